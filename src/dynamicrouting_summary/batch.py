@@ -0,0 +1,254 @@
+"""Compute per-unit metrics for many sessions in parallel.
+
+Each session's metrics are written to their own parquet shard as soon as they're
+computed, and recorded in a manifest: a run that's interrupted can be started
+again with the same `output_dir` and will skip sessions that are already done.
+Shards are combined into one table of metrics for all units at the end.
+
+Run from the command line with `dr-batch-metrics OUTPUT_DIR`, or from Python:
+
+>>> import dynamicrouting_summary.batch as batch
+>>> df = batch.run_batch('/tmp/metrics', session_ids=['366122_2023-12-31'])  # doctest: +SKIP
+"""
+
+from __future__ import annotations
+
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import pathlib
+import time
+import traceback
+from collections.abc import Callable, Iterable, Mapping, Sequence
+from typing import Any
+
+import pandas as pd
+
+import dynamicrouting_summary.derived as derived
+import dynamicrouting_summary.instrument as instrument
+import dynamicrouting_summary.opto as opto
+
+METRIC_FUNCTIONS: dict[str, Callable[[Any], None]] = {
+    "vis": opto.add_vis_response_metric,
+    "aud": opto.add_aud_response_metric,
+    "opto": opto.add_opto_response_metric,
+}
+
+MANIFEST_FILENAME = "manifest.jsonl"
+SHARDS_DIRNAME = "shards"
+COMBINED_FILENAME = "units_metrics.parquet"
+
+
+def get_session(session_id: str) -> Any:
+    """Default session factory: must be importable by worker processes"""
+    import npc_sessions
+
+    return npc_sessions.DynamicRoutingSession(session_id)
+
+
+def compute_session_metrics(
+    session: Any, metrics: Iterable[str] = METRIC_FUNCTIONS
+) -> pd.DataFrame:
+    """Run metric functions on a session and return a dataframe of the columns
+    they added to `session.units`, plus `unit_id`"""
+    units = session.units[:]
+    existing_columns = set(units.columns)
+    for name in metrics:
+        with instrument.stage("metric", metric=name, units=len(units)):
+            METRIC_FUNCTIONS[name](session)
+    units = session.units[:]
+    new_columns = [c for c in units.columns if c not in existing_columns]
+    return units[["unit_id", *new_columns]].reset_index(drop=True)
+
+
+def _get_shard_path(output_dir: pathlib.Path, session_id: str) -> pathlib.Path:
+    return output_dir / SHARDS_DIRNAME / f"{session_id}.parquet"
+
+
+def _process_session(
+    session_id: str,
+    output_dir: pathlib.Path,
+    metrics: Sequence[str],
+    session_factory: Callable[[str], Any],
+    fingerprint: str | None = None,
+) -> dict[str, Any]:
+    """Compute metrics for one session and write its shard: runs in a worker
+    process, and reports failures in the returned record instead of raising"""
+    t0 = time.perf_counter()
+    record: dict[str, Any] = {"session_id": session_id, "fingerprint": fingerprint}
+    try:
+        df = compute_session_metrics(session_factory(session_id), metrics)
+        df.insert(0, "session_id", session_id)
+        path = _get_shard_path(output_dir, session_id)
+        tmp = path.with_suffix(".tmp")
+        df.to_parquet(tmp, index=False)
+        os.replace(tmp, path)
+    except Exception as exc:
+        record.update(status="error", error=f"{exc!r}", traceback=traceback.format_exc())
+    else:
+        record.update(status="done", shard=path.name, units=len(df))
+    record["seconds"] = round(time.perf_counter() - t0, 3)
+    return record
+
+
+def read_manifest(output_dir: str | pathlib.Path) -> dict[str, dict[str, Any]]:
+    """Latest manifest record for each session"""
+    path = pathlib.Path(output_dir) / MANIFEST_FILENAME
+    records: dict[str, dict[str, Any]] = {}
+    if not path.exists():
+        return records
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # partial line from an interrupted write
+            records[record["session_id"]] = record
+    return records
+
+
+def get_completed_session_ids(
+    output_dir: str | pathlib.Path,
+    fingerprints: Mapping[str, str] | None = None,
+) -> set[str]:
+    """Sessions recorded as done in the manifest, with their shard on disk.
+
+    - if source `fingerprints` are provided (see
+      `derived.get_source_fingerprints`), sessions whose source has changed
+      since they were done are not included
+    """
+    output_dir = pathlib.Path(output_dir)
+    return {
+        session_id
+        for session_id, record in read_manifest(output_dir).items()
+        if record["status"] == "done"
+        and _get_shard_path(output_dir, session_id).exists()
+        and (fingerprints is None or record.get("fingerprint") == fingerprints.get(session_id))
+    }
+
+
+def combine_shards(
+    output_dir: str | pathlib.Path,
+    session_ids: Iterable[str] | None = None,
+) -> pd.DataFrame:
+    """Concatenate shards for completed sessions into one table and write it
+    to `output_dir`"""
+    output_dir = pathlib.Path(output_dir)
+    completed = get_completed_session_ids(output_dir)
+    if session_ids is not None:
+        completed &= set(session_ids)
+    dfs = [pd.read_parquet(_get_shard_path(output_dir, s)) for s in sorted(completed)]
+    if dfs:
+        df = pd.concat(dfs, ignore_index=True)
+    else:
+        df = pd.DataFrame(columns=["session_id", "unit_id"])
+    df.to_parquet(output_dir / COMBINED_FILENAME, index=False)
+    return df
+
+
+def run_batch(
+    output_dir: str | pathlib.Path,
+    session_ids: Iterable[str] | None = None,
+    metrics: Sequence[str] = tuple(METRIC_FUNCTIONS),
+    max_workers: int | None = None,
+    session_factory: Callable[[str], Any] = get_session,
+    version: str | None = None,
+    combine: bool = True,
+    fingerprints: Mapping[str, str] | None = None,
+    progress: bool | None = None,
+) -> pd.DataFrame | None:
+    """Compute metrics for each session in a pool of worker processes.
+
+    - `session_ids`: default is all sessions with units in the cache for
+      `version`
+    - `metrics`: names of functions in `METRIC_FUNCTIONS` to run on each session
+    - `session_factory`: creates a session object from a session ID: it must be
+      a module-level function, so it can be sent to worker processes
+    - sessions already done in `output_dir` are skipped; sessions that failed
+      are retried
+    - `fingerprints`: session ID -> fingerprint of the session's source data:
+      sessions whose fingerprint differs from when they were done are
+      recomputed. By default, when `session_ids` aren't specified, fingerprints
+      of units files in the cache are used, so a new cache version only
+      recomputes sessions that have changed
+    - `progress`: show a progress bar (default: only if stderr is a terminal -
+      see `instrument.is_progress_enabled`)
+    - returns the combined metrics table for `session_ids`, or None if
+      `combine` is False
+    """
+    output_dir = pathlib.Path(output_dir)
+    (output_dir / SHARDS_DIRNAME).mkdir(parents=True, exist_ok=True)
+    if unknown := set(metrics) - set(METRIC_FUNCTIONS):
+        raise ValueError(f"Unknown metrics {unknown}: expected some of {tuple(METRIC_FUNCTIONS)}")
+    if session_ids is None:
+        if fingerprints is None:
+            fingerprints = derived.get_source_fingerprints("units", version=version)
+        session_ids = sorted(fingerprints)
+    session_ids = list(dict.fromkeys(session_ids))
+    completed = get_completed_session_ids(output_dir, fingerprints)
+    pending = [s for s in session_ids if s not in completed]
+
+    # spawn: worker processes must not inherit numba/pyarrow thread pools via fork
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")
+    ) as executor, open(output_dir / MANIFEST_FILENAME, "a") as manifest:
+        futures = [
+            executor.submit(
+                _process_session,
+                session_id,
+                output_dir,
+                tuple(metrics),
+                session_factory,
+                fingerprints.get(session_id) if fingerprints else None,
+            )
+            for session_id in pending
+        ]
+        for future in instrument.track(
+            concurrent.futures.as_completed(futures),
+            total=len(futures),
+            description=f"Computing metrics ({len(session_ids) - len(pending)} already done)",
+            show=progress,
+        ):
+            manifest.write(json.dumps(future.result()) + "\n")
+            manifest.flush()
+    if not combine:
+        return None
+    return combine_shards(output_dir, session_ids)
+
+
+def main(argv: Sequence[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Compute per-unit metrics for many sessions in parallel, with resumable output."
+    )
+    parser.add_argument(
+        "output_dir", type=pathlib.Path, help="directory for shards, manifest and combined table"
+    )
+    parser.add_argument("--session-ids", nargs="+", help="default: all ephys sessions in the cache")
+    parser.add_argument("--version", help="cache version used to find sessions (default: latest)")
+    parser.add_argument(
+        "--metrics", nargs="+", choices=tuple(METRIC_FUNCTIONS), default=tuple(METRIC_FUNCTIONS)
+    )
+    parser.add_argument("--max-workers", type=int, help="default: number of CPUs")
+    parser.add_argument("--no-combine", action="store_true", help="don't combine shards at the end")
+    parser.add_argument("--no-progress", action="store_true", help="don't show a progress bar")
+    args = parser.parse_args(argv)
+    df = run_batch(
+        args.output_dir,
+        session_ids=args.session_ids,
+        metrics=args.metrics,
+        max_workers=args.max_workers,
+        version=args.version,
+        combine=not args.no_combine,
+        progress=False if args.no_progress else None,
+    )
+    records = read_manifest(args.output_dir).values()
+    if errors := [r for r in records if r["status"] == "error"]:
+        print(f"{len(errors)} sessions failed - see {args.output_dir / MANIFEST_FILENAME}")
+    if df is not None:
+        print(f"{len(df)} units written to {args.output_dir / COMBINED_FILENAME}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+"""Spike counts for a session's units at any bin size, from one pass over the
+spike times.
+
+Spikes are binned once at a fine base resolution (`BASE_BIN_SIZE`), and the
+cumulative count for each unit at every bin edge is stored on disk. The count
+of spikes in any interval on the base grid is then the difference of two
+cumulative counts: binning at a coarser bin size (any multiple of the base),
+counting in arbitrary windows or around events reads only the edges needed,
+instead of rebinning every spike.
+
+Cumulative counts are stored as uint32 in a memory-mapped array of shape
+(edges x units), so that all units' counts at an edge are contiguous: a
+session of 300 units lasting 1 hour takes ~4.3 GB at 1 ms resolution.
+
+>>> import tempfile
+>>> counts = write_binned_counts(
+...     tempfile.mkdtemp(), ['a', 'b'], [[0.0012, 0.0051, 0.0123], [0.0099]], bin_size=0.001,
+... )
+>>> counts
+BinnedCounts(bin_size=0.001, units=2, stop_time=0.013)
+>>> binned, edges = counts.get_counts(bin_size=0.005)
+>>> binned.tolist(), edges.tolist()
+([[1, 1], [0, 1]], [0.0, 0.005, 0.01])
+>>> counts.get_window_counts([0.0, 0.005], [0.01, 0.013]).tolist()
+[[2, 2], [1, 1]]
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import pathlib
+import shutil
+from collections.abc import Iterable, Sequence
+
+import numba
+import numpy as np
+import numpy.typing as npt
+import pandas as pd
+
+import dynamicrouting_summary.instrument as instrument
+import dynamicrouting_summary.storage as storage
+import dynamicrouting_summary.utils as utils
+from dynamicrouting_summary.spike_store import flatten_spike_times
+
+BASE_BIN_SIZE = 0.001
+BINNED_COUNTS_DIRNAME = "binned_counts"
+CUMULATIVE_COUNTS_FILENAME = "cumulative_counts.npy"
+UNIT_IDS_FILENAME = "unit_ids.npy"
+METADATA_FILENAME = "metadata.json"
+EDGES_PER_CHUNK = 2**14
+
+
+@numba.njit(nogil=True, parallel=True)
+def _fill_cumulative_counts(spike_times, offsets, first_edge, bin_size, out):
+    """Fill (edges x units) `out` with the number of spikes of each unit before
+    each edge, for edges at `(first_edge + idx) * bin_size`"""
+    n_edges = out.shape[0]
+    for uu in numba.prange(len(offsets) - 1):
+        unit_spike_times = spike_times[offsets[uu] : offsets[uu + 1]]
+        ss = np.searchsorted(unit_spike_times, first_edge * bin_size)
+        for ee in range(n_edges):
+            edge = (first_edge + ee) * bin_size
+            while ss < len(unit_spike_times) and unit_spike_times[ss] < edge:
+                ss += 1
+            out[ee, uu] = ss
+
+
+def write_binned_counts(
+    path: str | pathlib.Path,
+    unit_ids: Sequence[str],
+    spike_times: Iterable[npt.ArrayLike],
+    bin_size: float = BASE_BIN_SIZE,
+) -> BinnedCounts:
+    """Bin spike times for units at `bin_size`, write cumulative counts to
+    `path` (replaced if it exists) and open them.
+
+    - bin edges are multiples of `bin_size` from time 0, up to the first edge
+      after the last spike
+    - bins include their left edge and exclude their right edge
+    """
+    path = pathlib.Path(path)
+    flat_spike_times, offsets = flatten_spike_times(spike_times)
+    stop_time = flat_spike_times.max() if len(flat_spike_times) else 0.0
+    n_edges = int(np.floor(stop_time / bin_size)) + 2
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    tmp.mkdir(parents=True, exist_ok=True)
+    with instrument.stage("binned_counts_write", units=len(unit_ids), rows=n_edges):
+        cumulative_counts = np.lib.format.open_memmap(
+            tmp / CUMULATIVE_COUNTS_FILENAME,
+            mode="w+",
+            dtype=np.uint32,
+            shape=(n_edges, len(unit_ids)),
+        )
+        # in chunks of edges, so the array being filled stays in memory
+        for first_edge in range(0, n_edges, EDGES_PER_CHUNK):
+            _fill_cumulative_counts(
+                flat_spike_times,
+                offsets,
+                first_edge,
+                bin_size,
+                np.asarray(cumulative_counts[first_edge : first_edge + EDGES_PER_CHUNK]),
+            )
+        cumulative_counts.flush()
+        del cumulative_counts
+    np.save(tmp / UNIT_IDS_FILENAME, np.array(unit_ids, dtype=str))
+    (tmp / METADATA_FILENAME).write_text(json.dumps(dict(bin_size=bin_size, n_edges=n_edges)))
+    if path.exists():
+        shutil.rmtree(path)
+    os.replace(tmp, path)
+    return BinnedCounts(path)
+
+
+def get_binned_counts_path(
+    session_id: str, version: str | None = None, bin_size: float = BASE_BIN_SIZE
+) -> pathlib.Path:
+    version = utils.get_cache_version(version)
+    return (
+        utils.LOCAL_CACHE_DIR
+        / BINNED_COUNTS_DIRNAME
+        / version
+        / f"{session_id}_{bin_size * 1e3:g}ms"
+    )
+
+
+def get_binned_counts(
+    session_id: str,
+    version: str | None = None,
+    bin_size: float = BASE_BIN_SIZE,
+    refresh: bool = False,
+) -> BinnedCounts:
+    """Cumulative spike counts for all units in a session, binned at
+    `bin_size`.
+
+    Made from the session's units file the first time they're requested for a
+    cache version, then kept in `LOCAL_CACHE_DIR` and memory-mapped on
+    subsequent calls (unless `refresh` is True).
+    """
+    version = utils.get_cache_version(version)
+    path = get_binned_counts_path(session_id, version, bin_size)
+    if path.exists() and not refresh:
+        return BinnedCounts(path)
+    units = pd.read_parquet(
+        storage.get_cache_path("units", session_id, version=version),
+        columns=["unit_id", "spike_times"],
+    )
+    return write_binned_counts(path, units["unit_id"].tolist(), units["spike_times"], bin_size)
+
+
+class BinnedCounts:
+    """Cumulative spike counts from `write_binned_counts`: spike counts in any
+    interval with edges on the grid of `bin_size` are differences of two
+    cumulative counts.
+
+    - times are rounded to the nearest edge on the grid
+    - counts are returned with units in the order of `unit_ids` (default all
+      units)
+    """
+
+    def __init__(self, path: str | pathlib.Path) -> None:
+        self.path = pathlib.Path(path)
+        metadata = json.loads((self.path / METADATA_FILENAME).read_text())
+        self.bin_size: float = metadata["bin_size"]
+        self.unit_ids: npt.NDArray[np.str_] = np.load(self.path / UNIT_IDS_FILENAME)
+        self.cumulative_counts: npt.NDArray[np.uint32] = np.load(
+            self.path / CUMULATIVE_COUNTS_FILENAME, mmap_mode="r"
+        )
+        self._index = {unit_id: idx for idx, unit_id in enumerate(self.unit_ids.tolist())}
+
+    def __len__(self) -> int:
+        return len(self.unit_ids)
+
+    def __repr__(self) -> str:
+        return (
+            f"{self.__class__.__name__}(bin_size={self.bin_size:g}, units={len(self)},"
+            f" stop_time={self.stop_time:g})"
+        )
+
+    @property
+    def stop_time(self) -> float:
+        """Time of the last edge: after the last spike of all units"""
+        return (self.cumulative_counts.shape[0] - 1) * self.bin_size
+
+    def _get_unit_indices(self, unit_ids: Iterable[str] | None) -> npt.NDArray[np.intp] | slice:
+        if unit_ids is None:
+            return slice(None)
+        return np.array([self._index[unit_id] for unit_id in unit_ids], dtype=np.intp)
+
+    def _round_to_edges(self, times: npt.ArrayLike) -> npt.NDArray[np.intp]:
+        """Indices of the nearest edges to times: may be outside the stored
+        edges"""
+        return np.round(np.asarray(times, dtype=np.float64) / self.bin_size).astype(np.intp)
+
+    def _clip_edge_indices(self, edge_indices: npt.NDArray[np.intp]) -> npt.NDArray[np.intp]:
+        # no spikes are stored before the first edge or after the last, so
+        # cumulative counts outside the stored edges equal those at the ends
+        return np.clip(edge_indices, 0, self.cumulative_counts.shape[0] - 1)
+
+    def _get_edge_indices(self, times: npt.ArrayLike) -> npt.NDArray[np.intp]:
+        return self._clip_edge_indices(self._round_to_edges(times))
+
+    def _get_step(self, bin_size: float | None) -> int:
+        """Number of base bins in `bin_size`"""
+        if bin_size is None:
+            return 1
+        step = round(bin_size / self.bin_size)
+        if step < 1 or not np.isclose(step * self.bin_size, bin_size):
+            raise ValueError(
+                f"bin_size must be a multiple of the base bin size {self.bin_size}: got {bin_size}"
+            )
+        return step
+
+    def _get_counts_at_edges(
+        self, edge_indices: npt.NDArray[np.intp], unit_ids: Iterable[str] | None
+    ) -> npt.NDArray[np.uint32]:
+        """Cumulative counts at edges (any shape), with units as the last axis"""
+        counts = self.cumulative_counts[edge_indices.ravel()]
+        counts = counts[:, self._get_unit_indices(unit_ids)]
+        return counts.reshape(*edge_indices.shape, counts.shape[-1])
+
+    def get_counts(
+        self,
+        bin_size: float | None = None,
+        start_time: float = 0.0,
+        stop_time: float | None = None,
+        unit_ids: Iterable[str] | None = None,
+    ) -> tuple[npt.NDArray[np.uint32], npt.NDArray[np.float64]]:
+        """Spike counts in consecutive bins of `bin_size` (a multiple of the
+        base bin size, default the base bin size) from `start_time` to
+        `stop_time` (default the last edge).
+
+        - returns (units x bins) array of counts (a transposed view), and bin
+          edges
+        - the last bin ends at or before `stop_time`
+        """
+        step = self._get_step(bin_size)
+        first, last = self._get_edge_indices(
+            [start_time, self.stop_time if stop_time is None else stop_time]
+        )
+        edge_indices = np.arange(first, last + 1, step)
+        # a strided view of the memory-mapped counts: only the diff is allocated
+        cumulative_counts = self.cumulative_counts[first : last + 1 : step]
+        counts = np.diff(cumulative_counts[:, self._get_unit_indices(unit_ids)], axis=0)
+        return counts.T, edge_indices * self.bin_size
+
+    def get_window_counts(
+        self,
+        start_times: npt.ArrayLike,
+        stop_times: npt.ArrayLike,
+        unit_ids: Iterable[str] | None = None,
+    ) -> npt.NDArray[np.uint32]:
+        """Spike counts in each window from start to stop time: returns (units x
+        windows) array of counts
+
+        - raises ValueError if any window stops before it starts
+        """
+        start_times = np.asarray(start_times, dtype=np.float64)
+        stop_times = np.asarray(stop_times, dtype=np.float64)
+        if np.any(stop_times < start_times):
+            raise ValueError("Windows must not stop before they start: got stop_time < start_time")
+        edge_indices = np.stack(
+            [self._get_edge_indices(start_times), self._get_edge_indices(stop_times)], axis=-1
+        )
+        counts = self._get_counts_at_edges(edge_indices, unit_ids)
+        return (counts[:, 1] - counts[:, 0]).T
+
+    def get_event_aligned_counts(
+        self,
+        event_times: npt.ArrayLike,
+        time_before: float,
+        time_after: float,
+        bin_size: float | None = None,
+        unit_ids: Iterable[str] | None = None,
+    ) -> tuple[npt.NDArray[np.uint32], npt.NDArray[np.float64]]:
+        """Spike counts in bins around each event, with the same bins as
+        `spike_utils.make_neuron_time_trials_tensor`.
+
+        - returns (units x time x events) array of counts, and bin centers
+          relative to events
+        - event times are rounded to the nearest edge on the base grid: counts
+          equal the tensor's for events on the grid, otherwise a spike within
+          half a base bin of a bin edge can be counted in the neighbouring bin
+        - bins before the start or after the end of the recording count no
+          spikes, as in the tensor, so spike times before 0 (not stored) are not
+          counted
+        """
+        step = self._get_step(bin_size)
+        bins = np.arange(-time_before, time_after, step * self.bin_size)
+        first = self._round_to_edges(np.asarray(event_times, dtype=np.float64) - time_before)
+        # clip after offsetting from the first edge, so that windows extending
+        # past either end of the recording are not shifted
+        edge_indices = self._clip_edge_indices(first[:, np.newaxis] + step * np.arange(len(bins)))
+        counts = np.diff(self._get_counts_at_edges(edge_indices, unit_ids), axis=1)
+        return counts.transpose(2, 1, 0), (bins[:-1] + bins[1:]) / 2
@@ -1,21 +1,88 @@
 from __future__ import annotations
 
 import typing
+from collections.abc import Iterable, Mapping, Sequence
 
 import npc_lims
 import pandas as pd
+import pyarrow.compute as pc
+
+import dynamicrouting_summary.instrument as instrument
+import dynamicrouting_summary.storage as storage
 import dynamicrouting_summary.utils as utils
 
+T = typing.TypeVar("T")
+
+
+def _get_for_component(arg: T | Mapping[str, T] | None, component: str) -> T | None:
+    if isinstance(arg, Mapping):
+        return arg.get(component)
+    return arg
+
+
+def _read_component(
+    component: str,
+    version: str | None,
+    with_bool_columns: bool,
+    columns: Sequence[str] | None = None,
+    filters: pc.Expression | None = None,
+) -> pd.DataFrame:
+    if columns is not None and with_bool_columns:
+        columns = [*columns, *(c for c in utils.SESSION_ID_COLUMNS if c not in columns)]
+    path = storage.get_cache_path(component, version=version)
+    with instrument.stage("read_parquet", component=component) as stage:
+        df = pd.read_parquet(path, columns=columns, filters=filters)
+        stage.update(rows=len(df))
+    if instrument.is_enabled():
+        # after the stage, so the metadata read isn't included in its time
+        stage.update(bytes_read=instrument.get_parquet_bytes(path, columns))
+    if with_bool_columns:
+        df = utils.add_bool_columns(df, version=version)
+    return df
+
+
+def get_dfs(
+    version: str | None = None,
+    with_bool_columns: bool = True,
+    components: Iterable[str | npc_lims.NWBComponentStr] | None = None,
+    columns: Sequence[str] | Mapping[str, Sequence[str]] | None = None,
+    filters: pc.Expression | Mapping[str, pc.Expression] | None = None,
+    prefetch: bool = False,
+    max_bytes: int | None = None,
+) -> typing.Mapping[str | npc_lims.NWBComponentStr, pd.DataFrame]:
+    """Get a dictionary of dataframes for each table-like component in an NWB file (except units).
 
-def get_dfs(version: str | None = None, with_bool_columns: bool = True) -> typing.Mapping[str | npc_lims.NWBComponentStr, pd.DataFrame]:
-    """Get a dictionary of dataframes for each table-like component in an NWB file (except units)."""
-    components = (c for c in typing.get_args(npc_lims.NWBComponentStr) if c != "units")
-    def _helper(component, version, with_bool_columns) -> pd.DataFrame:
-        df = pd.read_parquet(npc_lims.get_cache_path(component, version=version))
-        if with_bool_columns:
-            df = utils.add_bool_columns(df)
-        return df
-    return utils.LazyDict({
-        component: (_helper, (component, version, with_bool_columns), {})
+    - `components`: only get these components, instead of all
+    - `columns`: only read these columns - applied to every component, or
+      specified per component as a mapping of component to columns
+    - `filters`: a pyarrow expression pushed down into the parquet scan, e.g.
+      `ds.field('subject_id') == 366122` - applied to every component, or
+      specified per component as a mapping
+    - `prefetch`: start reading all components concurrently in background
+      threads, instead of reading each one when first accessed
+    - `max_bytes`: memory budget for dataframes held by the returned mapping:
+      least-recently-used dataframes are dropped when it's exceeded, and read
+      again on next access
+    """
+    if components is None:
+        components = (c for c in typing.get_args(npc_lims.NWBComponentStr) if c != "units")
+    args = {
+        component: (
+            component,
+            version,
+            with_bool_columns,
+            _get_for_component(columns, component),
+            _get_for_component(filters, component),
+        )
         for component in components
-    })
\ No newline at end of file
+    }
+    dfs: utils.LazyDict[str, pd.DataFrame] = utils.LazyDict(
+        {
+            component: (_read_component, component_args, {})
+            for component, component_args in args.items()
+        },
+        max_bytes=max_bytes,
+    )
+    if prefetch:
+        dfs.prefetch()
+    return dfs
@@ -0,0 +1,287 @@
+"""Tables derived from the `npc_lims` cache, recomputed incrementally.
+
+Each derived table is computed per session from a source component in the
+cache: either by a function that reads a session's files, or from the
+session's rows of a few source columns, read for all sessions to update in one
+dataset scan. The result for each session is stored on local disk in
+`LOCAL_CACHE_DIR/derived/<name>`, with a manifest of the source file
+fingerprint it was computed from (its S3 ETag, or size and modification time).
+When a new cache version lands, only sessions whose source files are new or
+have changed are recomputed: the rest are reused from previous versions.
+
+>>> import dynamicrouting_summary.derived as derived
+>>> df = derived.get_derived_table('structure_probe')  # doctest: +SKIP
+"""
+
+from __future__ import annotations
+
+import concurrent.futures
+import dataclasses
+import hashlib
+import json
+import os
+import pathlib
+import threading
+from collections.abc import Callable, Iterable, Mapping, Sequence
+from typing import Optional
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+import dynamicrouting_summary.storage as storage
+import dynamicrouting_summary.utils as utils
+
+DERIVED_DIRNAME = "derived"
+ComputeFn = Callable[[str, Optional[str]], pd.DataFrame]
+TransformFn = Callable[[pd.DataFrame], pd.DataFrame]
+MANIFEST_FILENAME = "manifest.json"
+SHARDS_DIRNAME = "shards"
+
+
+@dataclasses.dataclass(frozen=True)
+class DerivedTable:
+    """A table computed per session from one component in the cache.
+
+    - `compute` is called with a session ID (the name of the session's file in
+      the cache) and cache version, and returns that session's rows
+    - or, if `columns` is set, `transform` is called with a session's rows of
+      those columns in the source, read for all sessions in one scan
+    """
+
+    name: str
+    component: str
+    compute: ComputeFn | None = None
+    transform: TransformFn | None = None
+    columns: tuple[str, ...] | None = None
+
+    @property
+    def path(self) -> pathlib.Path:
+        # resolved on access, so `utils.LOCAL_CACHE_DIR` can be changed at runtime
+        return utils.LOCAL_CACHE_DIR / DERIVED_DIRNAME / self.name
+
+
+DERIVED_TABLES: dict[str, DerivedTable] = {}
+
+
+def register(name: str, component: str) -> Callable[[ComputeFn], ComputeFn]:
+    """Decorator to register a per-session function as a derived table"""
+
+    def decorator(compute: ComputeFn) -> ComputeFn:
+        DERIVED_TABLES[name] = DerivedTable(name, component, compute)
+        return compute
+
+    return decorator
+
+
+def register_scan(
+    name: str, component: str, columns: Sequence[str]
+) -> Callable[[TransformFn], TransformFn]:
+    """Decorator to register a function of one session's rows of `columns` in
+    the source as a derived table"""
+
+    def decorator(transform: TransformFn) -> TransformFn:
+        DERIVED_TABLES[name] = DerivedTable(
+            name, component, transform=transform, columns=tuple(columns)
+        )
+        return transform
+
+    return decorator
+
+
+def get_source_fingerprints(component: str, version: str | None = None) -> dict[str, str]:
+    """Session ID -> fingerprint of each per-session file for a component in
+    the cache, from a single directory listing"""
+    path = storage.get_remote_cache_path(component, version=version, consolidated=False)
+    return {
+        pathlib.PurePosixPath(info["name"]).stem: storage.get_fingerprint(info)
+        for info in storage.get_filesystem(path).ls(path.path, detail=True)
+        if info["type"] == "file"
+    }
+
+
+def read_manifest(name: str) -> dict[str, str]:
+    """Session ID -> source fingerprint for each session stored for a derived
+    table"""
+    path = DERIVED_TABLES[name].path / MANIFEST_FILENAME
+    if not path.exists():
+        return {}
+    return json.loads(path.read_text())
+
+
+def _get_tmp_path(path: pathlib.Path) -> pathlib.Path:
+    # unique to each process and thread writing the same file
+    return path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+
+
+def _write_manifest(name: str, manifest: Mapping[str, str]) -> None:
+    path = DERIVED_TABLES[name].path / MANIFEST_FILENAME
+    tmp = _get_tmp_path(path)
+    tmp.write_text(json.dumps(dict(sorted(manifest.items())), indent=1))
+    os.replace(tmp, path)
+
+
+def _write_atomic(df: pd.DataFrame, path: pathlib.Path) -> None:
+    df.to_parquet(tmp := _get_tmp_path(path), index=False)
+    os.replace(tmp, path)
+
+
+def _get_fingerprints(
+    table: DerivedTable, version: str | None, session_ids: Iterable[str] | None
+) -> dict[str, str]:
+    fingerprints = get_source_fingerprints(table.component, version=version)
+    if session_ids is None:
+        return fingerprints
+    return {s: fingerprints[s] for s in session_ids if s in fingerprints}
+
+
+def _scan_sources(
+    table: DerivedTable, session_ids: Sequence[str], version: str | None
+) -> dict[str, pd.DataFrame]:
+    """Session ID -> rows of `table.columns` in each session's source file,
+    read in one dataset scan"""
+    assert table.columns is not None
+    path = storage.get_remote_cache_path(table.component, version=version, consolidated=False)
+    dataset = ds.dataset(
+        [f"{path.path}/{session_id}.parquet" for session_id in session_ids],
+        filesystem=storage.get_filesystem(path),
+        format="parquet",
+    )
+    scanner = dataset.scanner(columns=list(table.columns))
+    batches: dict[str, list[pa.RecordBatch]] = {session_id: [] for session_id in session_ids}
+    for tagged in scanner.scan_batches():
+        batches[pathlib.PurePosixPath(tagged.fragment.path).stem].append(tagged.record_batch)
+    schema = scanner.projected_schema
+    return {
+        session_id: pa.Table.from_batches(session_batches, schema=schema).to_pandas()
+        for session_id, session_batches in batches.items()
+    }
+
+
+def get_stale_session_ids(name: str, fingerprints: Mapping[str, str]) -> list[str]:
+    """Sessions that are new, or whose source files have changed since they
+    were computed"""
+    manifest = read_manifest(name)
+    shards = DERIVED_TABLES[name].path / SHARDS_DIRNAME
+    return [
+        session_id
+        for session_id, fingerprint in fingerprints.items()
+        if manifest.get(session_id) != fingerprint
+        or not (shards / f"{session_id}.parquet").exists()
+    ]
+
+
+def update_derived_table(
+    name: str,
+    version: str | None = None,
+    session_ids: Iterable[str] | None = None,
+    max_workers: int | None = None,
+    refresh: bool = False,
+) -> list[str]:
+    """Compute a derived table for sessions that are new or have changed in the
+    cache, and return their session IDs.
+
+    - sessions are computed concurrently in threads: the manifest is updated as
+      each one finishes, so an interrupted update keeps completed sessions
+    - `refresh`: recompute all sessions, even if their source is unchanged
+    """
+    table = DERIVED_TABLES[name]
+    fingerprints = _get_fingerprints(table, version, session_ids)
+    return _update(table, fingerprints, version, max_workers, refresh)
+
+
+def _update(
+    table: DerivedTable,
+    fingerprints: Mapping[str, str],
+    version: str | None,
+    max_workers: int | None,
+    refresh: bool,
+) -> list[str]:
+    stale = list(fingerprints) if refresh else get_stale_session_ids(table.name, fingerprints)
+    if not stale:
+        return stale
+    (table.path / SHARDS_DIRNAME).mkdir(parents=True, exist_ok=True)
+    manifest = read_manifest(table.name)
+    if table.transform is not None:
+        sources = _scan_sources(table, stale, version)
+        for session_id, source in sources.items():
+            _write_atomic(
+                table.transform(source), table.path / SHARDS_DIRNAME / f"{session_id}.parquet"
+            )
+            manifest[session_id] = fingerprints[session_id]
+        _write_manifest(table.name, manifest)
+        return stale
+    assert table.compute is not None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        future_to_session_id = {
+            executor.submit(table.compute, session_id, version): session_id
+            for session_id in stale
+        }
+        for future in concurrent.futures.as_completed(future_to_session_id):
+            session_id = future_to_session_id[future]
+            _write_atomic(future.result(), table.path / SHARDS_DIRNAME / f"{session_id}.parquet")
+            manifest[session_id] = fingerprints[session_id]
+            _write_manifest(table.name, manifest)
+    return stale
+
+
+def get_derived_table(
+    name: str,
+    version: str | None = None,
+    session_ids: Iterable[str] | None = None,
+    refresh: bool = False,
+    max_workers: int | None = None,
+) -> pd.DataFrame:
+    """Get a derived table for all sessions in a cache version, or a subset of
+    them, updating only sessions that are new or have changed.
+
+    - `refresh`: recompute all sessions, even if their source is unchanged
+    """
+    table = DERIVED_TABLES[name]
+    fingerprints = _get_fingerprints(table, version, session_ids)
+    updated = _update(table, fingerprints, version, max_workers, refresh)
+
+    # the combined table for a set of sessions is reused until any of them changes
+    subset_key = _get_key(sorted(fingerprints))
+    combined = table.path / f"{name}_{subset_key}_{_get_key(sorted(fingerprints.items()))}.parquet"
+    if combined.exists() and not updated:
+        return pd.read_parquet(combined)
+    if not fingerprints:
+        return pd.DataFrame()
+    shards = table.path / SHARDS_DIRNAME
+    df = pd.concat(
+        [pd.read_parquet(shards / f"{s}.parquet") for s in sorted(fingerprints)],
+        ignore_index=True,
+    )
+    # previous combined tables for the same set of sessions are out of date
+    for path in table.path.glob(f"{name}_{subset_key}_*.parquet"):
+        path.unlink(missing_ok=True)
+    _write_atomic(df, combined)
+    return df
+
+
+def _get_key(value: object) -> str:
+    return hashlib.sha1(json.dumps(value).encode()).hexdigest()[:16]
+
+
+@register_scan(
+    "session_index", component="session", columns=[*utils.SESSION_ID_COLUMNS, "keywords"]
+)
+def _compute_session_index(session_df: pd.DataFrame) -> pd.DataFrame:
+    return utils.make_session_index(session_df)
+
+
+@register("structure_probe", component="units")
+def _compute_structure_probe(session_id: str, version: str | None) -> pd.DataFrame:
+    import dynamicrouting_summary.spike_utils as spike_utils
+
+    return spike_utils.get_structure_probe(session_id, version=version)
+
+
+@register_scan(
+    "performance_dprime",
+    component="performance",
+    columns=[*utils.SESSION_ID_COLUMNS, "block_index", "same_modal_dprime", "cross_modal_dprime"],
+)
+def _compute_performance_dprime(performance_df: pd.DataFrame) -> pd.DataFrame:
+    return utils.add_session_id_column(performance_df).astype({"session_id": str})
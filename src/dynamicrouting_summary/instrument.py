@@ -0,0 +1,285 @@
+"""Opt-in timing of stages in the package's hot paths.
+
+Functions in `dataframes`, `utils`, `spike_utils` and `opto` mark their main
+stages - parquet reads, the bool-column join, spike counting, masking of
+invalid intervals, tensor builds - with `stage`. When recording is enabled,
+each stage's wall time, rows and units processed, bytes read and the process's
+peak RSS are recorded. When it's disabled (the default) a stage only checks a
+flag.
+
+Enable for a block of code and get a report as a dataframe or JSON:
+
+>>> import dynamicrouting_summary.instrument as instrument
+>>> with instrument.recording():
+...     with instrument.stage('outer', rows=10):
+...         with instrument.stage('inner') as s:
+...             s.update(units=3)
+>>> instrument.get_report()[['stage', 'parent', 'rows', 'units']]
+   stage parent  rows  units
+0  inner  outer   NaN    3.0
+1  outer    NaN  10.0    NaN
+>>> instrument.get_summary()['calls'].to_dict()
+{'outer': 1, 'inner': 1}
+
+or for a whole process, by setting the environment variable
+`DR_SUMMARY_INSTRUMENT=1`. Stages in worker processes (e.g. in `batch`) are
+recorded in the workers, not in the parent process.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from collections.abc import Callable, Iterable, Iterator, Sequence
+from typing import Any, TypeVar
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None  # type: ignore[assignment]
+
+T = TypeVar("T")
+F = TypeVar("F", bound=Callable[..., Any])
+
+REPORT_COLUMNS = (
+    "stage", "parent", "start", "seconds", "rows", "units", "bytes_read", "peak_rss_mb",
+)
+SUMMARY_SUMS = ("seconds", "rows", "units", "bytes_read")
+
+_enabled = os.environ.get("DR_SUMMARY_INSTRUMENT", "0") not in ("", "0", "false", "False")
+_records: list[dict[str, Any]] = []
+_records_lock = threading.Lock()
+_local = threading.local()
+_t0 = time.perf_counter()
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def enable(reset: bool = True) -> None:
+    """Start recording stages, clearing previous records unless `reset` is
+    False"""
+    global _enabled
+    if reset:
+        clear()
+    _enabled = True
+
+
+def disable() -> None:
+    """Stop recording stages: records made so far are kept"""
+    global _enabled
+    _enabled = False
+
+
+def clear() -> None:
+    global _t0
+    with _records_lock:
+        _records.clear()
+    _t0 = time.perf_counter()
+
+
+@contextlib.contextmanager
+def recording(reset: bool = True) -> Iterator[None]:
+    """Record stages within the context, then restore the previous state"""
+    previous = _enabled
+    enable(reset=reset)
+    try:
+        yield
+    finally:
+        if not previous:
+            disable()
+
+
+def get_peak_rss_mb() -> float | None:
+    """Peak resident set size of this process so far, in MB"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1e6 if sys.platform == "darwin" else 1e3)
+
+
+class Stage:
+    """Context manager that records a stage, if recording is enabled.
+
+    - `fields` are added to the stage's record: `rows`, `units` and
+      `bytes_read` are summed in the summary, other fields are labels
+    - more fields can be added with `update`, before or after the stage
+      exits (e.g. to measure bytes read without including it in the stage's
+      time)
+    """
+
+    __slots__ = ("_parent", "_start", "fields", "name", "record")
+
+    def __init__(self, name: str, **fields: Any) -> None:
+        self.name = name
+        self.fields = fields
+        self.record: dict[str, Any] | None = None
+
+    def __enter__(self) -> Stage:
+        if not _enabled:
+            return self
+        stack = _local.__dict__.setdefault("stack", [])
+        self._parent = stack[-1].name if stack else None
+        stack.append(self)
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        if not _enabled or not hasattr(self, "_start"):
+            return
+        end = time.perf_counter()
+        _local.stack.pop()
+        self.record = dict(
+            stage=self.name,
+            parent=self._parent,
+            start=self._start - _t0,
+            seconds=end - self._start,
+            peak_rss_mb=get_peak_rss_mb(),
+            **self.fields,
+        )
+        with _records_lock:
+            _records.append(self.record)
+
+    def update(self, **fields: Any) -> None:
+        if not _enabled:
+            return
+        self.fields.update(fields)
+        if self.record is not None:
+            self.record.update(fields)
+
+
+# lowercase, as it's used like a function: `with instrument.stage(...):`
+stage = Stage
+
+
+def update(**fields: Any) -> None:
+    """Add fields to the innermost stage running in this thread, e.g. in a
+    function decorated with `timed`"""
+    if _enabled and getattr(_local, "stack", None):
+        _local.stack[-1].update(**fields)
+
+
+def timed(name: str) -> Callable[[F], F]:
+    """Decorator to record each call of a function as a stage
+
+    >>> @timed('add')
+    ... def add(a, b):
+    ...     update(rows=2)
+    ...     return a + b
+    >>> with recording():
+    ...     add(1, 2)
+    3
+    >>> get_report()[['stage', 'rows']]
+      stage  rows
+    0   add     2
+    """
+
+    def decorator(fn: F) -> F:
+        @functools.wraps(fn)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            if not _enabled:
+                return fn(*args, **kwargs)
+            with stage(name):
+                return fn(*args, **kwargs)
+
+        return wrapper  # type: ignore[return-value]
+
+    return decorator
+
+
+def get_records() -> list[dict[str, Any]]:
+    """Records of stages, in the order they finished"""
+    with _records_lock:
+        return [dict(record) for record in _records]
+
+
+def get_report() -> pd.DataFrame:
+    """Dataframe with one row per recorded stage, in the order they finished:
+    nested stages finish before their `parent`"""
+    df = pd.DataFrame.from_records(get_records())
+    for column in REPORT_COLUMNS:
+        if column not in df:
+            df[column] = None
+    return df[[*REPORT_COLUMNS, *(c for c in df.columns if c not in REPORT_COLUMNS)]]
+
+
+def get_summary() -> pd.DataFrame:
+    """Recorded stages aggregated by name: number of calls, summed seconds, rows,
+    units and bytes read, and the largest peak RSS, sorted by total time"""
+    df = get_report()
+    if df.empty:
+        return pd.DataFrame(columns=["calls", *SUMMARY_SUMS, "peak_rss_mb"])
+    grouped = df.groupby("stage", sort=False)
+    summary = grouped[list(SUMMARY_SUMS)].sum(min_count=1)
+    summary.insert(0, "calls", grouped.size())
+    summary["peak_rss_mb"] = grouped["peak_rss_mb"].max()
+    return summary.sort_values("seconds", ascending=False)
+
+
+def to_json(path: str | os.PathLike | None = None) -> str:
+    """Report of recorded stages and their summary as JSON, optionally written
+    to `path`"""
+    # via pandas, so missing values are null
+    text = json.dumps(
+        dict(
+            stages=json.loads(get_report().to_json(orient="records")),
+            summary=json.loads(get_summary().reset_index().to_json(orient="records")),
+        ),
+        indent=1,
+    )
+    if path is not None:
+        with open(path, "w") as f:
+            f.write(text)
+    return text
+
+
+def get_parquet_bytes(path: Any, columns: Sequence[str] | None = None) -> int:
+    """Compressed size of `columns` (default all) in a parquet file: the
+    number of bytes read to load them, without filters"""
+    import pyarrow.parquet as pq
+    import upath
+
+    with upath.UPath(path).open("rb") as f:
+        metadata = pq.ParquetFile(f).metadata
+    total = 0
+    for row_group in range(metadata.num_row_groups):
+        for column in range(metadata.num_columns):
+            chunk = metadata.row_group(row_group).column(column)
+            if columns is None or chunk.path_in_schema.split(".")[0] in columns:
+                total += chunk.total_compressed_size
+    return total
+
+
+def is_progress_enabled() -> bool:
+    """Progress bars are shown when stderr is a terminal, unless disabled with
+    the environment variable `DR_SUMMARY_PROGRESS=0`"""
+    setting = os.environ.get("DR_SUMMARY_PROGRESS")
+    if setting is not None:
+        return setting not in ("", "0", "false", "False")
+    return sys.stderr.isatty()
+
+
+def track(
+    iterable: Iterable[T],
+    description: str = "",
+    total: float | None = None,
+    show: bool | None = None,
+) -> Iterable[T]:
+    """`rich.progress.track`, if `show` is True (default: see
+    `is_progress_enabled`), otherwise `iterable` unchanged"""
+    if show is None:
+        show = is_progress_enabled()
+    if not show:
+        return iterable
+    import rich.progress
+
+    return rich.progress.track(iterable, description=description, total=total)
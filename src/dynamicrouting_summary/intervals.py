@@ -0,0 +1,246 @@
+from __future__ import annotations
+
+from collections.abc import Iterable, Iterator, Mapping, Sequence
+from typing import Literal, Union, overload
+
+import hdmf.common
+import numpy as np
+import numpy.typing as npt
+import pandas as pd
+from typing_extensions import TypeAlias
+
+Interval: TypeAlias = Union[
+    Sequence[float],
+    Mapping[Literal["start_time", "stop_time"], float],
+    pd.Series,
+    pd.DataFrame,
+]
+
+
+def _parse_times(times: object) -> npt.NDArray[np.float64]:
+    """Parse a sequence of start times and a sequence of stop times, or a single
+    start and stop time, as an (n, 2) array"""
+    columns = []
+    for t in times:  # type: ignore [attr-defined]
+        if isinstance(t, hdmf.common.table.VectorData):
+            t = t.data
+        columns.append(np.atleast_1d(np.asarray(t, dtype=np.float64)))
+    if len(columns) != 2 or columns[0].shape != columns[1].shape:
+        raise ValueError(f"Invalid interval, expected [start_time, stop_time]: {times!r}")
+    return np.column_stack(columns)
+
+
+def _parse_interval(interval: Interval) -> npt.NDArray[np.float64]:
+    """Parse one item as an (n, 2) array: an item may contain multiple intervals,
+    eg. a DataFrame or a pair of sequences of start and stop times"""
+    if isinstance(interval, IntervalArray):
+        return interval.values
+    try:
+        times = (interval.get("start_time"), interval.get("stop_time"))  # type: ignore [union-attr]
+    except AttributeError:
+        times = tuple(interval)
+    if any(t is None for t in times):
+        raise ValueError(f"Invalid interval, expected [start_time, stop_time]: {times!r}")
+    return _parse_times(times)
+
+
+def parse_interval_array(
+    intervals: Interval | Iterable[Interval] | npt.ArrayLike,
+) -> npt.NDArray[np.float64]:
+    """Parse one or more intervals as an (n, 2) array of [start_time, stop_time],
+    in the order given.
+
+    >>> parse_interval_array((0, 1))
+    array([[0., 1.]])
+    >>> parse_interval_array([(0, 1), dict(start_time=2, stop_time=3)])
+    array([[0., 1.],
+           [2., 3.]])
+    >>> parse_interval_array(pd.DataFrame(dict(start_time=[0, 2], stop_time=[1, 3])))
+    array([[0., 1.],
+           [2., 3.]])
+    >>> parse_interval_array((1, 0))
+    Traceback (most recent call last):
+    ...
+    ValueError: Invalid interval, expected [start_time, stop_time]: (1.0, 0.0)
+    """
+    if isinstance(intervals, IntervalArray):
+        return intervals.values
+    if isinstance(intervals, np.ndarray) and intervals.ndim == 2 and intervals.shape[1] == 2:
+        values = intervals.astype(np.float64)
+    elif hasattr(intervals, "get"):
+        values = _parse_interval(intervals)
+    else:
+        items = tuple(intervals)  # type: ignore [arg-type]
+        pairs: npt.NDArray[np.float64] | None = None
+        if len(items) == 2 and isinstance(items[0], (int, float, np.number)):
+            pairs = _parse_times(items)
+        elif items and not hasattr(items[0], "get"):
+            # fast path for a sequence of (start_time, stop_time) pairs
+            try:
+                array = np.asarray(items, dtype=np.float64)
+            except (TypeError, ValueError):
+                pass
+            else:
+                if array.ndim == 2 and array.shape[1] == 2:
+                    pairs = array
+        if pairs is not None:
+            values = pairs
+        elif items:
+            values = np.concatenate([_parse_interval(i) for i in items])
+        else:
+            values = np.empty((0, 2), dtype=np.float64)
+    is_invalid = values[:, 0] > values[:, 1]
+    if is_invalid.any():
+        raise ValueError(
+            f"Invalid interval, expected [start_time, stop_time]: {tuple(values[is_invalid][0].tolist())!r}"
+        )
+    return values
+
+
+def _cumulative_max(values: npt.NDArray[np.float64]) -> npt.NDArray[np.float64]:
+    return np.maximum.accumulate(values) if len(values) else values
+
+
+class IntervalArray(Sequence[tuple[float, float]]):
+    """Intervals of [start_time, stop_time] backed by an (n, 2) float array.
+
+    Accepts anything that `Interval` describes: a (start, stop) pair, a mapping
+    or Series with `start_time` and `stop_time`, a DataFrame or hdmf table with
+    those columns, or an iterable of any of these. Intervals are kept in the
+    order given: queries against other intervals return one result per
+    interval, computed with sorting and `np.searchsorted` rather than pairwise
+    comparisons.
+
+    >>> trials = IntervalArray([(0, 1), (1, 2), (5, 6)])
+    >>> invalid = IntervalArray([(0.5, 1.5)])
+    >>> trials.overlaps(invalid)
+    array([ True,  True, False])
+    >>> trials.is_within([(0, 3)])
+    array([ True,  True, False])
+    >>> trials.union()
+    IntervalArray([(0.0, 2.0), (5.0, 6.0)])
+    >>> trials.intersection(invalid)
+    IntervalArray([(0.5, 1.5)])
+    >>> trials.complement(0, 10)
+    IntervalArray([(2.0, 5.0), (6.0, 10.0)])
+    """
+
+    def __init__(self, intervals: Interval | Iterable[Interval] | npt.ArrayLike) -> None:
+        self.values: npt.NDArray[np.float64] = parse_interval_array(intervals)
+        self.values.flags.writeable = False
+
+    @property
+    def starts(self) -> npt.NDArray[np.float64]:
+        return self.values[:, 0]
+
+    @property
+    def stops(self) -> npt.NDArray[np.float64]:
+        return self.values[:, 1]
+
+    @property
+    def durations(self) -> npt.NDArray[np.float64]:
+        return self.stops - self.starts
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    @overload
+    def __getitem__(self, index: int) -> tuple[float, float]: ...
+
+    @overload
+    def __getitem__(self, index: slice | npt.ArrayLike) -> IntervalArray: ...
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            return tuple(self.values[index].tolist())
+        return IntervalArray(self.values[index].reshape(-1, 2))
+
+    def __iter__(self) -> Iterator[tuple[float, float]]:
+        return (tuple(i) for i in self.values.tolist())
+
+    def __array__(
+        self, dtype: npt.DTypeLike | None = None, copy: bool | None = None
+    ) -> npt.NDArray:
+        # `values` is read-only: a copy is writeable
+        values = self.values if dtype is None else self.values.astype(dtype, copy=False)
+        return values.copy() if copy else values
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({list(self)!r})"
+
+    def sorted(self) -> IntervalArray:
+        """Intervals sorted by start time, then stop time"""
+        return IntervalArray(self.values[np.lexsort((self.stops, self.starts))])
+
+    def has_overlap(self) -> bool:
+        """Check if any two intervals overlap (touching intervals don't overlap)"""
+        s = self.sorted()
+        return bool(np.any(s.starts[1:] < _cumulative_max(s.stops)[:-1]))
+
+    def _sorted_by_start(self) -> tuple[npt.NDArray[np.float64], npt.NDArray[np.float64]]:
+        """Start times in ascending order, with the max stop time of all intervals
+        up to and including each one"""
+        order = np.argsort(self.starts, kind="stable")
+        return self.starts[order], _cumulative_max(self.stops[order])
+
+    def overlaps(self, other: Interval | Iterable[Interval]) -> npt.NDArray[np.bool_]:
+        """For each interval, check if it overlaps any of the other intervals
+        (touching intervals don't overlap)"""
+        starts, max_stops = IntervalArray(other)._sorted_by_start()
+        if not len(starts):
+            return np.zeros(len(self), dtype=bool)
+        # other intervals that start before each interval stops
+        count = np.searchsorted(starts, self.stops, side="left")
+        return (count > 0) & (max_stops[np.maximum(count - 1, 0)] > self.starts)
+
+    def is_within(self, other: Interval | Iterable[Interval]) -> npt.NDArray[np.bool_]:
+        """For each interval, check if it's completely within any one of the
+        other intervals"""
+        starts, max_stops = IntervalArray(other)._sorted_by_start()
+        if not len(starts):
+            return np.zeros(len(self), dtype=bool)
+        # other intervals that start at or before each interval starts
+        count = np.searchsorted(starts, self.starts, side="right")
+        return (count > 0) & (max_stops[np.maximum(count - 1, 0)] >= self.stops)
+
+    def union(self, *others: Interval | Iterable[Interval]) -> IntervalArray:
+        """Sorted, non-overlapping intervals covering all intervals: touching
+        intervals are merged"""
+        values = np.concatenate([self.values, *(IntervalArray(o).values for o in others)])
+        s = IntervalArray(values).sorted()
+        if not len(s):
+            return s
+        is_new = np.concatenate([[True], s.starts[1:] > _cumulative_max(s.stops)[:-1]])
+        first = np.flatnonzero(is_new)
+        return IntervalArray(
+            np.column_stack([s.starts[first], np.maximum.reduceat(s.stops, first)])
+        )
+
+    def intersection(self, other: Interval | Iterable[Interval]) -> IntervalArray:
+        """Sorted, non-overlapping intervals covered by both sets of intervals"""
+        a, b = self.union(), IntervalArray(other).union()
+        # range of b intervals that could overlap each a interval
+        first = np.searchsorted(b.stops, a.starts, side="right")
+        stop = np.searchsorted(b.starts, a.stops, side="left")
+        counts = np.maximum(stop - first, 0)
+        a_idx = np.repeat(np.arange(len(a)), counts)
+        b_idx = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(first, counts)
+        values = np.column_stack([
+            np.maximum(a.starts[a_idx], b.starts[b_idx]),
+            np.minimum(a.stops[a_idx], b.stops[b_idx]),
+        ])
+        return IntervalArray(values[values[:, 0] < values[:, 1]])
+
+    def complement(self, start: float | None = None, stop: float | None = None) -> IntervalArray:
+        """Sorted intervals between `start` and `stop` not covered by any interval
+        (default: the span of all intervals)"""
+        u = self.union()
+        if start is None:
+            start = u.starts[0] if len(u) else 0.0
+        if stop is None:
+            stop = u.stops[-1] if len(u) else 0.0
+        values = np.column_stack([
+            np.concatenate([[start], np.clip(u.stops, start, stop)]),
+            np.concatenate([np.clip(u.starts, start, stop), [stop]]),
+        ])
+        return IntervalArray(values[values[:, 0] < values[:, 1]])
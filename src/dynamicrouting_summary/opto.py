@@ -1,55 +1,24 @@
 from __future__ import annotations
 
-import typing
-from collections.abc import Iterable, Mapping, Sequence
-from typing import Literal, Union
+from collections.abc import Iterable, Sequence
+from typing import Union
 
-import hdmf.common
 import numpy as np
 import numpy.typing as npt
 import pandas as pd
-import rich.progress
 from typing_extensions import TypeAlias
 
-Interval: TypeAlias = Union[
-    Sequence[float],
-    Mapping[Literal["start_time", "stop_time"], float],
-    pd.Series,
-    pd.DataFrame,
-]
+import dynamicrouting_summary.instrument as instrument
+from dynamicrouting_summary.intervals import Interval, IntervalArray
+from dynamicrouting_summary.spike_store import SpikeStore, flatten_spike_times
+
 UnitSelection: TypeAlias = Union[int, str, Iterable[int], pd.DataFrame, pd.Series]
 
 
 def parse_intervals(
     intervals: Interval | Iterable[Interval],
 ) -> tuple[tuple[float, float], ...]:
-    intervals = tuple(intervals)
-    is_single_interval = len(intervals) == 2 and isinstance(intervals[0], (int, float))
-    intervals = [intervals] if is_single_interval else intervals
-
-    _intervals: list[tuple[float, float]] = []
-    for i in intervals:
-        times: tuple[float, float]
-        try:
-            times = (i.get("start_time"), i.get("stop_time"))  # type: ignore [union-attr]
-        except AttributeError:
-            times = tuple(i)
-        if all(isinstance(t, hdmf.common.table.VectorData) for t in times):
-            t = typing.cast(
-                tuple[hdmf.common.table.VectorData, hdmf.common.table.VectorData], times
-            )
-            times = (t[0].data, t[1].data)
-        if all(isinstance(t, Iterable) for t in times):
-            t = typing.cast(tuple[Iterable[float], Iterable[float]], times)
-            _intervals.extend(parse_intervals(zip(*t)))
-            continue
-        if None in times or len(times) != 2 or sorted(times) != list(times):
-            raise ValueError(
-                f"Invalid interval, expected [start_time, stop_time]: {times!r}"
-            )
-        else:
-            _intervals.append(times)
-    return tuple(_intervals)
+    return tuple(IntervalArray(intervals))
 
 
 def is_overlap_in_intervals(*intervals: Interval) -> bool:
@@ -70,19 +39,10 @@ def is_overlap_in_intervals(*intervals: Interval) -> bool:
     >>> is_overlap_in_intervals((0, 1), (-0.5, 0.5))
     True
     """
-    _intervals = list(parse_intervals(intervals))
+    _intervals = IntervalArray(intervals)
     if len(_intervals) < 2:
         raise ValueError(f"Expected two or more intervals, got {_intervals!r}")
-    for idx in range(len(_intervals) - 1):
-        i = _intervals.pop(idx)
-        is_overlap = any(
-            (i[0] < other[1] and other[0] < i[1])
-            or (other[0] < i[1] and i[0] < other[1])
-            for other in _intervals
-        )
-        if is_overlap:
-            return True
-    return False
+    return _intervals.has_overlap()
 
 
 def is_within_intervals(interval: Interval, *other_intervals: Interval) -> bool:
@@ -101,22 +61,14 @@ def is_within_intervals(interval: Interval, *other_intervals: Interval) -> bool:
     >>> is_within_intervals((0, 1), (-0.5, 0.5))
     False
     """
-    _intervals = list(parse_intervals([interval, *other_intervals]))
-    interval = _intervals.pop(0)
-    for other in _intervals:
-        is_within = other[0] <= interval[0] and interval[1] <= other[1]
-        if is_within:
-            return True
-    return False
+    _intervals = IntervalArray([interval, *other_intervals])
+    return bool(_intervals[:1].is_within(_intervals[1:])[0])
 
 
 def is_valid_interval(session, interval: Interval) -> bool:
     """Check if time interval is valid, based on `invalid_times`"""
     if session.invalid_times is not None:
-        if any(
-            is_overlap_in_intervals(interval, invalid_interval)
-            for invalid_interval in parse_intervals(session.invalid_times)
-        ):
+        if IntervalArray(interval).overlaps(session.invalid_times).any():
             return False
     return True
 
@@ -172,73 +124,183 @@ def get_spike_counts(
     return counts
 
 
+@numba.njit(nogil=True, parallel=True)
+def get_spike_counts_for_units(
+    spike_times: npt.NDArray[np.floating],
+    offsets: npt.NDArray[np.integer],
+    intervals: npt.NDArray[np.floating],
+) -> npt.NDArray[np.int64]:
+    """Count spikes in each interval for each unit, in parallel over units.
+
+    - `spike_times` and `offsets` are flat spike times for N units, as returned
+      by `spike_store.flatten_spike_times`: each unit's spike times must be sorted
+    - `intervals` is an (M, 2) array of [start_time, stop_time]: intervals can be
+      in any order and may overlap
+    - returns [N units x M intervals] array of counts, including spikes at
+      `start_time` and excluding spikes at `stop_time`
+
+    >>> spike_times, offsets = flatten_spike_times([[0.1, 0.2, 0.3], [0.25]])
+    >>> get_spike_counts_for_units(spike_times, offsets, np.array([[0.2, 0.3], [0.0, 1.0]]))
+    array([[1, 3],
+           [1, 1]])
+    """
+    starts = np.ascontiguousarray(intervals[:, 0])
+    stops = np.ascontiguousarray(intervals[:, 1])
+    n_units = len(offsets) - 1
+    counts = np.zeros((n_units, len(intervals)), dtype=np.int64)
+    for idx in numba.prange(n_units):
+        unit_spike_times = spike_times[offsets[idx] : offsets[idx + 1]]
+        counts[idx] = np.searchsorted(unit_spike_times, stops) - np.searchsorted(
+            unit_spike_times, starts
+        )
+    return counts
+
+
+@numba.njit(nogil=True, parallel=True)
+def get_first_spike_latencies(
+    spike_times: npt.NDArray[np.floating],
+    offsets: npt.NDArray[np.integer],
+    event_times: npt.NDArray[np.floating],
+    min_latency: float,
+    max_latency: float,
+) -> npt.NDArray[np.float64]:
+    """Latency of the first spike after each event, for each unit, in parallel
+    over units.
+
+    - `spike_times` and `offsets` are flat spike times for N units, as returned
+      by `spike_store.flatten_spike_times`: each unit's spike times must be sorted
+    - only spikes from `event_time + min_latency` up to (excluding)
+      `event_time + max_latency` are considered
+    - returns [N units x M events] array of latencies relative to each event
+      time, `np.nan` where a unit has no spike in the window
+
+    >>> spike_times, offsets = flatten_spike_times([[0.1, 1.05, 1.3], []])
+    >>> get_first_spike_latencies(spike_times, offsets, np.array([0.0, 1.0]), 0.01, 0.2)
+    array([[0.1 , 0.05],
+           [ nan,  nan]])
+    """
+    window_starts = event_times + min_latency
+    window_stops = event_times + max_latency
+    n_units = len(offsets) - 1
+    latencies = np.full((n_units, len(event_times)), np.nan)
+    for idx in numba.prange(n_units):
+        unit_spike_times = spike_times[offsets[idx] : offsets[idx + 1]]
+        first = np.searchsorted(unit_spike_times, window_starts)
+        for event_idx in range(len(event_times)):
+            spike_idx = first[event_idx]
+            if (
+                spike_idx < len(unit_spike_times)
+                and unit_spike_times[spike_idx] < window_stops[event_idx]
+            ):
+                latencies[idx, event_idx] = (
+                    unit_spike_times[spike_idx] - event_times[event_idx]
+                )
+    return latencies
+
+
+def get_valid_intervals_mask(
+    session,
+    intervals: Interval | Iterable[Interval],
+    unit_selection: UnitSelection | None = None,
+) -> npt.NDArray[np.bool_]:
+    """Get [units x intervals] bool array: False where an interval overlaps the
+    session's `invalid_times` or isn't completely within the unit's `obs_intervals`.
+
+    - units with the same `obs_intervals` are grouped, so each distinct set of
+      observed intervals is checked against all intervals once
+    """
+    interval_array = IntervalArray(intervals)
+    units = parse_units(session, unit_selection)
+
+    is_valid = np.ones((len(units), len(interval_array)), dtype=bool)
+    if session.invalid_times is not None:
+        is_valid[:, interval_array.overlaps(session.invalid_times)] = False
+    if "obs_intervals" not in units:
+        return is_valid
+
+    unit_idx_by_obs_intervals: dict[bytes, list[int]] = {}
+    obs_intervals_by_key: dict[bytes, IntervalArray] = {}
+    for idx, obs_intervals in enumerate(units["obs_intervals"]):
+        if obs_intervals is None:
+            continue
+        obs_interval_array = IntervalArray(obs_intervals)
+        key = obs_interval_array.values.tobytes()
+        unit_idx_by_obs_intervals.setdefault(key, []).append(idx)
+        obs_intervals_by_key[key] = obs_interval_array
+    for key, unit_idx in unit_idx_by_obs_intervals.items():
+        is_valid[unit_idx] &= interval_array.is_within(obs_intervals_by_key[key])
+    return is_valid
+
+
+@instrument.timed("mask_invalid_intervals")
 def apply_invalid_intervals(
     session,
     intervals: Interval | Iterable[Interval],
     units_by_intervals: npt.NDArray | Iterable[npt.NDArray],
     unit_selection: UnitSelection | None = None,
 ) -> npt.NDArray[np.float64]:
-    _intervals = parse_intervals(intervals)
+    """Set values to `np.nan` for intervals that are invalid or unobserved, for
+    each unit - see `get_valid_intervals_mask`"""
+    interval_array = IntervalArray(intervals)
     units = parse_units(session, unit_selection)
+    instrument.update(units=len(units), rows=len(interval_array))
 
     # convert to float64 to allow NaNs
     units_by_intervals = np.array(units_by_intervals, dtype=np.float64, copy=True)
-    assert units_by_intervals.shape[0:2] == (len(units), len(_intervals))
+    assert units_by_intervals.shape[0:2] == (len(units), len(interval_array))
 
-    is_global_obs_interval = all(
-        i == units.iloc[0].obs_intervals for i in units.obs_intervals.array
-    )
-    # deal with unobserved intervals on a per-unit basis
-    for idx, unit in enumerate(units):
-        if not is_global_obs_interval:
-            units_by_intervals[idx, ...] = np.where(
-                [is_within_intervals(i, *unit.obs_intervals) for i in _intervals],
-                units_by_intervals[idx, ...],
-                np.nan,
-            )
-    # deal with global unobserved intervals (ie same for all units) and global invalid
-    # intervals
-    for idx, interval in enumerate(_intervals):
-        if not is_valid_interval(session, interval) or (
-            is_global_obs_interval
-            and not is_within_intervals(interval, *units.iloc[0].obs_intervals)
-        ):
-            units_by_intervals[:, idx] = np.nan
+    units_by_intervals[
+        ~get_valid_intervals_mask(session, interval_array, units), ...
+    ] = np.nan
     return units_by_intervals
 
 
+def get_flat_spike_times(
+    units: pd.DataFrame,
+    spike_store: SpikeStore | None = None,
+) -> tuple[npt.NDArray[np.float64], npt.NDArray[np.int64]]:
+    """Flat spike times and offsets for units, from `spike_store` if provided,
+    otherwise from the units table - see `spike_store.flatten_spike_times`"""
+    if spike_store is not None:
+        return spike_store.get_flat_spike_times(units.unit_id)
+    return flatten_spike_times(units.spike_times)
+
+
+@instrument.timed("spike_counts")
 def get_spike_counts_in_intervals(
     session,
     intervals: Interval | Iterable[Interval],
     unit_selection: UnitSelection | None = None,
     as_spikes_per_second: bool = False,
+    spike_store: SpikeStore | None = None,
+    flat_spike_times: tuple[npt.NDArray[np.float64], npt.NDArray[np.int64]] | None = None,
 ) -> npt.NDArray[np.floating]:
     """Get spike counts in interval(s) for unit(s).
 
     - returns [units x intervals] array of spike counts (as floats)
     - if no spiking data is available within an interval for a unit, its
       count is `np.nan`
+    - if `spike_store` is provided, spike times are read from it instead of
+      the units table
+    - `flat_spike_times` from `get_flat_spike_times` for the same units can be
+      provided, to reuse them across calls
     """
-    _intervals = parse_intervals(intervals)
+    interval_array = IntervalArray(intervals).values
     units = parse_units(session, unit_selection)
+    instrument.update(units=len(units), rows=len(interval_array))
 
-    _spikes_per_interval_per_unit: list[npt.NDArray[np.floating]] = []
-    for unit in rich.progress.track(
-        units.itertuples(),
-        description="getting spike counts for units",
-        total=len(units),
-    ):
-        spikes_per_interval = get_spike_counts(
-            np.array(unit.spike_times), np.array(_intervals)
-        )
-        if as_spikes_per_second:
-            spikes_per_interval / np.diff(_intervals)
-        _spikes_per_interval_per_unit.append(spikes_per_interval)
+    spike_times, offsets = flat_spike_times or get_flat_spike_times(units, spike_store)
+    spikes_per_interval_per_unit = get_spike_counts_for_units(
+        spike_times, offsets, interval_array
+    )
+    if as_spikes_per_second:
+        spikes_per_interval_per_unit = spikes_per_interval_per_unit / np.diff(
+            interval_array, axis=1
+        ).T
 
-    spikes_per_interval_per_unit = apply_invalid_intervals(
-        session, _intervals, _spikes_per_interval_per_unit, unit_selection
+    return apply_invalid_intervals(
+        session, interval_array, spikes_per_interval_per_unit, units
     )
-    return spikes_per_interval_per_unit
 
 
 def get_response_in_intervals(
@@ -248,17 +310,29 @@ def get_response_in_intervals(
     unit_selection: UnitSelection | None = None,
     as_spikes_per_second: bool = True,
     as_normalized_ratio: bool = False,
+    spike_store: SpikeStore | None = None,
+    flat_spike_times: tuple[npt.NDArray[np.float64], npt.NDArray[np.int64]] | None = None,
 ) -> npt.NDArray[np.floating]:
+    """Get [units x intervals] array of response minus baseline for each pair of
+    response and baseline intervals.
+
+    - spikes in response and baseline intervals are counted together in one pass
+    """
+    response = IntervalArray(response_intervals)
+    baseline = IntervalArray(baseline_intervals)
     if not as_spikes_per_second:
-        assert np.diff(parse_intervals(response_intervals)) == np.diff(
-            parse_intervals(baseline_intervals)
+        assert np.allclose(
+            response.durations, baseline.durations
         ), "response and baseline intervals must have same duration to express response as spike counts"
-    _response = get_spike_counts_in_intervals(
-        session, response_intervals, unit_selection, as_spikes_per_second
-    )
-    _baseline = get_spike_counts_in_intervals(
-        session, baseline_intervals, unit_selection, as_spikes_per_second
+    counts = get_spike_counts_in_intervals(
+        session,
+        np.concatenate([response.values, baseline.values]),
+        unit_selection,
+        as_spikes_per_second,
+        spike_store,
+        flat_spike_times,
     )
+    _response, _baseline = counts[:, : len(response)], counts[:, len(response) :]
 
     output = _response - _baseline
     if as_normalized_ratio:
@@ -268,6 +342,49 @@ def get_response_in_intervals(
     return output
 
 
+def get_response_by_condition(
+    session,
+    trials: pd.DataFrame,
+    by: str | Sequence[str],
+    response_intervals: Interval | Iterable[Interval],
+    baseline_intervals: Interval | Iterable[Interval],
+    unit_selection: UnitSelection | None = None,
+    as_spikes_per_second: bool = True,
+    as_normalized_ratio: bool = False,
+    spike_store: SpikeStore | None = None,
+) -> pd.DataFrame:
+    """Get mean response of each unit to trials grouped by condition.
+
+    - `response_intervals` and `baseline_intervals` have one interval per row
+      of `trials`, in the same order
+    - responses for all trials are computed once, then averaged within each
+      group of trials with the same values in `by` columns (ignoring NaN)
+    - returns [units x conditions] dataframe indexed by `unit_id`, with a
+      column for each condition
+    """
+    units = parse_units(session, unit_selection)
+    responses = get_response_in_intervals(
+        session,
+        response_intervals,
+        baseline_intervals,
+        unit_selection=units,
+        as_spikes_per_second=as_spikes_per_second,
+        as_normalized_ratio=as_normalized_ratio,
+        spike_store=spike_store,
+    )
+    assert responses.shape[1] == len(trials), "expected one interval per trial"
+    keys = [by] if isinstance(by, str) else list(by)
+    by_condition = (
+        pd.DataFrame(responses.T)
+        .groupby([trials[key].to_numpy() for key in keys])
+        .mean()
+        .T
+    )
+    by_condition.columns.names = keys
+    by_condition.index = pd.Index(units.unit_id, name="unit_id")
+    return by_condition
+
+
 VIS_MIN_RESP_LATENCY = 0.025
 AUD_MIN_RESP_LATENCY = 0.01
 OPTO_MIN_RESP_LATENCY = 0.01
@@ -277,11 +394,94 @@ AUD_RESP_WINDOW = 0.2
 OPTO_RESP_WINDOW = 0.1
 
 
+def add_response_latency_metrics(
+    session,
+    name: str,
+    event_times: npt.ArrayLike,
+    baseline_intervals: Interval | Iterable[Interval],
+    min_latency: float,
+    window: float,
+    description: str,
+    unit_selection: UnitSelection | None = None,
+    spike_store: SpikeStore | None = None,
+) -> None:
+    """Adds `{name}_response`, `{name}_latency` and `{name}_latency_jitter`
+    metrics to `session.units`.
+
+    - response is the mean change in firing rate from baseline, in the window
+      `[event_time + min_latency, event_time + min_latency + window)`
+    - latency is the median time from each event to the first spike in the
+      same window, and jitter is its standard deviation across events
+    - events in invalid or unobserved intervals are ignored for each unit
+    - with `unit_selection`, metrics are added for the selected units and are
+      `np.nan` for other units
+    """
+    event_times = np.asarray(event_times, dtype=np.float64)
+    units = parse_units(session, unit_selection)
+    # flattened once, for counts and latencies
+    flat_spike_times = get_flat_spike_times(units, spike_store)
+    response_intervals = np.column_stack(
+        [event_times + min_latency, event_times + min_latency + window]
+    )
+    responses = get_response_in_intervals(
+        session,
+        response_intervals,
+        baseline_intervals,
+        unit_selection=units,
+        as_spikes_per_second=True,
+        as_normalized_ratio=False,
+        flat_spike_times=flat_spike_times,
+    )
+    with instrument.stage("first_spike_latencies", units=len(units), rows=len(event_times)):
+        latencies = get_first_spike_latencies(
+            *flat_spike_times, event_times, min_latency, min_latency + window
+        )
+    latencies = apply_invalid_intervals(session, response_intervals, latencies, units)
+
+    # one value per unit in the session, aligned on unit_id
+    all_unit_ids = session.units[:].unit_id.to_numpy()
+
+    def align(values: npt.NDArray[np.float64]) -> npt.NDArray[np.float64]:
+        return pd.Series(values, index=units.unit_id.to_numpy()).reindex(all_unit_ids).to_numpy()
+
+    session.units.add_column(
+        name=f"{name}_response",
+        description=f"mean change in firing rate in response to {description}",
+        data=align(np.nanmean(responses, axis=1)),
+    )
+    session.units.add_column(
+        name=f"{name}_latency",
+        description=f"median latency of first spike in response to {description}",
+        data=align(np.nanmedian(latencies, axis=1)),
+    )
+    session.units.add_column(
+        name=f"{name}_latency_jitter",
+        description=f"standard deviation of latency of first spike in response to {description}",
+        data=align(np.nanstd(latencies, axis=1)),
+    )
+
+
 def add_opto_response_metric(session) -> None:
-    """Adds `opto_response` metric to `session.units`"""
+    """Adds `opto_response`, `opto_latency` and `opto_latency_jitter` metrics to
+    `session.units`"""
     trials = session.intervals.get("OptoTagging")
     if trials is None:
         return
+    trials = trials.to_dataframe()
+    add_response_latency_metrics(
+        session,
+        name="opto",
+        event_times=trials.start_time,
+        # no pre-stim period in opto-tagging trials: use a window of the same
+        # duration immediately before laser onset
+        baseline_intervals=zip(
+            trials.start_time - OPTO_RESP_WINDOW, trials.start_time
+        ),
+        min_latency=OPTO_MIN_RESP_LATENCY,
+        window=OPTO_RESP_WINDOW,
+        description="optotagging laser stimulus",
+        unit_selection=session.units[:],  # slight speed-up by creating df only once
+    )
 
 
 def add_vis_response_metric(session) -> None:
@@ -289,56 +489,45 @@ def add_vis_response_metric(session) -> None:
     trials = session.intervals["VisRFMapping"].to_dataframe()
     if trials is None:
         return
-    units = session.units[:]  # slight speed-up by creating df only once
-    get_response_in_intervals(
+    trials = trials.query("is_small_field_grating")
+    # mean response for each unit to each stim location
+    responses = get_response_by_condition(
         session,
+        trials,
+        by=["grating_x", "grating_y"],
         response_intervals=zip(
-            (start := trials.stim_start_time[:] + VIS_MIN_RESP_LATENCY),
+            (start := trials.stim_start_time + VIS_MIN_RESP_LATENCY),
             start + VIS_RESP_WINDOW,
         ),
-        baseline_intervals=zip(trials.start_time[:], trials.stim_start_time[:]),
+        baseline_intervals=zip(trials.start_time, trials.stim_start_time),
         as_spikes_per_second=True,
         as_normalized_ratio=False,
-        unit_selection=units,
+        unit_selection=session.units[:],  # slight speed-up by creating df only once
     )
-    trials = trials.query("is_small_field_grating")
-    stim_by_unit_responses = []
-    for grating_x in trials.grating_x.unique():
-        for grating_y in trials.grating_y.unique():
-            t = trials.query(f"grating_x == {grating_x} and grating_y == {grating_y}")
-            if len(t) == 0:
-                continue
-            # get mean response for each unit to this stim location
-            stim_by_unit_responses.append(
-                np.nanmean(
-                    get_response_in_intervals(
-                        session,
-                        response_intervals=zip(
-                            (start := t.stim_start_time[:] + VIS_MIN_RESP_LATENCY),
-                            start + VIS_RESP_WINDOW,
-                        ),
-                        baseline_intervals=zip(t.start_time[:], t.stim_start_time[:]),
-                        as_spikes_per_second=True,
-                        as_normalized_ratio=False,
-                        unit_selection=session.units[
-                            :
-                        ],  # slight speed-up by creating df only once
-                    ),
-                    axis=1,
-                )
-            )
     session.units.add_column(
         name="vis_response",
         description="mean change in firing rate in response to small-field grating stimulus at most responsive location on screen",
-        data=np.nanmax(stim_by_unit_responses, axis=0),
+        data=np.nanmax(responses.to_numpy(), axis=1),
     )
 
 
 def add_aud_response_metric(session) -> None:
-    """Adds `aud_response` metric to `session.units`"""
-    trials = session.intervals["AudRFMapping"]
+    """Adds `aud_response`, `aud_latency` and `aud_latency_jitter` metrics to
+    `session.units`"""
+    trials = session.intervals.get("AudRFMapping")
     if trials is None:
         return
+    trials = trials.to_dataframe()
+    add_response_latency_metrics(
+        session,
+        name="aud",
+        event_times=trials.stim_start_time,
+        baseline_intervals=zip(trials.start_time, trials.stim_start_time),
+        min_latency=AUD_MIN_RESP_LATENCY,
+        window=AUD_RESP_WINDOW,
+        description="auditory receptive field mapping stimulus",
+        unit_selection=session.units[:],  # slight speed-up by creating df only once
+    )
 
 
 if __name__ == "__main__":
@@ -1,49 +1,59 @@
+import concurrent.futures
+import logging
+import multiprocessing
 import os
+import time
 
+import matplotlib
 import matplotlib.pyplot as plt
-import npc_lims
 import numpy as np
 import pandas as pd
-import pyarrow.dataset as ds
 from matplotlib import patches
 
-from dynamicrouting_summary import spike_utils
+from dynamicrouting_summary import spike_utils, storage, unit_index, utils
 
+logger = logging.getLogger(__name__)
 
-def plot_unit_by_id(sel_unit, spike_times_unit, save_path=None,show_metric=None) -> plt.Figure:
-    print('Selected unit', sel_unit)
-    unit_df = ds.dataset(npc_lims.get_cache_path('units', version='any')).to_table(filter=(ds.field('unit_id') == sel_unit)).to_pandas()
-    session_id=str(unit_df['subject_id'].values[0])+'_'+str(unit_df['date'].values[0])
+CONTEXT_MODULATION_STIMS = ('vis1','vis2','sound1','sound2')
+CONTEXT_MODULATION_TRIALS_COLUMNS = ['stim_start_time','stim_name','is_vis_context','is_aud_context']
+CONTEXT_MODULATION_TIME_BEFORE = 0.5
+CONTEXT_MODULATION_TIME_AFTER = 1.0
+CONTEXT_MODULATION_BINSIZE = 0.025
+
+
+def get_context_mean_psths(trial_da, trials):
+    #trial_da: tensor of shape (units, time, trials) from spike_utils.make_neuron_time_trials_tensor
+    #trials: trials used to make the tensor, in the same order
+    #returns: {stim: (vis context mean PSTH, aud context mean PSTH)}, arrays of shape (units, time)
+    values = trial_da.values
+    stim_name = trials['stim_name'].to_numpy()
+    psths = {}
+    for stim in CONTEXT_MODULATION_STIMS:
+        context_psths = []
+        for context in ('is_vis_context', 'is_aud_context'):
+            idx = np.flatnonzero((stim_name == stim) & trials[context].to_numpy())
+            if len(idx):
+                context_psths.append(values[:, :, idx].mean(axis=2))
+            else:
+                context_psths.append(np.full(values.shape[:2], np.nan))
+        psths[stim] = tuple(context_psths)
+    return psths
 
-    trials=pd.read_parquet(
-                npc_lims.get_cache_path('trials',session_id, version='any')
-            )
 
-    time_before = 0.5
-    time_after = 1.0
-    binsize = 0.025
-    trial_da = spike_utils.make_neuron_time_trials_tensor(unit_df, spike_times_unit, trials, time_before, time_after, binsize)
+def create_context_modulation_figure():
+    #returns: figure, axes and {stim: (vis context line, aud context line)}, to be filled in
+    #         for each unit with update_context_modulation_figure
 
     ##plot PSTH with context differences -- subplot for each stimulus
     fig,ax=plt.subplots(2,2,sharex=True,sharey=True)
     ax=ax.flatten()
 
-    stims=['vis1','vis2','sound1','sound2']
-
-    for st,stim in enumerate(stims):
-
-        stim_trials=trials[:].query('stim_name==@stim')
-
-        vis_context_spikes=trial_da.sel(
-            trials=stim_trials.query('is_vis_context').index,
-            unit_id=sel_unit,).mean(dim=['trials'])
+    lines={}
+    for st,stim in enumerate(CONTEXT_MODULATION_STIMS):
 
-        aud_context_spikes=trial_da.sel(
-            trials=stim_trials.query('is_aud_context').index,
-            unit_id=sel_unit,).mean(dim=['trials'])
-
-        ax[st].plot(vis_context_spikes.time, vis_context_spikes.values, label='vis context',color='tab:green')
-        ax[st].plot(aud_context_spikes.time, aud_context_spikes.values, label='aud context',color='tab:blue')
+        vis_line,=ax[st].plot([], [], label='vis context',color='tab:green')
+        aud_line,=ax[st].plot([], [], label='aud context',color='tab:blue')
+        lines[stim]=(vis_line,aud_line)
         ax[st].axvline(0, color='k', linestyle='--',alpha=0.5)
         ax[st].axvline(0.5, color='k', linestyle='--',alpha=0.5)
         ax[st].set_title(stim)
@@ -55,19 +65,156 @@ def plot_unit_by_id(sel_unit, spike_times_unit, save_path=None,show_metric=None)
         if st==0 or st==2:
             ax[st].set_ylabel('spikes/s')
 
+    # reserve space for the title before laying out
+    fig.suptitle(' ')
+    fig.tight_layout()
+
+    return fig, ax, lines
+
+
+def update_context_modulation_figure(fig, ax, lines, time, psths, title):
+    #time: bin centers of PSTHs
+    #psths: {stim: (vis context mean PSTH, aud context mean PSTH)} for one unit
+    #title: figure title
+    for stim,(vis_line,aud_line) in lines.items():
+        vis_line.set_data(time, psths[stim][0])
+        aud_line.set_data(time, psths[stim][1])
+    for a in ax:
+        a.relim()
+        a.autoscale_view(scalex=False)
+    fig.suptitle(title)
+
+
+def get_context_modulation_path(save_path, unit_id):
+    return os.path.join(save_path,unit_id+'_context_modulation.png')
+
+
+def save_context_modulation_figure(fig, save_path, unit_id, dpi=300):
+    fig.savefig(get_context_modulation_path(save_path, unit_id),
+                dpi=dpi, facecolor='w', edgecolor='w',
+                orientation='portrait', format='png',
+                transparent=True, bbox_inches='tight', pad_inches=0.1,
+                metadata=None)
+
+
+def _get_context_modulation_title(unit_id, structure, show_metric=None):
     if show_metric is not None:
-        fig.suptitle('unit '+unit_df['unit_id'].values[0]+'; '+unit_df['structure'].values[0]+'; '+show_metric)
-    else:
-        fig.suptitle('unit '+unit_df['unit_id'].values[0]+'; '+unit_df['structure'].values[0])
+        return 'unit '+unit_id+'; '+structure+'; '+show_metric
+    return 'unit '+unit_id+'; '+structure
 
-    fig.tight_layout()
+
+def _read_context_modulation_trials(session_id, version=None):
+    return pd.read_parquet(
+                storage.get_cache_path('trials',session_id, version=utils.get_cache_version(version)),
+                columns=CONTEXT_MODULATION_TRIALS_COLUMNS,
+            )
+
+
+def plot_unit_by_id(sel_unit, spike_times_unit=None, save_path=None,show_metric=None,version=None) -> plt.Figure:
+    print('Selected unit', sel_unit)
+    # read only this unit's row group, via the unit index (see `unit_index.get_units`)
+    unit_columns=['unit_id','structure'] if spike_times_unit is not None else ['unit_id','structure','spike_times']
+    unit_df = unit_index.get_units(sel_unit, columns=unit_columns, version=version)
+    session_id=unit_df['session_id'].values[0]
+    if spike_times_unit is None:
+        spike_times_unit=unit_df['spike_times'].values[0]
+
+    trials=_read_context_modulation_trials(session_id, version)
+
+    trial_da = spike_utils.make_neuron_time_trials_tensor(
+        unit_df, [spike_times_unit], trials,
+        CONTEXT_MODULATION_TIME_BEFORE, CONTEXT_MODULATION_TIME_AFTER, CONTEXT_MODULATION_BINSIZE,
+    )
+    psths = get_context_mean_psths(trial_da, trials)
+
+    fig, ax, lines = create_context_modulation_figure()
+    update_context_modulation_figure(
+        fig, ax, lines, trial_da.time.values,
+        {stim: (vis[0], aud[0]) for stim, (vis, aud) in psths.items()},
+        _get_context_modulation_title(unit_df['unit_id'].values[0], unit_df['structure'].values[0], show_metric),
+    )
 
     if save_path is not None:
-        fig.savefig(os.path.join(save_path,unit_df['unit_id'].values[0]+'_context_modulation.png'),
-                    dpi=300, facecolor='w', edgecolor='w',
-                    orientation='portrait', format='png',
-                    transparent=True, bbox_inches='tight', pad_inches=0.1,
-                    metadata=None)
+        save_context_modulation_figure(fig, save_path, unit_df['unit_id'].values[0])
         plt.close()
-    
+
     return fig
+
+
+_render_worker_figure = None
+
+
+def _init_render_worker():
+    matplotlib.use('Agg')
+
+
+def _render_context_modulation_figures(time, units, save_path, dpi):
+    #units: list of (unit_id, title, psths) to render with one figure, reused for all units
+    #       in this worker process
+    global _render_worker_figure
+    if _render_worker_figure is None:
+        _render_worker_figure = create_context_modulation_figure()
+    fig, ax, lines = _render_worker_figure
+    for unit_id, title, psths in units:
+        update_context_modulation_figure(fig, ax, lines, time, psths, title)
+        save_context_modulation_figure(fig, save_path, unit_id, dpi)
+    return len(units)
+
+
+def render_units_context_modulation(unit_ids, save_path, show_metric=None, version=None, max_workers=None, units_per_task=32, overwrite=False, dpi=300):
+    #unit_ids: units to render figures for, as in plot_unit_by_id
+    #save_path: directory for figures
+    #show_metric: optional {unit_id: text} to add to each figure's title
+    #max_workers: number of rendering processes (default: number of CPUs)
+    #units_per_task: number of figures rendered per task sent to a worker process
+    #overwrite: re-render figures that already exist in save_path
+    #returns: {'rendered', 'skipped', 'seconds', 'figures_per_second'}
+    #
+    #units are grouped by session, so each session's trials and spike times are read once and
+    #PSTHs for all its units are made in one call; rendering happens in worker processes while
+    #the next session is loaded
+    t0 = time.perf_counter()
+    os.makedirs(save_path, exist_ok=True)
+    unit_ids = list(dict.fromkeys(unit_ids))
+    pending = [u for u in unit_ids if overwrite or not os.path.exists(get_context_modulation_path(save_path, u))]
+    skipped = len(unit_ids) - len(pending)
+
+    version = utils.get_cache_version(version)
+    index = unit_index.get_unit_index(version)
+    if missing := [u for u in pending if u not in index.index]:
+        raise KeyError(f"Units not found in units cache {version=}: {missing}")
+    session_files = index.loc[pending, 'file'].astype(str)
+
+    rendered = 0
+    # spawn: worker processes must not inherit numba thread pools via fork
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'), initializer=_init_render_worker,
+    ) as executor:
+        futures = []
+        for _, session_unit_ids in session_files.groupby(session_files, sort=False):
+            units = unit_index.get_units(session_unit_ids.index, columns=['unit_id','structure','spike_times'], version=version)
+            trials = _read_context_modulation_trials(units['session_id'].values[0], version)
+            trial_da = spike_utils.make_neuron_time_trials_tensor(
+                units, None, trials,
+                CONTEXT_MODULATION_TIME_BEFORE, CONTEXT_MODULATION_TIME_AFTER, CONTEXT_MODULATION_BINSIZE,
+            )
+            psths = get_context_mean_psths(trial_da, trials)
+            tasks = [
+                (
+                    unit_id,
+                    _get_context_modulation_title(unit_id, structure, show_metric.get(unit_id) if show_metric else None),
+                    {stim: (vis[idx], aud[idx]) for stim, (vis, aud) in psths.items()},
+                )
+                for idx, (unit_id, structure) in enumerate(zip(units['unit_id'], units['structure']))
+            ]
+            for start in range(0, len(tasks), units_per_task):
+                futures.append(executor.submit(
+                    _render_context_modulation_figures, trial_da.time.values, tasks[start:start+units_per_task], save_path, dpi,
+                ))
+        for future in concurrent.futures.as_completed(futures):
+            rendered += future.result()
+
+    seconds = time.perf_counter() - t0
+    figures_per_second = rendered / seconds if seconds else 0.0
+    logger.info(f'Rendered {rendered} figures in {seconds:.1f} s ({figures_per_second:.1f} figures/s), skipped {skipped} existing')
+    return dict(rendered=rendered, skipped=skipped, seconds=seconds, figures_per_second=figures_per_second)
@@ -0,0 +1,151 @@
+from __future__ import annotations
+
+import collections.abc
+import pathlib
+from collections.abc import Iterable, Iterator
+
+import numpy as np
+import numpy.typing as npt
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+import dynamicrouting_summary.storage as storage
+
+SPIKE_TIMES_FILENAME = "spike_times.f8"
+OFFSETS_FILENAME = "offsets.npy"
+UNIT_IDS_FILENAME = "unit_ids.npy"
+
+
+def flatten_spike_times(
+    spike_times: Iterable[npt.ArrayLike],
+) -> tuple[npt.NDArray[np.float64], npt.NDArray[np.int64]]:
+    """Concatenate per-unit spike times into one flat array plus offsets.
+
+    Spike times for unit `i` are `flat[offsets[i]:offsets[i + 1]]`.
+
+    >>> flat, offsets = flatten_spike_times([[0.1, 0.2], [], [0.3]])
+    >>> flat
+    array([0.1, 0.2, 0.3])
+    >>> offsets
+    array([0, 2, 2, 3])
+    """
+    arrays = [np.asarray(s, dtype=np.float64).ravel() for s in spike_times]
+    offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+    np.cumsum([len(a) for a in arrays], out=offsets[1:])
+    flat = np.concatenate(arrays) if arrays else np.empty(0, dtype=np.float64)
+    return flat, offsets
+
+
+def write_spike_store(
+    path: str | pathlib.Path,
+    source: str | pathlib.Path | ds.Dataset | None = None,
+    version: str | None = None,
+    batch_size: int = 64,
+) -> SpikeStore:
+    """Write spike times for all units to a flat on-disk store and open it.
+
+    `source` defaults to the units cache for `version`: any parquet file,
+    directory or dataset with `unit_id` and `spike_times` columns can be used
+    instead. Units are streamed in record batches, so memory use is bounded by
+    `batch_size` units, not the size of the dataset.
+
+    >>> import tempfile
+    >>> import pandas as pd
+    >>> tmp = tempfile.mkdtemp()
+    >>> pd.DataFrame({'unit_id': ['a', 'b'], 'spike_times': [[0.1, 0.2], [0.3]]}).to_parquet(f'{tmp}/units.parquet')
+    >>> store = write_spike_store(f'{tmp}/store', source=f'{tmp}/units.parquet')
+    >>> store['a'].tolist()
+    [0.1, 0.2]
+    >>> len(SpikeStore(f'{tmp}/store'))
+    2
+    """
+    path = pathlib.Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    dataset: ds.Dataset
+    if isinstance(source, ds.Dataset):
+        dataset = source
+    else:
+        # per-session units files: the consolidated table has no spike times
+        dataset = ds.dataset(
+            source or storage.get_cache_path("units", version=version, consolidated=False)
+        )
+    unit_ids: list[str] = []
+    lengths: list[npt.NDArray[np.int64]] = []
+    with open(path / SPIKE_TIMES_FILENAME, "wb") as f:
+        for batch in dataset.to_batches(
+            columns=["unit_id", "spike_times"], batch_size=batch_size
+        ):
+            spike_times = batch.column("spike_times")
+            values = spike_times.flatten().to_numpy(zero_copy_only=False)
+            f.write(values.astype("<f8", copy=False).tobytes())
+            lengths.append(
+                pc.list_value_length(spike_times)
+                .fill_null(0)
+                .to_numpy(zero_copy_only=False)
+            )
+            unit_ids.extend(batch.column("unit_id").to_pylist())
+    offsets = np.zeros(len(unit_ids) + 1, dtype=np.int64)
+    if lengths:
+        np.cumsum(np.concatenate(lengths), out=offsets[1:])
+    # written last: an interrupted write leaves no offsets file and can't be opened
+    np.save(path / UNIT_IDS_FILENAME, np.array(unit_ids, dtype=str))
+    np.save(path / OFFSETS_FILENAME, offsets)
+    return SpikeStore(path)
+
+
+class SpikeStore(collections.abc.Mapping[str, npt.NDArray[np.float64]]):
+    """Read-only mapping of unit_id to spike times, from `write_spike_store`.
+
+    Spike times for all units are stored back-to-back in one memory-mapped
+    float64 array: indexing a unit returns a view, without copying or reading
+    any other unit's spikes from disk.
+    """
+
+    def __init__(self, path: str | pathlib.Path) -> None:
+        self.path = pathlib.Path(path)
+        self.offsets: npt.NDArray[np.int64] = np.load(self.path / OFFSETS_FILENAME)
+        self.unit_ids: npt.NDArray[np.str_] = np.load(self.path / UNIT_IDS_FILENAME)
+        self.spike_times: npt.NDArray[np.float64]
+        if self.offsets[-1] == 0:
+            # empty files can't be memory-mapped
+            self.spike_times = np.empty(0, dtype=np.float64)
+        else:
+            self.spike_times = np.memmap(
+                self.path / SPIKE_TIMES_FILENAME,
+                dtype="<f8",
+                mode="r",
+                shape=(int(self.offsets[-1]),),
+            )
+        self._index = {
+            unit_id: idx for idx, unit_id in enumerate(self.unit_ids.tolist())
+        }
+
+    def __getitem__(self, unit_id: str) -> npt.NDArray[np.float64]:
+        idx = self._index[unit_id]
+        return self.spike_times[self.offsets[idx] : self.offsets[idx + 1]]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._index)
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}(path={str(self.path)!r}, units={len(self)})"
+
+    def get_indices(self, unit_ids: Iterable[str]) -> npt.NDArray[np.intp]:
+        """Row index of each unit in the store"""
+        return np.array([self._index[unit_id] for unit_id in unit_ids], dtype=np.intp)
+
+    def get_flat_spike_times(
+        self, unit_ids: Iterable[str] | None = None
+    ) -> tuple[npt.NDArray[np.float64], npt.NDArray[np.int64]]:
+        """Flat spike times and offsets for units, in the format of
+        `flatten_spike_times`.
+
+        - with no `unit_ids`, the memory-mapped arrays for all units are returned
+          without copying
+        """
+        if unit_ids is None:
+            return self.spike_times, self.offsets
+        return flatten_spike_times(self[unit_id] for unit_id in unit_ids)
@@ -1,9 +1,18 @@
+import logging
+import typing
+
 import matplotlib.pyplot as plt
-import npc_lims
+import numba
 import numpy as np
 import pandas as pd
 import xarray as xr
 
+import dynamicrouting_summary.storage as cache_storage
+from dynamicrouting_summary import instrument
+from dynamicrouting_summary.spike_store import SpikeStore, flatten_spike_times
+
+logger = logging.getLogger(__name__)
+
 #functions for making 3d trial-aligned tensor
 
 def makePSTH(spike_times, event_times, time_before, time_after, bin_size):
@@ -29,136 +38,364 @@ def makePSTH(spike_times, event_times, time_before, time_after, bin_size):
     return np.vstack(event_aligned_spikes).T, bin_centers
 
 
-def make_neuron_time_trials_tensor(units, spike_times_all, trials, time_before, time_after, bin_size, event_name='stim_start_time'):
+@numba.njit(nogil=True, parallel=True)
+def _get_event_aligned_spike_counts(spike_times, offsets, event_times, time_before, time_after, bin_edges):
+
+    #spike_times, offsets: flat spike times for all units (see spike_store.flatten_spike_times)
+    #event_times: times of events to align to
+    #bin_edges: edges of bins relative to event time
+    #returns: event-aligned spike counts (units x time x trials), binned as in makePSTH
+
+    n_units = len(offsets) - 1
+    n_bins = len(bin_edges) - 1
+    counts = np.zeros((n_units, n_bins, len(event_times)), dtype=np.int64)
+    for uu in numba.prange(n_units):
+        unit_spike_times = spike_times[offsets[uu]:offsets[uu + 1]]
+        first_spikes = np.searchsorted(unit_spike_times, event_times - time_before)
+        stop_spikes = np.searchsorted(unit_spike_times, event_times + time_after)
+        for tt in range(len(event_times)):
+            for ss in range(first_spikes[tt], stop_spikes[tt]):
+                spike_time = unit_spike_times[ss] - event_times[tt]
+                # same edges as np.histogram: last bin includes its right edge
+                if spike_time == bin_edges[-1]:
+                    bb = n_bins - 1
+                else:
+                    bb = np.searchsorted(bin_edges, spike_time, side='right') - 1
+                if 0 <= bb < n_bins:
+                    counts[uu, bb, tt] += 1
+    return counts
+
+
+def _get_unit_chunk(spike_times, offsets, start, stop):
+
+    #spike_times, offsets: flat spike times for all units (see spike_store.flatten_spike_times)
+    #start, stop: range of units to select
+    #returns: flat spike times, offsets for units[start:stop], without copying
+
+    chunk_offsets = offsets[start:stop + 1]
+    return spike_times[chunk_offsets[0]:chunk_offsets[-1]], chunk_offsets - chunk_offsets[0]
+
+
+def _to_zarr_in_unit_chunks(make_chunk, unit_count, unit_chunk_size, zarr_path, name, chunks=None):
+
+    #make_chunk: function taking (start, stop) unit indices, returning a DataArray for those units
+    #unit_count: total number of units
+    #unit_chunk_size: number of units to compute and write at a time
+    #zarr_path: path to write zarr store (overwritten)
+    #name: name of data variable in zarr store
+    #chunks: optional zarr chunk sizes for dims other than unit_id (default: whole dim)
+    #returns: DataArray lazily loaded from zarr_path, backed by dask with one chunk per unit chunk
+
+    for start in range(0, max(unit_count, 1), unit_chunk_size):
+        da = make_chunk(start, min(start + unit_chunk_size, unit_count))
+        dataset = da.to_dataset(name=name)
+        if start == 0:
+            encoding_chunks = tuple(
+                unit_chunk_size if dim == 'unit_id' else min((chunks or {}).get(dim, size), size) or 1
+                for dim, size in da.sizes.items()
+            )
+            dataset.to_zarr(zarr_path, mode='w', encoding={name: {'chunks': encoding_chunks}})
+        else:
+            dataset.to_zarr(zarr_path, append_dim='unit_id')
+    return xr.open_dataarray(zarr_path, engine='zarr', chunks={})
+
+
+@instrument.timed('trials_tensor')
+def make_neuron_time_trials_tensor(units, spike_times_all, trials, time_before, time_after, bin_size, event_name='stim_start_time', zarr_path=None, unit_chunk_size=100):
     
     #units: units to include in tensor
+    #spike_times_all: spike times for each unit, in the same order as units (list of arrays, or a SpikeStore);
+    #                 if None, units['spike_times'] is used
     #trials: trials to include in tensor
     #time_before: time before event to include in PSTH
     #time_after: time after event to include in PSTH
     #bin_size: size of each bin in seconds
     #event_name: optional input to specify column to use to align events
+    #zarr_path: optional path to write tensor to a zarr store in chunks of unit_chunk_size units,
+    #           returning a lazily-loaded dask-backed DataArray instead of building it in memory
     #returns: 3d tensor of shape (units, time, trials)
-    unit_count = len(units[:])
-    trial_count = len(trials[:])
-    bins = np.arange(-time_before, time_after, bin_size)
+    unit_ids = units[:]['unit_id'].values
+    if spike_times_all is None:
+        spike_times, offsets = flatten_spike_times(units[:]['spike_times'])
+    elif isinstance(spike_times_all, SpikeStore):
+        spike_times, offsets = spike_times_all.get_flat_spike_times(unit_ids)
+    else:
+        spike_times, offsets = flatten_spike_times(spike_times_all)
 
-    tensor = np.zeros((unit_count, len(bins)-1, trial_count))
+    bins = np.arange(-time_before, time_after, bin_size)
+    bin_centers = (bins[:-1] + bins[1:])/2
+    event_times = trials[:][event_name].to_numpy(dtype=np.float64)
+    instrument.update(units=len(unit_ids), rows=len(event_times))
 
-    for uu, (_, unit) in enumerate(units[:].iterrows()):
-        spike_times = spike_times_all[uu]
-        event_times = trials[:][event_name]
-        event_aligned_spikes, bin_centers = makePSTH(spike_times_all, event_times, time_before, time_after, bin_size)
-        tensor[uu,:,:] = event_aligned_spikes/bin_size
+    def make_chunk(start, stop):
+        tensor = _get_event_aligned_spike_counts(
+            *_get_unit_chunk(spike_times, offsets, start, stop),
+            event_times, time_before, time_after, bins,
+        )/bin_size
 
-    trial_da = xr.DataArray(tensor, dims=("unit_id", "time", "trials"), 
+        return xr.DataArray(tensor, dims=("unit_id", "time", "trials"), 
                             coords={
-                                "unit_id": units[:]['unit_id'].values,
+                                "unit_id": unit_ids[start:stop],
                                 "time": bin_centers,
                                 "trials": trials[:].index.values
                                 })
 
+    if zarr_path is not None:
+        return _to_zarr_in_unit_chunks(make_chunk, len(unit_ids), unit_chunk_size, zarr_path, 'spikes_per_second')
+
+    trial_da = make_chunk(0, len(unit_ids))
+
     return trial_da
 
 
-def make_timebins_table(trials, bin_size):
+TIMEBIN_FLAGS = (
+    'stim_start',
+    'stim_stop',
+    'reward',
+    'is_vis_context',
+    'is_aud_context',
+    'is_vis_stim',
+    'is_aud_stim',
+    'is_vis_target',
+    'is_aud_target',
+    'is_catch',
+    'is_vis_nontarget',
+    'is_aud_nontarget',
+    'is_context_switch',
+)
+
+
+def _mark_event_bins(bin_starts, event_times, bin_size):
+    
+    #bin_starts: sorted start times of bins
+    #event_times: times of events
+    #returns: bool array, True for bins with bin_start in [event_time, event_time + bin_size)
+
+    event_times = np.asarray(event_times, dtype=np.float64)
+    first = np.searchsorted(bin_starts, event_times, side='left')
+    stop = np.searchsorted(bin_starts, event_times + bin_size, side='left')
+    # +1 at the first bin of each event, -1 after its last bin (usually the next bin)
+    edges = np.zeros(len(bin_starts) + 1, dtype=np.int64)
+    np.add.at(edges, first, 1)
+    np.add.at(edges, np.maximum(first, stop), -1)
+    return np.cumsum(edges[:-1]) > 0
+
+
+def pack_timebin_flags(timebins_table):
+
+    #timebins_table: table from make_timebins_table with a bool column for each of TIMEBIN_FLAGS
+    #returns: table with bool columns replaced by a single uint16 'flags' column (bit i = TIMEBIN_FLAGS[i])
+
+    flags = np.zeros(len(timebins_table), dtype=np.uint16)
+    for bit, name in enumerate(TIMEBIN_FLAGS):
+        flags |= timebins_table[name].to_numpy().astype(np.uint16) << bit
+    packed = timebins_table.drop(columns=list(TIMEBIN_FLAGS))
+    packed['flags'] = flags
+    return packed
+
+
+def unpack_timebin_flags(timebins_table, names=TIMEBIN_FLAGS):
+
+    #timebins_table: table with a 'flags' column from pack_timebin_flags
+    #names: flags to unpack as bool columns
+    #returns: table with bool columns for each of names, in place of 'flags'
+
+    flags = timebins_table['flags'].to_numpy()
+    unpacked = timebins_table.drop(columns=['flags'])
+    for name in names:
+        unpacked[name] = (flags >> TIMEBIN_FLAGS.index(name)) & 1 == 1
+    return unpacked
+
+
+@instrument.timed('timebins_table')
+def make_timebins_table(trials, bin_size, packed_flags=False):
+
+    #trials: trials table, indexed by trial_index
+    #bin_size: size of each bin in seconds
+    #packed_flags: optional input to return event/context flags as bits of a single uint16 'flags' column
+    #               instead of one bool column each (see pack_timebin_flags, unpack_timebin_flags)
+    #returns: timebins table, bin edges
 
     start_time = trials[:]['start_time'].iloc[0]
     end_time = trials[:]['stop_time'].iloc[-1]
 
     bins = np.arange(start_time, end_time, bin_size)
 
+    bin_starts = bins[:-1]
     bin_centers = (bins[:-1] + bins[1:])/2
 
     timebins_table={
-        'bin_start':bins[:-1],
+        'bin_start':bin_starts,
         'bin_end':bins[1:],
         'bin_center':bin_centers,
-        'stim_start':np.zeros(len(bin_centers),dtype=bool),
-        'stim_stop':np.zeros(len(bin_centers),dtype=bool),
-        'reward':np.zeros(len(bin_centers),dtype=bool),
-        'is_vis_context':np.zeros(len(bin_centers),dtype=bool),
-        'is_aud_context':np.zeros(len(bin_centers),dtype=bool),
-        'is_vis_stim':np.zeros(len(bin_centers),dtype=bool),
-        'is_aud_stim':np.zeros(len(bin_centers),dtype=bool),
-        'is_vis_target':np.zeros(len(bin_centers),dtype=bool),
-        'is_aud_target':np.zeros(len(bin_centers),dtype=bool),
-        'is_catch':np.zeros(len(bin_centers),dtype=bool),
-        'is_vis_nontarget':np.zeros(len(bin_centers),dtype=bool),
-        'is_aud_nontarget':np.zeros(len(bin_centers),dtype=bool),
-        'is_context_switch':np.zeros(len(bin_centers),dtype=bool),
     }
+    for name in TIMEBIN_FLAGS:
+        timebins_table[name] = np.zeros(len(bin_centers),dtype=bool)
 
-    #set context
+    #set context: blocks run from the start of each context switch trial to the stop of the next,
+    #so later blocks overwrite the overlap with earlier ones
     context_switches=trials[:].query('is_context_switch')
 
     context_switch_trial_index=np.hstack([0,context_switches['trial_index'].values,len(trials[:])-1])
 
-    for ii,switch_trial_num in enumerate(context_switch_trial_index[:-1]):
-        block_start=trials.loc[switch_trial_num]['start_time']
-        block_end=trials.loc[context_switch_trial_index[ii+1]]['stop_time']
-
-        if trials['is_vis_context'].loc[switch_trial_num]:
-            timebins_table['is_vis_context'][(timebins_table['bin_start']>=block_start) & 
-                                            (timebins_table['bin_start']<block_end)]=True
-            timebins_table['is_aud_context'][(timebins_table['bin_start']>=block_start) & 
-                                            (timebins_table['bin_start']<block_end)]=False
-        elif trials['is_aud_context'].loc[switch_trial_num]:
-            timebins_table['is_aud_context'][(timebins_table['bin_start']>=block_start) & 
-                                            (timebins_table['bin_start']<block_end)]=True
-            timebins_table['is_vis_context'][(timebins_table['bin_start']>=block_start) & 
-                                            (timebins_table['bin_start']<block_end)]=False
-        if ii > 0:    
-            timebins_table['is_context_switch'][(timebins_table['bin_start']>=block_start) &
-                                                (timebins_table['bin_start']<block_start+bin_size)]=True
+    block_starts=trials.loc[context_switch_trial_index[:-1], 'start_time'].to_numpy()
+    block_ends=trials.loc[context_switch_trial_index[1:], 'stop_time'].to_numpy()
+    block_is_vis=trials['is_vis_context'].loc[context_switch_trial_index[:-1]].to_numpy()
+    block_is_aud=trials['is_aud_context'].loc[context_switch_trial_index[:-1]].to_numpy()
+
+    first_bins=np.searchsorted(bin_starts, block_starts, side='left')
+    stop_bins=np.searchsorted(bin_starts, block_ends, side='left')
 
+    for first_bin, stop_bin, is_vis, is_aud in zip(first_bins, stop_bins, block_is_vis, block_is_aud):
+        if is_vis:
+            timebins_table['is_vis_context'][first_bin:stop_bin]=True
+            timebins_table['is_aud_context'][first_bin:stop_bin]=False
+        elif is_aud:
+            timebins_table['is_aud_context'][first_bin:stop_bin]=True
+            timebins_table['is_vis_context'][first_bin:stop_bin]=False
+
+    timebins_table['is_context_switch']=_mark_event_bins(bin_starts, block_starts[1:], bin_size)
 
     #set reward
     reward_trials=trials[:].query('is_rewarded')
 
-    for rr,reward_trial in reward_trials.iterrows():
-        timebins_table['reward'][(timebins_table['bin_start']>=reward_trial['reward_time']) & 
-                                (timebins_table['bin_start']<reward_trial['reward_time']+bin_size)]=True
-        
-        
-    #set stimuli
-    for tt,trial in trials[:].iterrows():
-        if trial['is_vis_stim']:
-            timebins_table['is_vis_stim'][(timebins_table['bin_start']>=trial['stim_start_time']) & 
-                                        (timebins_table['bin_start']<trial['stim_start_time']+bin_size)]=True
-            if trial['is_target']:
-                timebins_table['is_vis_target'][(timebins_table['bin_start']>=trial['stim_start_time']) & 
-                                                (timebins_table['bin_start']<trial['stim_start_time']+bin_size)]=True
-            elif trial['is_nontarget']:
-                timebins_table['is_vis_nontarget'][(timebins_table['bin_start']>=trial['stim_start_time']) & 
-                                                (timebins_table['bin_start']<trial['stim_start_time']+bin_size)]=True
-        elif trial['is_aud_stim']:
-            timebins_table['is_aud_stim'][(timebins_table['bin_start']>=trial['stim_start_time']) & 
-                                        (timebins_table['bin_start']<trial['stim_start_time']+bin_size)]=True
-            if trial['is_target']:
-                timebins_table['is_aud_target'][(timebins_table['bin_start']>=trial['stim_start_time']) & 
-                                                (timebins_table['bin_start']<trial['stim_start_time']+bin_size)]=True
-            elif trial['is_nontarget']:
-                timebins_table['is_aud_nontarget'][(timebins_table['bin_start']>=trial['stim_start_time']) & 
-                                                (timebins_table['bin_start']<trial['stim_start_time']+bin_size)]=True
-        elif trial['is_catch']:
-            timebins_table['is_catch'][(timebins_table['bin_start']>=trial['stim_start_time']) & 
-                                        (timebins_table['bin_start']<trial['stim_start_time']+bin_size)]=True
-            
-        timebins_table['stim_start'][(timebins_table['bin_start']>=trial['stim_start_time']) &
-                                    (timebins_table['bin_start']<trial['stim_start_time']+bin_size)]=True
-        timebins_table['stim_stop'][(timebins_table['bin_start']>=trial['stim_stop_time']) &
-                                    (timebins_table['bin_start']<trial['stim_stop_time']+bin_size)]=True
-
-
-    return pd.DataFrame.from_dict(timebins_table),bins
-
-
-
-def make_neuron_timebins_matrix(units, trials, bin_size, generate_context_labels=False):
+    timebins_table['reward']=_mark_event_bins(bin_starts, reward_trials['reward_time'], bin_size)
+
+    #set stimuli: each trial is marked as only one of vis, aud or catch, in that order of precedence
+    is_vis_stim=trials[:]['is_vis_stim'].to_numpy().astype(bool)
+    is_aud_stim=~is_vis_stim & trials[:]['is_aud_stim'].to_numpy().astype(bool)
+    is_catch=~is_vis_stim & ~is_aud_stim & trials[:]['is_catch'].to_numpy().astype(bool)
+    is_target=trials[:]['is_target'].to_numpy().astype(bool)
+    is_nontarget=~is_target & trials[:]['is_nontarget'].to_numpy().astype(bool)
+
+    stim_start_times=trials[:]['stim_start_time'].to_numpy()
+
+    for name, is_trial in {
+        'is_vis_stim': is_vis_stim,
+        'is_vis_target': is_vis_stim & is_target,
+        'is_vis_nontarget': is_vis_stim & is_nontarget,
+        'is_aud_stim': is_aud_stim,
+        'is_aud_target': is_aud_stim & is_target,
+        'is_aud_nontarget': is_aud_stim & is_nontarget,
+        'is_catch': is_catch,
+    }.items():
+        timebins_table[name]=_mark_event_bins(bin_starts, stim_start_times[is_trial], bin_size)
+
+    timebins_table['stim_start']=_mark_event_bins(bin_starts, stim_start_times, bin_size)
+    timebins_table['stim_stop']=_mark_event_bins(bin_starts, trials[:]['stim_stop_time'], bin_size)
+
+    timebins_table=pd.DataFrame.from_dict(timebins_table)
+    instrument.update(rows=len(timebins_table))
+    if packed_flags:
+        timebins_table=pack_timebin_flags(timebins_table)
+
+    return timebins_table,bins
+
+
+
+TIMEBINS_MATRIX_STORAGE = ('float64', 'float32', 'uint16', 'uint8', 'sparse')
+
+
+def estimate_neuron_timebins_matrix_nbytes(unit_count, timebin_count, storage='float64', spike_count=None):
+
+    #unit_count, timebin_count: shape of matrix
+    #storage: one of TIMEBINS_MATRIX_STORAGE
+    #spike_count: total spikes across units, required for 'sparse' (an upper bound on non-zero entries)
+    #returns: estimated size of matrix in bytes
+
+    if storage not in TIMEBINS_MATRIX_STORAGE:
+        raise ValueError(f"storage must be one of {TIMEBINS_MATRIX_STORAGE}, got {storage!r}")
+    if storage == 'sparse':
+        if spike_count is None:
+            raise ValueError("spike_count is required to estimate size of sparse matrix")
+        nonzero_count = min(spike_count, unit_count * timebin_count)
+        # int32 data + int32 column indices, int64 row pointers
+        return nonzero_count * 8 + (unit_count + 1) * 8
+    return unit_count * timebin_count * np.dtype(storage).itemsize
+
+
+@numba.njit(nogil=True, parallel=True)
+def _fill_binned_spike_counts(spike_times, offsets, bins, out):
+
+    #spike_times, offsets: flat spike times for all units (see spike_store.flatten_spike_times)
+    #bins: bin edges, binned as in np.histogram (last bin includes its right edge)
+    #out: (units x timebins) array to fill with spike counts
+    #returns: largest count in any bin
+
+    max_counts = np.zeros(len(offsets) - 1, dtype=np.int64)
+    for uu in numba.prange(len(offsets) - 1):
+        unit_spike_times = spike_times[offsets[uu]:offsets[uu + 1]]
+        cumulative_counts = np.searchsorted(unit_spike_times, bins)
+        cumulative_counts[-1] = np.searchsorted(unit_spike_times, bins[-1], side='right')
+        counts = np.diff(cumulative_counts)
+        if len(counts):
+            max_counts[uu] = counts.max()
+        for bb in range(len(counts)):
+            out[uu, bb] = counts[bb]
+    return max_counts.max() if len(max_counts) else 0
+
+
+def get_sparse_binned_spike_counts(spike_times, offsets, bins):
+
+    #spike_times, offsets: flat spike times for all units (see spike_store.flatten_spike_times)
+    #bins: bin edges, binned as in np.histogram (last bin includes its right edge)
+    #returns: scipy.sparse CSR matrix of spike counts (units x timebins), with memory
+    #         proportional to the number of spikes rather than timebins
+
+    import scipy.sparse
+
+    unit_idx = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    bin_idx = np.searchsorted(bins, spike_times, side='right') - 1
+    bin_idx[spike_times == bins[-1]] = len(bins) - 2
+    is_in_bins = (bin_idx >= 0) & (bin_idx < len(bins) - 1)
+    return scipy.sparse.csr_matrix(
+        (np.ones(is_in_bins.sum(), dtype=np.int32), (unit_idx[is_in_bins], bin_idx[is_in_bins])),
+        shape=(len(offsets) - 1, len(bins) - 1),
+    )
+
+
+class SparseTimebinsMatrix(typing.NamedTuple):
+
+    #neuron x timebin matrix of spike counts from make_neuron_timebins_matrix(storage='sparse'),
+    #with the coords and attrs of the DataArray returned for other storage options
+    #matrix: scipy.sparse CSR matrix (units x timebins)
+    #unit_id: unit_id of each row
+    #timebin: timebins table index of each column
+    #bins: timebin edges
+    #attrs: bin_size, units
+
+    matrix: typing.Any
+    unit_id: np.ndarray
+    timebin: np.ndarray
+    bins: np.ndarray
+    attrs: dict
+
+    @property
+    def shape(self):
+        return self.matrix.shape
+
+    def to_dataarray(self):
+        #returns: dense DataArray of spike counts, as for storage='uint16' etc.
+        return xr.DataArray(self.matrix.toarray(), dims=("unit_id", "timebin"),
+                            coords={"unit_id": self.unit_id, "timebin": self.timebin},
+                            attrs=self.attrs)
+
+
+@instrument.timed('timebins_matrix')
+def make_neuron_timebins_matrix(units, trials, bin_size, generate_context_labels=False, storage='float64', spike_times_all=None, zarr_path=None, unit_chunk_size=100):
     
     #units: units table to include in matrix
     #trials: trials table to create timebins table
     #bin_size: size of each bin in seconds
+    #storage: optional input to specify how the matrix is stored (one of TIMEBINS_MATRIX_STORAGE):
+    #   'float64', 'float32': spikes/s
+    #   'uint16', 'uint8': spike counts - divide by attrs['bin_size'] for spikes/s
+    #   'sparse': SparseTimebinsMatrix with a scipy.sparse CSR matrix of spike counts, plus the
+    #             unit ids, timebins and bin edges, returned in place of the DataArray
+    #spike_times_all: optional spike times for each unit, in the same order as units (list of arrays,
+    #                 or a SpikeStore); if None, units['spike_times'] is used
+    #zarr_path: optional path to write matrix to a zarr store in chunks of unit_chunk_size units,
+    #           returning a lazily-loaded dask-backed DataArray instead of building it in memory
     
     # generate 10-minute blocks of context labels
     if generate_context_labels:
@@ -188,52 +425,239 @@ def make_neuron_timebins_matrix(units, trials, bin_size, generate_context_labels
 
     timebins_table,bins = make_timebins_table(trials, bin_size)
 
-    unit_count = len(units[:])
-    timebin_count = len(timebins_table)
-
-    matrix = np.zeros((unit_count, timebin_count))
+    unit_ids = units[:]['unit_id'].values
+    if spike_times_all is None:
+        spike_times, offsets = flatten_spike_times(units[:]['spike_times'])
+    elif isinstance(spike_times_all, SpikeStore):
+        spike_times, offsets = spike_times_all.get_flat_spike_times(unit_ids)
+    else:
+        spike_times, offsets = flatten_spike_times(spike_times_all)
 
-    for uu, unit in units[:].iterrows():
-        spike_times = np.array(unit['spike_times'])
-        # event_times = timebins_table['bin_start']
-        # event_aligned_spikes, bin_centers = makePSTH(spike_times, event_times, time_before, time_after, bin_size)
-        event_aligned_spikes, bin_edges = np.histogram(spike_times, bins=bins)
-        matrix[uu,:] = event_aligned_spikes/bin_size
+    unit_count = len(unit_ids)
+    timebin_count = len(timebins_table)
+    instrument.update(units=unit_count, rows=timebin_count)
+
+    if storage == 'sparse':
+        if zarr_path is not None:
+            raise ValueError("storage='sparse' can't be written to zarr: use a dense storage option")
+        nbytes = estimate_neuron_timebins_matrix_nbytes(unit_count, timebin_count, storage, spike_count=len(spike_times))
+        logger.info(f"neuron x timebin matrix: {unit_count} units x {timebin_count} timebins as {storage} ~ {nbytes / 1e9:.2f} GB")
+        timebin_matrix = SparseTimebinsMatrix(
+            matrix=get_sparse_binned_spike_counts(spike_times, offsets, bins),
+            unit_id=unit_ids,
+            timebin=timebins_table.index.values,
+            bins=bins,
+            attrs={'bin_size': bin_size, 'units': 'spikes'},
+        )
+        return timebin_matrix, timebins_table
+
+    nbytes = estimate_neuron_timebins_matrix_nbytes(
+        unit_count if zarr_path is None else min(unit_chunk_size, unit_count), timebin_count, storage
+    )
+    logger.info(f"neuron x timebin matrix: {unit_count} units x {timebin_count} timebins as {storage} ~ {nbytes / 1e9:.2f} GB"
+                + ("" if zarr_path is None else f" per chunk of {unit_chunk_size} units"))
+
+    def make_chunk(start, stop):
+        matrix = np.zeros((stop - start, timebin_count), dtype=storage)
+        max_count = _fill_binned_spike_counts(*_get_unit_chunk(spike_times, offsets, start, stop), bins, matrix)
+        if np.issubdtype(matrix.dtype, np.integer):
+            if max_count > np.iinfo(matrix.dtype).max:
+                raise ValueError(f"Spike count of {max_count} in a single timebin does not fit in {storage}: use a larger dtype")
+            attrs = {'bin_size': bin_size, 'units': 'spikes'}
+        else:
+            matrix /= bin_size
+            attrs = {'bin_size': bin_size, 'units': 'spikes/s'}
 
-    timebin_da = xr.DataArray(matrix, dims=("unit_id", "timebin"), 
+        return xr.DataArray(matrix, dims=("unit_id", "timebin"), 
                             coords={
-                                "unit_id": units[:]['unit_id'].values,
+                                "unit_id": unit_ids[start:stop],
                                 "timebin": timebins_table.index.values,
-                                })
-
-    return timebin_da, timebins_table
-
-
-def get_structure_probe(session):
-    
-    units=pd.read_parquet(
-                npc_lims.get_cache_path('units',session.id,version='v0.0.173')
-            )
+                                },
+                            attrs=attrs)
 
-    unique_areas=units[:]['structure'].unique()
+    if zarr_path is not None:
+        name = 'spike_counts' if np.issubdtype(np.dtype(storage), np.integer) else 'spikes_per_second'
+        timebin_da = _to_zarr_in_unit_chunks(
+            make_chunk, unit_count, unit_chunk_size, zarr_path, name, chunks={'timebin': 2**16}
+        )
+    else:
+        timebin_da = make_chunk(0, unit_count)
 
-    structure_probe=np.full(len(units[:]),'',dtype=object)
-
-    for aa in unique_areas:
-        unique_probes=units[:].query('structure==@aa')['group_name'].unique()
+    return timebin_da, timebins_table
 
-        if len(unique_probes)>1:
-            for up in unique_probes:
-                unit_idx=units[:].query('structure==@aa and group_name==@up').index.values
-                structure_probe[unit_idx]=aa+'_'+up
-        elif len(unique_probes)==1:
-            unit_idx=units[:].query('structure==@aa').index.values
-            structure_probe[unit_idx]=aa
-        else:
-            print('no units in '+aa)
 
-    structure_probe=pd.DataFrame({
+def make_structure_probe(units):
+    #units: dataframe with unit_id, structure and group_name columns, plus session_id if it
+    #       contains units from more than one session
+    #returns: dataframe with structure_probe and unit_id for each unit, with the same index as
+    #         units: structure_probe is the structure, with the probe appended if the structure was
+    #         recorded on more than one probe in the session
+
+    keys = ['session_id', 'structure'] if 'session_id' in units.columns else ['structure']
+    probe_count = units.groupby(keys, observed=True)['group_name'].transform('nunique', dropna=False)
+    structure = units['structure'].astype(object)
+    structure_probe = np.where(
+        probe_count > 1,
+        structure + '_' + units['group_name'].astype(object),
+        structure,
+    )
+    # units without a structure, or without a probe in a structure on more than one probe, have
+    # no label
+    structure_probe = pd.Series(structure_probe, index=units.index).fillna('').to_numpy()
+
+    return pd.DataFrame({
         'structure_probe':structure_probe,
-        'unit_id':units[:]['unit_id']},index=units[:].index.values)
-
-    return structure_probe
\ No newline at end of file
+        'unit_id':units['unit_id']},index=units.index.values)
+
+
+def get_structure_probe(session=None,version=None):
+    #session: session object, or session ID of a file in the units cache; if None, units from
+    #         all sessions are labelled from one scan of the consolidated units table
+    #version: cache version to read units from (default: latest)
+    #returns: see make_structure_probe
+    #
+    #only the columns needed are read. For labels kept up to date across cache versions, see
+    #derived.get_derived_table('structure_probe')
+
+    from dynamicrouting_summary import utils
+
+    columns=['unit_id','structure','group_name']
+    if session is None:
+        units=pd.read_parquet(
+                    cache_storage.get_cache_path('units',version=version),
+                    columns=[*columns,*utils.SESSION_ID_COLUMNS],
+                )
+        units=utils.add_session_id_column(units)
+    else:
+        session_id=getattr(session,'id',session)
+        units=pd.read_parquet(
+                    cache_storage.get_cache_path('units',session_id,version=version),
+                    columns=columns,
+                )
+
+    return make_structure_probe(units)
+
+
+#functions for population firing rate drift, streamed from the units dataset
+
+@numba.njit(nogil=True, parallel=True)
+def _get_window_binned_counts(spike_times, offsets, pair_unit_idx, pair_window_edges, align_to_first_spike):
+
+    #spike_times, offsets: flat spike times for units (see spike_store.flatten_spike_times)
+    #pair_unit_idx: unit index for each (unit, window) pair
+    #pair_window_edges: bin edges of the window for each pair, shape (pairs, bins + 1),
+    #                   binned as in np.histogram (last bin includes its right edge)
+    #align_to_first_spike: subtract each unit's first spike time from its spike times
+    #returns: spike counts for each pair, shape (pairs, bins)
+
+    n_bins = pair_window_edges.shape[1] - 1
+    counts = np.zeros((len(pair_unit_idx), n_bins), dtype=np.int64)
+    for pp in numba.prange(len(pair_unit_idx)):
+        uu = pair_unit_idx[pp]
+        unit_spike_times = spike_times[offsets[uu]:offsets[uu + 1]]
+        if len(unit_spike_times) == 0:
+            continue
+        edges = pair_window_edges[pp].copy()
+        if align_to_first_spike:
+            edges += unit_spike_times[0]
+        cumulative_counts = np.searchsorted(unit_spike_times, edges)
+        cumulative_counts[-1] = np.searchsorted(unit_spike_times, edges[-1], side='right')
+        counts[pp] = np.diff(cumulative_counts)
+    return counts
+
+
+def get_population_rate_drift(windows, n_bins=100, units_source=None, version=None, filter=None, probe_column='electrode_group_name', align_to_first_spike=False, batch_size=64):
+
+    #windows: dataframe with start_time, stop_time and session_id (or subject_id, date and
+    #         session_idx) for each window to bin spikes in (e.g. the `epochs` table) - other
+    #         columns are kept in the output, except `probe_column`, which is replaced
+    #n_bins: number of equal-width bins in each window
+    #units_source: parquet file/directory or pyarrow dataset of units with spike_times
+    #              (default: per-session units files in the cache for `version`)
+    #filter: pyarrow expression to select units, e.g. ds.field('default_qc') == True
+    #probe_column: units column to group by within each session
+    #align_to_first_spike: bin each unit's spike times relative to its first spike
+    #returns: dataframe with one row per (session, probe, window), with n_units and bin_size
+    #         columns, and (rows x n_bins) array of spike counts summed over units
+    #
+    #units are streamed from the dataset in record batches of `batch_size` units, so only one
+    #batch of spike times is in memory at a time. Normalize as spikes/s per unit with
+    #counts / bin_size / n_units
+
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+
+    from dynamicrouting_summary import utils
+
+    if not isinstance(units_source, ds.Dataset):
+        units_source = ds.dataset(
+            units_source
+            or cache_storage.get_cache_path('units', version=version, consolidated=False)
+        )
+    if 'session_id' not in windows.columns:
+        windows = utils.add_session_id_column(windows)
+    windows = windows.reset_index(drop=True)
+    window_session_ids = windows['session_id'].astype(str).to_numpy()
+    window_edges = np.array([
+        np.linspace(start, stop, n_bins + 1)
+        for start, stop in zip(windows['start_time'], windows['stop_time'])
+    ]).reshape(len(windows), n_bins + 1)
+    window_idx_by_session = pd.Series(np.arange(len(windows))).groupby(window_session_ids).apply(np.asarray).to_dict()
+
+    has_session_id = 'session_id' in units_source.schema.names
+    columns = [probe_column, 'spike_times', *(['session_id'] if has_session_id else utils.SESSION_ID_COLUMNS)]
+
+    row_by_key = {}
+    row_counts = []
+    row_n_units = []
+    for batch in units_source.to_batches(columns=columns, filter=filter, batch_size=batch_size):
+        if batch.num_rows == 0:
+            continue
+        unit_info = batch.drop_columns(['spike_times']).to_pandas()
+        if not has_session_id:
+            unit_info = utils.add_session_id_column(unit_info)
+        session_ids = unit_info['session_id'].astype(str).to_numpy()
+        probes = unit_info[probe_column].astype(str).to_numpy()
+
+        pair_unit_idx = []
+        pair_window_idx = []
+        for uu, session_id in enumerate(session_ids):
+            window_idx = window_idx_by_session.get(session_id)
+            if window_idx is None:
+                continue
+            pair_unit_idx.extend([uu] * len(window_idx))
+            pair_window_idx.extend(window_idx)
+        if not pair_unit_idx:
+            continue
+        pair_unit_idx = np.array(pair_unit_idx, dtype=np.int64)
+        pair_window_idx = np.array(pair_window_idx, dtype=np.int64)
+
+        spike_times = batch.column('spike_times')
+        offsets = np.zeros(batch.num_rows + 1, dtype=np.int64)
+        np.cumsum(pc.list_value_length(spike_times).fill_null(0).to_numpy(zero_copy_only=False), out=offsets[1:])
+        counts = _get_window_binned_counts(
+            spike_times.flatten().to_numpy(zero_copy_only=False).astype(np.float64, copy=False),
+            offsets, pair_unit_idx, window_edges[pair_window_idx], align_to_first_spike,
+        )
+
+        # sum counts for units in the same (session, probe, window)
+        pair_rows = np.empty(len(pair_unit_idx), dtype=np.int64)
+        for pp, (uu, ww) in enumerate(zip(pair_unit_idx, pair_window_idx)):
+            key = (session_ids[uu], probes[uu], ww)
+            if key not in row_by_key:
+                row_by_key[key] = len(row_by_key)
+                row_counts.append(np.zeros(n_bins, dtype=np.int64))
+                row_n_units.append(0)
+            pair_rows[pp] = row_by_key[key]
+        for row, pair_counts in zip(pair_rows, counts):
+            row_counts[row] += pair_counts
+            row_n_units[row] += 1
+
+    keys = list(row_by_key)
+    drift_df = windows.drop(columns=probe_column, errors='ignore').iloc[[ww for _, _, ww in keys]]
+    drift_df = drift_df.reset_index(drop=True)
+    drift_df.insert(drift_df.columns.get_loc('session_id') + 1, probe_column, [probe for _, probe, _ in keys])
+    drift_df['n_units'] = row_n_units
+    drift_df['bin_size'] = (drift_df['stop_time'] - drift_df['start_time']) / n_bins
+    counts = np.array(row_counts, dtype=np.int64).reshape(len(keys), n_bins)
+    return drift_df, counts
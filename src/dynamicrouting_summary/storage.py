@@ -0,0 +1,360 @@
+"""Local read-through mirror of the `npc_lims` cache.
+
+Cache paths are resolved with `get_cache_path`, which returns a copy of the
+file (or directory of per-session files) on local disk, in
+`LOCAL_CACHE_DIR/mirror`: it's downloaded from the cache the first time it's
+requested, then read locally.
+
+- files in a cache version don't change, so a local copy is used without
+  checking the cache again (unless `validate` is set)
+- each copy records the fingerprint of the file it was downloaded from (its
+  S3 ETag, or size and modification time): when a new cache version has a file
+  with the same fingerprint as a copy from a previous version, the copy is
+  reused instead of being downloaded again
+- the mirror's total size is capped at `MIRROR_MAX_BYTES` (set with the
+  environment variable `DR_SUMMARY_MIRROR_MAX_BYTES`, 0 to disable the
+  mirror): least-recently-used copies are removed when it's exceeded, and
+  anything larger than the cap is read from the cache directly
+- downloads share one S3 filesystem with a pool of connections
+
+The cache root can be changed with `set_cache_root`, e.g. to a local
+directory that stands in for the bucket:
+
+>>> import tempfile
+>>> import pandas as pd
+>>> bucket, local = tempfile.mkdtemp(), tempfile.mkdtemp()
+>>> (pathlib.Path(bucket) / 'v0.0.0' / 'consolidated').mkdir(parents=True)
+>>> pd.DataFrame({'a': [1, 2]}).to_parquet(f'{bucket}/v0.0.0/consolidated/trials.parquet')
+>>> set_cache_root(bucket)
+>>> mirror = CacheMirror(local)
+>>> path = get_cache_path('trials', version='v0.0.0', mirror=mirror)
+>>> path.is_relative_to(local), pd.read_parquet(path)['a'].tolist()
+(True, [1, 2])
+>>> mirror.get_size() > 0
+True
+>>> set_cache_root(None)
+"""
+
+from __future__ import annotations
+
+import concurrent.futures
+import functools
+import json
+import os
+import pathlib
+import re
+import shutil
+import threading
+from collections.abc import Iterable, Mapping
+from typing import Any, cast
+
+import fsspec
+import npc_lims
+import npc_lims.paths.cache
+import upath
+
+import dynamicrouting_summary.instrument as instrument
+import dynamicrouting_summary.utils as utils
+
+MIRROR_DIRNAME = "mirror"
+MIRROR_MAX_BYTES = int(float(os.environ.get("DR_SUMMARY_MIRROR_MAX_BYTES", 50e9)))
+S3_MAX_POOL_CONNECTIONS = 64
+METADATA_SUFFIX = ".meta.json"
+VERSION_PATTERN = re.compile(r"^v\d+\.\d+\.\d+")
+
+CACHE_ROOT: upath.UPath | None = None
+"""Root of the cache to read from instead of `npc_lims`'s: see `set_cache_root`"""
+
+_eviction_lock = threading.Lock()
+
+
+def set_cache_root(root: str | os.PathLike | None) -> None:
+    """Read the cache from `root` (any path or URI with the same layout as the
+    `npc_lims` cache), or from the `npc_lims` cache if None"""
+    global CACHE_ROOT
+    CACHE_ROOT = None if root is None else upath.UPath(root)
+
+
+def get_remote_cache_path(
+    component: str,
+    session_id: str | None = None,
+    version: str | None = None,
+    consolidated: bool = True,
+) -> upath.UPath:
+    """`npc_lims.get_cache_path`, relative to `CACHE_ROOT` if it's set"""
+    # npc_lims checks the component
+    path = npc_lims.get_cache_path(
+        cast(npc_lims.NWBComponentStr, component),
+        session_id,
+        version=version,
+        consolidated=consolidated,
+    )
+    if CACHE_ROOT is None:
+        return path
+    npc_lims_root = npc_lims.paths.cache.CACHE_ROOT.as_posix().rstrip("/")
+    return CACHE_ROOT / path.as_posix()[len(npc_lims_root) :].lstrip("/")
+
+
+def get_cache_path(
+    component: str,
+    session_id: str | None = None,
+    version: str | None = None,
+    consolidated: bool = True,
+    mirror: CacheMirror | None = None,
+    download: bool = True,
+) -> pathlib.Path | upath.UPath:
+    """Path to read a file (or directory of per-session files, if
+    `consolidated` is False) in the cache from: a local copy in `mirror`
+    (default: `get_mirror()`), or the path in the cache if it can't be
+    mirrored.
+
+    - `download`: if False, a local copy is only used if it's already in the
+      mirror, e.g. to read a small part of a large file
+    """
+    path = get_remote_cache_path(component, session_id, version, consolidated)
+    mirror = mirror or get_mirror()
+    if mirror is None:
+        return path
+    return mirror.get_local_path(path, download=download) or path
+
+
+@functools.cache
+def _get_s3_filesystem() -> fsspec.AbstractFileSystem:
+    import s3fs
+
+    return s3fs.S3FileSystem(config_kwargs={"max_pool_connections": S3_MAX_POOL_CONNECTIONS})
+
+
+def get_filesystem(path: upath.UPath) -> fsspec.AbstractFileSystem:
+    """Filesystem for reading `path`: one S3 filesystem is shared by all S3
+    paths, so connections are reused"""
+    if path.protocol in ("s3", "s3a"):
+        return _get_s3_filesystem()
+    return path.fs
+
+
+def get_fingerprint(info: Mapping[str, Any]) -> str:
+    """Content identifier from fsspec file info: ETag is the same for a file
+    copied unchanged into a new cache version, mtime isn't"""
+    etag = info.get("ETag") or info.get("etag")
+    if etag:
+        return str(etag).strip('"')
+    return f"{info['size']}-{info.get('mtime') or info.get('LastModified')}"
+
+
+def _get_metadata_path(local_path: pathlib.Path) -> pathlib.Path:
+    # hidden, so it's ignored when a mirrored directory is read as a dataset
+    return local_path.with_name(f".{local_path.name}{METADATA_SUFFIX}")
+
+
+def _read_metadata(local_path: pathlib.Path) -> dict[str, Any] | None:
+    try:
+        return json.loads(_get_metadata_path(local_path).read_text())
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def _write_metadata(local_path: pathlib.Path, metadata: Mapping[str, Any]) -> None:
+    path = _get_metadata_path(local_path)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    tmp.write_text(json.dumps(metadata))
+    os.replace(tmp, path)
+
+
+class CacheMirror:
+    """Local copies of files in the cache, under `root`, up to `max_bytes` in
+    total.
+
+    - `validate`: check the fingerprint of the file in the cache each time a
+      local copy is used, and download it again if it's changed (default: only
+      for paths that aren't in a cache version directory)
+    - `max_workers`: number of threads downloading files in a directory
+    """
+
+    def __init__(
+        self,
+        root: str | os.PathLike,
+        max_bytes: int = MIRROR_MAX_BYTES,
+        validate: bool = False,
+        max_workers: int | None = 16,
+    ) -> None:
+        self.root = pathlib.Path(root)
+        self.max_bytes = max_bytes
+        self.validate = validate
+        self.max_workers = max_workers
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({self.root.as_posix()!r}, max_bytes={self.max_bytes})"
+
+    def _get_local_path(self, path: upath.UPath) -> pathlib.Path:
+        return self.root / (path.protocol or "file") / path.path.lstrip("/")
+
+    def _is_versioned(self, path: upath.UPath) -> bool:
+        return any(VERSION_PATTERN.match(part) for part in path.parts)
+
+    def get_local_path(
+        self, path: str | os.PathLike | upath.UPath, download: bool = True
+    ) -> pathlib.Path | None:
+        """Local copy of a file or directory in the cache, downloaded if it
+        isn't in the mirror yet, or None if it's larger than the mirror.
+
+        - `download`: if False, None is returned instead of downloading a copy
+          (or checking an existing copy against the cache, with `validate`)
+        """
+        remote = upath.UPath(path)
+        local_path = self._get_local_path(remote)
+        if not self.validate and self._is_versioned(remote):
+            if _read_metadata(local_path) is not None and local_path.exists():
+                self._touch(local_path)
+                return local_path
+        if not download:
+            return None
+        info = get_filesystem(remote).info(remote.path)
+        if info["type"] == "directory":
+            return self._mirror_directory(remote, local_path)
+        if info["size"] > self.max_bytes:
+            return None
+        self._mirror_file(remote, local_path, info)
+        self.evict(keep=[local_path])
+        return local_path
+
+    def _mirror_directory(self, path: upath.UPath, local_path: pathlib.Path) -> pathlib.Path | None:
+        """Copy files in a directory (not subdirectories), from one listing,
+        downloading those that are missing or have changed concurrently"""
+        infos = [
+            info
+            for info in get_filesystem(path).ls(path.path, detail=True)
+            if info["type"] == "file"
+        ]
+        if sum(info["size"] for info in infos) > self.max_bytes:
+            return None
+        local_paths = [local_path / pathlib.PurePosixPath(info["name"]).name for info in infos]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            list(
+                executor.map(
+                    lambda args: self._mirror_file(path / args[0].name, *args),
+                    zip(local_paths, infos),
+                )
+            )
+        # the directory's metadata marks it as complete
+        _write_metadata(
+            local_path,
+            dict(source=path.as_posix(), files={p.name: get_fingerprint(i) for p, i in zip(local_paths, infos)}),
+        )
+        self.evict(keep=[local_path, *local_paths])
+        return local_path
+
+    def _mirror_file(
+        self, path: upath.UPath, local_path: pathlib.Path, info: Mapping[str, Any]
+    ) -> None:
+        fingerprint = get_fingerprint(info)
+        metadata = _read_metadata(local_path)
+        if metadata is not None and metadata["fingerprint"] == fingerprint and local_path.exists():
+            self._touch(local_path)
+            return
+        local_path.parent.mkdir(parents=True, exist_ok=True)
+        # unique name: other threads or processes may be mirroring the same file
+        tmp = local_path.with_name(f".{local_path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        # size-mtime fingerprints change when a file is copied: only ETags identify content
+        is_etag = bool(info.get("ETag") or info.get("etag"))
+        previous = self._find_previous_version(local_path, fingerprint) if is_etag else None
+        try:
+            if previous is not None:
+                with instrument.stage("mirror_reuse"):
+                    self._link_or_copy(previous, tmp)
+            else:
+                with instrument.stage("mirror_download", bytes_read=info["size"]):
+                    get_filesystem(path).get_file(path.path, str(tmp))
+            os.replace(tmp, local_path)
+        finally:
+            tmp.unlink(missing_ok=True)
+        _write_metadata(local_path, dict(source=path.as_posix(), fingerprint=fingerprint))
+
+    @staticmethod
+    def _link_or_copy(source: pathlib.Path, destination: pathlib.Path) -> None:
+        # a hard link shares data with the previous version's copy
+        try:
+            os.link(source, destination)
+        except OSError:
+            shutil.copyfile(source, destination)
+
+    def _find_previous_version(self, local_path: pathlib.Path, fingerprint: str) -> pathlib.Path | None:
+        """Copy of the same file in another cache version, with the same
+        fingerprint, if there is one"""
+        parts = local_path.relative_to(self.root).parts
+        idx = next((i for i, part in enumerate(parts) if VERSION_PATTERN.match(part)), None)
+        if idx is None:
+            return None
+        versions_dir = self.root.joinpath(*parts[:idx])
+        for version_dir in versions_dir.iterdir():
+            if version_dir.name == parts[idx]:
+                continue
+            candidate = version_dir.joinpath(*parts[idx + 1 :])
+            metadata = _read_metadata(candidate)
+            if metadata is not None and metadata["fingerprint"] == fingerprint and candidate.exists():
+                return candidate
+        return None
+
+    @staticmethod
+    def _touch(local_path: pathlib.Path) -> None:
+        # metadata mtime records last use, for eviction
+        try:
+            os.utime(_get_metadata_path(local_path))
+        except FileNotFoundError:
+            pass
+
+    def _get_files(self) -> list[tuple[pathlib.Path, float, int]]:
+        """(path, last used, size) of each mirrored file: a file in a mirrored
+        directory is also used when the directory is"""
+        last_used: dict[pathlib.Path, float] = {}
+        for metadata_path in self.root.rglob(f".*{METADATA_SUFFIX}"):
+            local_path = metadata_path.with_name(metadata_path.name[1 : -len(METADATA_SUFFIX)])
+            try:
+                last_used[local_path] = metadata_path.stat().st_mtime
+            except FileNotFoundError:
+                continue  # evicted by another process
+        files = []
+        for local_path, mtime in last_used.items():
+            try:
+                size = local_path.stat().st_size
+            except FileNotFoundError:
+                continue
+            if local_path.is_file():
+                files.append((local_path, max(mtime, last_used.get(local_path.parent, 0.0)), size))
+        return files
+
+    def get_size(self) -> int:
+        """Total size of mirrored files in bytes"""
+        return sum(size for _, _, size in self._get_files())
+
+    def evict(self, keep: Iterable[pathlib.Path] = ()) -> int:
+        """Remove least-recently-used files until the mirror is within
+        `max_bytes`, except those in `keep`, and return the number of bytes
+        removed"""
+        keep = set(keep)
+        with _eviction_lock:
+            files = self._get_files()
+            excess = sum(size for _, _, size in files) - self.max_bytes
+            removed = 0
+            for local_path, _, size in sorted(files, key=lambda f: f[1]):
+                if removed >= excess:
+                    break
+                if local_path in keep or local_path.parent in keep:
+                    continue
+                # a mirrored directory is no longer complete without all its files
+                _get_metadata_path(local_path.parent).unlink(missing_ok=True)
+                _get_metadata_path(local_path).unlink(missing_ok=True)
+                local_path.unlink(missing_ok=True)
+                removed += size
+        return removed
+
+    def clear(self) -> None:
+        """Remove all mirrored files"""
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+def get_mirror() -> CacheMirror | None:
+    """Mirror in `LOCAL_CACHE_DIR`, or None if `MIRROR_MAX_BYTES` is 0"""
+    if MIRROR_MAX_BYTES <= 0:
+        return None
+    return CacheMirror(utils.LOCAL_CACHE_DIR / MIRROR_DIRNAME, max_bytes=MIRROR_MAX_BYTES)
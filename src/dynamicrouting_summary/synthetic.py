@@ -0,0 +1,364 @@
+"""Synthetic sessions for running and benchmarking code without the S3 cache.
+
+Tables are generated with the columns used in this package - units with
+Poisson spike trains, obs_intervals and structures; trials with context blocks,
+stimuli and rewards; epochs, session and performance - and can be written to a
+local directory in the same layout as the `npc_lims` cache:
+
+    <root>/<version>/<component>/<session_id>.parquet
+    <root>/<version>/consolidated/<component>.parquet
+
+>>> import tempfile
+>>> root = tempfile.mkdtemp()
+>>> session_ids = write_synthetic_cache(root, n_sessions=2, n_units=10, n_trials=50, duration=600)
+>>> session_ids
+['900000_2024-01-01', '900001_2024-01-02']
+>>> with use_synthetic_cache(root):
+...     units = pd.read_parquet(storage.get_cache_path('units', session_ids[0], version=SYNTHETIC_VERSION))
+>>> len(units), int(units['num_spikes'].sum()) == sum(map(len, units['spike_times']))
+(10, True)
+>>> session = SyntheticSession(n_units=10, n_trials=50, duration=600)
+>>> session.units[:].shape[0], len(session.intervals['trials'])
+(10, 50)
+"""
+
+from __future__ import annotations
+
+import contextlib
+import datetime
+import pathlib
+from collections.abc import Iterator, Sequence
+from typing import Any
+
+import numpy as np
+import numpy.typing as npt
+import pandas as pd
+
+import dynamicrouting_summary.storage as storage
+import dynamicrouting_summary.utils as utils
+
+SYNTHETIC_VERSION = "v0.0.0"
+SYNTHETIC_SUBJECT_ID = 900000
+PROBES = ("A", "B", "C", "D", "E", "F")
+STRUCTURES = ("VISp", "VISl", "LP", "CA1", "DG", "MOs", "ACAd", "ORBl", "MRN", "SCig")
+TRIAL_STIM_NAMES = ("vis1", "vis2", "sound1", "sound2", "catch")
+TRIAL_STIM_PROBABILITIES = (0.225, 0.225, 0.225, 0.225, 0.1)
+N_BLOCKS = 6
+COMPONENTS = ("session", "epochs", "trials", "performance", "units")
+
+# fractions of the session duration: (start, stop, stim_name)
+EPOCHS = (
+    (0.0, 0.05, "Spontaneous"),
+    (0.05, 0.15, "RFMapping"),
+    (0.15, 0.85, "DynamicRouting1"),
+    (0.85, 0.95, "OptoTagging"),
+    (0.95, 1.0, "SpontaneousRewards"),
+)
+
+
+def get_session_ids(n_sessions: int) -> list[str]:
+    """Session IDs for synthetic sessions: one per subject, one per day"""
+    start = datetime.date(2024, 1, 1)
+    return [
+        f"{SYNTHETIC_SUBJECT_ID + i}_{start + datetime.timedelta(days=i)}"
+        for i in range(n_sessions)
+    ]
+
+
+def _get_session_id_columns(session_id: str) -> dict[str, Any]:
+    subject_id, date = session_id.split("_")[:2]
+    return dict(subject_id=subject_id, date=date, session_idx=0)
+
+
+def _get_epoch_interval(duration: float, stim_name: str) -> tuple[float, float]:
+    start, stop = next((start, stop) for start, stop, name in EPOCHS if name == stim_name)
+    return start * duration, stop * duration
+
+
+def make_units(
+    session_id: str,
+    n_units: int = 300,
+    duration: float = 3600.0,
+    seed: int = 0,
+) -> pd.DataFrame:
+    """Units table with homogeneous Poisson spike trains.
+
+    - firing rates are log-normally distributed, with a median of 5 spikes/s
+    - most units are observed for the whole session: the rest have one shorter
+      observed interval, and spikes only within it
+    - units are spread across probes, and each probe passes through a few
+      consecutive structures
+    """
+    rng = np.random.default_rng(seed)
+    rates = np.clip(rng.lognormal(np.log(5.0), 1.0, n_units), 0.05, 100.0)
+    obs_intervals = np.tile([0.0, duration], (n_units, 1))
+    is_partial = rng.random(n_units) < 0.1
+    obs_intervals[is_partial, 0] = rng.uniform(0, 0.2 * duration, is_partial.sum())
+    obs_intervals[is_partial, 1] = rng.uniform(0.8 * duration, duration, is_partial.sum())
+    spike_times = []
+    for rate, (start, stop) in zip(rates, obs_intervals):
+        n_spikes = rng.poisson(rate * (stop - start))
+        spike_times.append(np.sort(rng.uniform(start, stop, n_spikes)))
+
+    probes = np.array(PROBES)[np.sort(rng.integers(0, len(PROBES), n_units))]
+    unit_idx_on_probe = pd.Series(probes).groupby(probes).cumcount().to_numpy()
+    structures = np.empty(n_units, dtype=object)
+    for probe in np.unique(probes):
+        is_probe = probes == probe
+        first = rng.integers(0, len(STRUCTURES) - 2)
+        # deeper units (later on the probe) are in later structures
+        structures[is_probe] = np.array(STRUCTURES[first : first + 3])[
+            np.sort(rng.integers(0, 3, is_probe.sum()))
+        ]
+    return pd.DataFrame(
+        dict(
+            unit_id=[f"{session_id}_{p}-{i}" for p, i in zip(probes, unit_idx_on_probe)],
+            electrode_group_name=[f"probe{p}" for p in probes],
+            group_name=[f"probe{p}" for p in probes],
+            structure=structures,
+            location=structures,
+            default_qc=rng.random(n_units) < 0.7,
+            firing_rate=[len(s) / (stop - start) for s, (start, stop) in zip(spike_times, obs_intervals)],
+            num_spikes=[len(s) for s in spike_times],
+            obs_intervals=[[interval] for interval in obs_intervals],
+            spike_times=spike_times,
+            **_get_session_id_columns(session_id),
+        )
+    )
+
+
+def make_trials(
+    n_trials: int = 500,
+    duration: float = 3600.0,
+    seed: int = 0,
+) -> pd.DataFrame:
+    """Task trials table, with trials evenly spaced through the task epoch in
+    `N_BLOCKS` alternating context blocks"""
+    rng = np.random.default_rng(seed)
+    epoch_start, epoch_stop = _get_epoch_interval(duration, "DynamicRouting1")
+    spacing = (epoch_stop - epoch_start) / n_trials
+    start_time = epoch_start + spacing * (np.arange(n_trials) + rng.uniform(0, 0.05, n_trials))
+    stim_start_time = start_time + 0.3 * spacing
+    stim_stop_time = stim_start_time + min(0.5, 0.2 * spacing)
+    stop_time = start_time + 0.95 * spacing
+
+    block_index = np.arange(n_trials) * N_BLOCKS // n_trials
+    is_vis_context = (block_index % 2 == 0) == bool(rng.integers(2))
+    stim_name = rng.choice(TRIAL_STIM_NAMES, n_trials, p=TRIAL_STIM_PROBABILITIES)
+    is_vis_stim = np.isin(stim_name, ("vis1", "vis2"))
+    is_aud_stim = np.isin(stim_name, ("sound1", "sound2"))
+    is_target = np.isin(stim_name, ("vis1", "sound1"))
+    is_rewarded = (
+        ((stim_name == "vis1") & is_vis_context) | ((stim_name == "sound1") & ~is_vis_context)
+    ) & (rng.random(n_trials) < 0.8)
+    return pd.DataFrame(
+        dict(
+            trial_index=np.arange(n_trials),
+            start_time=start_time,
+            stop_time=stop_time,
+            stim_start_time=stim_start_time,
+            stim_stop_time=stim_stop_time,
+            stim_name=stim_name,
+            block_index=block_index,
+            is_vis_context=is_vis_context,
+            is_aud_context=~is_vis_context,
+            is_context_switch=np.diff(block_index, prepend=0) == 1,
+            is_vis_stim=is_vis_stim,
+            is_aud_stim=is_aud_stim,
+            is_catch=stim_name == "catch",
+            is_target=is_target,
+            is_nontarget=(is_vis_stim | is_aud_stim) & ~is_target,
+            is_vis_target=stim_name == "vis1",
+            is_aud_target=stim_name == "sound1",
+            is_rewarded=is_rewarded,
+            reward_time=np.where(is_rewarded, stim_start_time + 0.1 * spacing, np.nan),
+        )
+    )
+
+
+def make_epochs(duration: float = 3600.0) -> pd.DataFrame:
+    """Epochs table covering the session"""
+    return pd.DataFrame(
+        [(start * duration, stop * duration, name) for start, stop, name in EPOCHS],
+        columns=["start_time", "stop_time", "stim_name"],
+    )
+
+
+def make_performance(trials: pd.DataFrame, seed: int = 0) -> pd.DataFrame:
+    """Performance table with one row per block of `trials`"""
+    rng = np.random.default_rng(seed)
+    blocks = trials.groupby("block_index")["is_vis_context"].first()
+    return pd.DataFrame(
+        dict(
+            block_index=blocks.index.to_numpy(),
+            rewarded_modality=np.where(blocks.to_numpy(), "vis", "aud"),
+            same_modal_dprime=rng.normal(2.5, 1.0, len(blocks)),
+            cross_modal_dprime=rng.normal(2.0, 1.0, len(blocks)),
+        )
+    )
+
+
+def make_session(session_id: str, keywords: Sequence[str] = ("ephys", "opto")) -> pd.DataFrame:
+    """Session table with one row"""
+    return pd.DataFrame(dict(**_get_session_id_columns(session_id), keywords=[list(keywords)]))
+
+
+def make_stim_intervals(
+    stim_name: str, duration: float = 3600.0, n_trials: int = 500, seed: int = 0
+) -> pd.DataFrame:
+    """Trials for a stimulus during its epoch: 'VisRFMapping' and
+    'AudRFMapping' in the 'RFMapping' epoch, or 'OptoTagging'"""
+    rng = np.random.default_rng(seed)
+    epoch = "OptoTagging" if stim_name == "OptoTagging" else "RFMapping"
+    epoch_start, epoch_stop = _get_epoch_interval(duration, epoch)
+    spacing = (epoch_stop - epoch_start) / n_trials
+    start_time = epoch_start + spacing * np.arange(n_trials)
+    if stim_name == "OptoTagging":
+        return pd.DataFrame(dict(start_time=start_time, stop_time=start_time + min(0.01, 0.5 * spacing)))
+    df = pd.DataFrame(
+        dict(
+            start_time=start_time,
+            stim_start_time=start_time + 0.4 * spacing,
+            stop_time=start_time + 0.95 * spacing,
+        )
+    )
+    if stim_name == "VisRFMapping":
+        df["is_small_field_grating"] = rng.random(n_trials) < 0.9
+        df["grating_x"] = rng.choice([-30.0, 0.0, 30.0], n_trials)
+        df["grating_y"] = rng.choice([-20.0, 20.0], n_trials)
+    return df
+
+
+def make_session_tables(
+    session_id: str,
+    n_units: int = 300,
+    n_trials: int = 500,
+    duration: float = 3600.0,
+    seed: int = 0,
+) -> dict[str, pd.DataFrame]:
+    """Tables for one session, for each of `COMPONENTS`, with session ID columns"""
+    trials = make_trials(n_trials, duration, seed=seed)
+    id_columns = _get_session_id_columns(session_id)
+    return dict(
+        session=make_session(session_id),
+        epochs=make_epochs(duration).assign(**id_columns),
+        trials=trials.assign(**id_columns),
+        performance=make_performance(trials, seed=seed).assign(**id_columns),
+        units=make_units(session_id, n_units, duration, seed=seed),
+    )
+
+
+def write_synthetic_cache(
+    root: str | pathlib.Path,
+    n_sessions: int = 2,
+    n_units: int = 300,
+    n_trials: int = 500,
+    duration: float = 3600.0,
+    version: str = SYNTHETIC_VERSION,
+    seed: int = 0,
+) -> list[str]:
+    """Write tables for `n_sessions` synthetic sessions to `root` in the
+    `npc_lims` cache layout, and return their session IDs.
+
+    - each component is written per session, and consolidated across
+      sessions (units without spike times, as in the cache)
+    - use `use_synthetic_cache(root)` to read them with `storage.get_cache_path`
+    """
+    version_dir = pathlib.Path(root) / version
+    session_ids = get_session_ids(n_sessions)
+    consolidated: dict[str, list[pd.DataFrame]] = {c: [] for c in COMPONENTS}
+    for idx, session_id in enumerate(session_ids):
+        tables = make_session_tables(session_id, n_units, n_trials, duration, seed=seed + idx)
+        for component, df in tables.items():
+            (version_dir / component).mkdir(parents=True, exist_ok=True)
+            df.to_parquet(version_dir / component / f"{session_id}.parquet", index=False)
+            consolidated[component].append(
+                df.drop(columns="spike_times") if component == "units" else df
+            )
+    (version_dir / "consolidated").mkdir(parents=True, exist_ok=True)
+    for component, dfs in consolidated.items():
+        pd.concat(dfs, ignore_index=True).to_parquet(
+            version_dir / "consolidated" / f"{component}.parquet", index=False
+        )
+    return session_ids
+
+
+@contextlib.contextmanager
+def use_synthetic_cache(
+    root: str | pathlib.Path,
+    local_cache_dir: str | pathlib.Path | None = None,
+) -> Iterator[pathlib.Path]:
+    """Read the cache from `root` instead of S3 within the context.
+
+    - `utils.LOCAL_CACHE_DIR`, where derived tables, indexes and mirrored
+      files are kept, is also changed, to `local_cache_dir` (default:
+      `<root>/local`), so they're made from the synthetic cache
+    - pass an explicit cache version (e.g. `SYNTHETIC_VERSION`) to functions:
+      the latest version is looked up online
+    """
+    root = pathlib.Path(root)
+    original = storage.CACHE_ROOT, utils.LOCAL_CACHE_DIR
+    storage.set_cache_root(root)
+    utils.LOCAL_CACHE_DIR = pathlib.Path(local_cache_dir or root / "local")
+    try:
+        yield root
+    finally:
+        storage.CACHE_ROOT, utils.LOCAL_CACHE_DIR = original
+
+
+class SyntheticTable:
+    """Minimal stand-in for an NWB `DynamicTable`: `table[:]` returns a
+    dataframe, `table[idx]` selected rows, and columns can be added"""
+
+    def __init__(self, df: pd.DataFrame) -> None:
+        self._df = df
+
+    def __getitem__(self, key: Any) -> pd.DataFrame:
+        if isinstance(key, slice):
+            return self._df.iloc[key]
+        return self._df.iloc[np.atleast_1d(key)]
+
+    def __len__(self) -> int:
+        return len(self._df)
+
+    def to_dataframe(self) -> pd.DataFrame:
+        return self._df
+
+    def add_column(self, name: str, description: str, data: npt.ArrayLike) -> None:
+        self._df[name] = np.asarray(data)
+
+
+class SyntheticSession:
+    """Stand-in for an `npc_sessions` session, with synthetic units, trials and
+    stimulus intervals: enough for the metric functions in `opto` and the
+    tensors in `spike_utils`
+
+    >>> session = SyntheticSession(n_units=5, n_trials=20, duration=300)
+    >>> session.intervals['VisRFMapping'].to_dataframe().columns.tolist()
+    ['start_time', 'stim_start_time', 'stop_time', 'is_small_field_grating', 'grating_x', 'grating_y']
+    """
+
+    def __init__(
+        self,
+        session_id: str | None = None,
+        n_units: int = 300,
+        n_trials: int = 500,
+        duration: float = 3600.0,
+        seed: int = 0,
+    ) -> None:
+        self.id = session_id or get_session_ids(1)[0]
+        tables = make_session_tables(self.id, n_units, n_trials, duration, seed=seed)
+        self.units = SyntheticTable(tables["units"])
+        self.trials = tables["trials"]
+        self.epochs = SyntheticTable(tables["epochs"])
+        self.invalid_times = None
+        self.intervals = {
+            "trials": SyntheticTable(self.trials),
+            **{
+                name: SyntheticTable(make_stim_intervals(name, duration, n_trials, seed=seed))
+                for name in ("VisRFMapping", "AudRFMapping", "OptoTagging")
+            },
+        }
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({self.id!r})"
@@ -0,0 +1,143 @@
+"""Index of where each unit is stored in the per-session units cache.
+
+Finding one unit with a filter on `unit_id` means scanning every session's
+units file. Instead, the location of each unit - its session file, row group
+and row within the row group - is recorded once per cache version and saved in
+`LOCAL_CACHE_DIR`: looking up a unit then reads a single row group of a single
+file, and only the columns requested.
+
+>>> import dynamicrouting_summary.unit_index as unit_index
+>>> df = unit_index.get_units('366122_2023-12-31_A-1', columns=['spike_times'])  # doctest: +SKIP
+"""
+
+from __future__ import annotations
+
+import concurrent.futures
+import functools
+import os
+import pathlib
+from collections.abc import Iterable, Sequence
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+import dynamicrouting_summary.storage as storage
+import dynamicrouting_summary.utils as utils
+
+UNIT_INDEX_DIRNAME = "unit_index"
+
+
+def _get_units_dataset(version: str | None) -> ds.Dataset:
+    # read in place: only the unit_id column is needed
+    return ds.dataset(
+        storage.get_remote_cache_path("units", version=version, consolidated=False)
+    )
+
+
+def _index_fragment(fragment: ds.ParquetFileFragment) -> pd.DataFrame:
+    """Location of each unit in one session file, reading only `unit_id`"""
+    dfs = []
+    for row_group in fragment.split_by_row_group():
+        unit_ids = row_group.to_table(columns=["unit_id"]).column("unit_id")
+        dfs.append(
+            pd.DataFrame(
+                dict(
+                    unit_id=unit_ids.to_numpy(zero_copy_only=False),
+                    file=pathlib.PurePosixPath(fragment.path).name,
+                    row_group=row_group.row_groups[0].id,
+                    row=range(len(unit_ids)),
+                )
+            )
+        )
+    return pd.concat(dfs, ignore_index=True) if dfs else pd.DataFrame()
+
+
+def make_unit_index(
+    dataset: ds.Dataset,
+    max_workers: int | None = None,
+) -> pd.DataFrame:
+    """Make index of unit_id -> file, row_group, row for a dataset of
+    per-session units files. Files are read concurrently in threads."""
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        dfs = list(executor.map(_index_fragment, dataset.get_fragments()))
+    dfs = [df for df in dfs if len(df)]
+    if not dfs:
+        return pd.DataFrame(columns=["unit_id", "file", "row_group", "row"])
+    df = pd.concat(dfs, ignore_index=True)
+    df["file"] = df["file"].astype("category")
+    return df
+
+
+def get_unit_index(version: str | None = None, refresh: bool = False) -> pd.DataFrame:
+    """Get index of unit_id -> file, row_group, row for all units in the cache.
+
+    Made from the `unit_id` column of each session's units file the first time
+    it's requested for a cache version, then saved in `LOCAL_CACHE_DIR` and read
+    from local disk on subsequent calls (unless `refresh` is True).
+    """
+    version = utils.get_cache_version(version)
+    path = utils.LOCAL_CACHE_DIR / UNIT_INDEX_DIRNAME / f"{version}.parquet"
+    if path.exists() and not refresh:
+        return _read_unit_index(path)
+    df = make_unit_index(_get_units_dataset(version))
+    path.parent.mkdir(parents=True, exist_ok=True)
+    df.to_parquet(tmp := path.with_suffix(".tmp"), index=False)
+    os.replace(tmp, path)
+    _read_unit_index.cache_clear()
+    return _read_unit_index(path)
+
+
+@functools.cache
+def _read_unit_index(path: pathlib.Path) -> pd.DataFrame:
+    return pd.read_parquet(path).set_index("unit_id")
+
+
+def get_unit_location(unit_id: str, version: str | None = None) -> tuple[str, int, int]:
+    """Session file, row group and row of a unit in the units cache"""
+    try:
+        location = get_unit_index(version).loc[unit_id]
+    except KeyError:
+        raise KeyError(f"{unit_id!r} not found in units cache {version=}") from None
+    return str(location["file"]), int(location["row_group"]), int(location["row"])
+
+
+def get_units(
+    unit_ids: str | Iterable[str],
+    columns: Sequence[str] | None = None,
+    version: str | None = None,
+) -> pd.DataFrame:
+    """Get rows for units from the units cache, reading only the row groups
+    containing them and only `columns` (default all, including spike times).
+
+    - rows are returned in the order of `unit_ids`
+    - `session_id` (the name of the session's file) is added as a column
+    """
+    if isinstance(unit_ids, str):
+        unit_ids = [unit_ids]
+    unit_ids = list(unit_ids)
+    version = utils.get_cache_version(version)
+    index = get_unit_index(version)
+    if missing := [u for u in unit_ids if u not in index.index]:
+        raise KeyError(f"Units not found in units cache {version=}: {missing}")
+    locations = index.loc[unit_ids].reset_index()
+    if columns is not None and "unit_id" not in columns:
+        columns = [*columns, "unit_id"]
+    tables = []
+    for (file, row_group), rows in locations.groupby(
+        ["file", "row_group"], observed=True, sort=False
+    ):
+        session_id = pathlib.PurePosixPath(file).stem
+        # no dataset discovery: the session's file is opened directly, from the
+        # local mirror if it's already there - otherwise only the row group is
+        # read from the cache, without downloading the whole file
+        path = storage.get_cache_path("units", session_id, version=version, download=False)
+        with path.open("rb") as f:
+            table = pq.ParquetFile(f).read_row_group(row_group, columns=columns)
+        table = table.take(pa.array(rows["row"].to_numpy()))
+        if "session_id" not in table.column_names:
+            table = table.append_column("session_id", pa.array([session_id] * len(table)))
+        tables.append(table)
+    df = pa.concat_tables(tables, promote_options="default").to_pandas()
+    return df.set_index("unit_id", drop=False).loc[unit_ids].reset_index(drop=True)
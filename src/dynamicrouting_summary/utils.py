@@ -1,15 +1,32 @@
+import collections
 import collections.abc
-import contextlib
-import functools
-from typing import Iterator, TypeVar
+import concurrent.futures
+import os
+import pathlib
+import re
+import sys
+import threading
+from typing import TYPE_CHECKING, Iterable, Iterator, Sequence, TypeVar, overload
 
 import npc_lims
+import numpy as np
 import pandas as pd
 import npc_session
 import s3fs
 import random
 
+import dynamicrouting_summary.instrument as instrument
+
+if TYPE_CHECKING:
+    import polars as pl
+
 BEHAVIOR_CRITERIA_THRESHOLD = 1.5
+BEHAVIOR_CRITERIA_MIN_BLOCKS = 4
+SESSION_ID_COLUMNS = ('subject_id', 'date', 'session_idx')
+SESSION_INDEX_DIRNAME = 'session_index'
+LOCAL_CACHE_DIR = pathlib.Path(
+    os.environ.get('DR_SUMMARY_CACHE_DIR', '~/.cache/dynamicrouting_summary')
+).expanduser()
 
 def generate_subject_random_colors(df: pd.DataFrame) -> dict[str, tuple[int, int, int]]:
     colors = set()
@@ -35,43 +52,190 @@ def generate_subject_random_colors(df: pd.DataFrame) -> dict[str, tuple[int, int
     return subject_colors
 
 def is_subject_passing_behavior(subject: str | int | npc_session.SubjectRecord, performace_df: pd.DataFrame) -> bool:
+    """Check if a subject passes behavior criteria, counting passing blocks
+    across all of its sessions - see `make_behavior_pass_table`"""
     subject = npc_session.SubjectRecord(subject)
-    performace_df_subject = performace_df[performace_df['subject_id'] == subject]
-    number_of_blocks_passed = 0
+    # SubjectRecord is an int: subject_id may be stored as int or str
+    performace_df_subject = performace_df[performace_df['subject_id'].astype(str) == str(subject)]
+    table = make_behavior_pass_table(performace_df_subject, by='subject_id')
+    return bool(table['is_passing'].any())
 
-    for block in performace_df_subject['block_index'].unique():
-        intra_dprime = performace_df_subject[performace_df_subject['block_index'] == block]['same_modal_dprime'].sum()
-        inter_dprime = performace_df_subject[performace_df_subject['block_index'] == block]['cross_modal_dprime'].sum()
+def make_behavior_pass_table(
+    performance_df: pd.DataFrame,
+    by: str | Sequence[str] = 'session_id',
+    threshold: float = BEHAVIOR_CRITERIA_THRESHOLD,
+    min_blocks: int = BEHAVIOR_CRITERIA_MIN_BLOCKS,
+    joint: bool = True,
+    inclusive: bool = False,
+) -> pd.DataFrame:
+    """Get passing status for every group in a `performance` table (one row per
+    block), e.g. for every session or every subject, in one groupby pass.
 
-        if intra_dprime > BEHAVIOR_CRITERIA_THRESHOLD and inter_dprime > BEHAVIOR_CRITERIA_THRESHOLD:
-            number_of_blocks_passed += 1
-    
-    return number_of_blocks_passed > 3
+    - a block passes the same-modal or cross-modal criterion if its dprime is
+      above `threshold` (or equal to it, if `inclusive`)
+    - `joint`: a group passes if at least `min_blocks` blocks pass both criteria;
+      otherwise, if at least `min_blocks` blocks pass each criterion separately
+
+    >>> performance_df = pd.DataFrame({
+    ...     'session_id': ['a'] * 4 + ['b'] * 4,
+    ...     'same_modal_dprime': [2, 2, 2, 2, 2, 2, 2, 1],
+    ...     'cross_modal_dprime': [2, 2, 2, 2, 1, 2, 2, 2],
+    ... })
+    >>> make_behavior_pass_table(performance_df)[['session_id', 'n_blocks_passed', 'is_passing']]
+      session_id  n_blocks_passed  is_passing
+    0          a                4        True
+    1          b                2       False
+    >>> make_behavior_pass_table(performance_df, min_blocks=3, joint=False)['is_passing'].tolist()
+    [True, True]
+    """
+    keys = [by] if isinstance(by, str) else list(by)
+    dprime = performance_df[['same_modal_dprime', 'cross_modal_dprime']].to_numpy(dtype=np.float64)
+    # NaN dprime never passes
+    passed = dprime >= threshold if inclusive else dprime > threshold
+    table = (
+        pd.DataFrame({key: performance_df[key].array for key in keys})
+        .assign(
+            n_blocks=1,
+            n_blocks_passed_same_modal=passed[:, 0],
+            n_blocks_passed_cross_modal=passed[:, 1],
+            n_blocks_passed=passed.all(axis=1),
+        )
+        .groupby(keys, observed=True)
+        .sum()
+    )
+    if joint:
+        table['is_passing'] = table['n_blocks_passed'] >= min_blocks
+    else:
+        table['is_passing'] = (
+            (table['n_blocks_passed_same_modal'] >= min_blocks)
+            & (table['n_blocks_passed_cross_modal'] >= min_blocks)
+        )
+    return table.reset_index()
+
+def get_behavior_pass_table(
+    version: str | None = None,
+    by: str | Sequence[str] = 'session_id',
+    threshold: float = BEHAVIOR_CRITERIA_THRESHOLD,
+    min_blocks: int = BEHAVIOR_CRITERIA_MIN_BLOCKS,
+    joint: bool = True,
+    inclusive: bool = False,
+    refresh: bool = False,
+) -> pd.DataFrame:
+    """Get passing status for every session (or subject, with
+    `by='subject_id'`) in the `performance` cache - see
+    `make_behavior_pass_table` for criteria.
+
+    Block dprimes for all sessions are kept as a derived table in
+    `LOCAL_CACHE_DIR`, updated only for sessions that are new or have changed
+    in the cache. See `derived.get_derived_table`.
+    """
+    import dynamicrouting_summary.derived as derived  # derived depends on utils
+
+    performance_df = derived.get_derived_table('performance_dprime', version=version, refresh=refresh)
+    return make_behavior_pass_table(
+        performance_df, by=by, threshold=threshold, min_blocks=min_blocks, joint=joint, inclusive=inclusive,
+    )
+
+def get_cache_version(version: str | None = None) -> str:
+    """Resolve the cache version directory that `npc_lims` reads for `version`:
+    if `version` is None, the latest version in the cache is looked up.
+
+    >>> get_cache_version('0.0.173')
+    'v0.0.173'
+    """
+    path = npc_lims.get_cache_path('session', version=version).as_posix()
+    match = re.search(r"/(v\d+\.\d+\.\d+[^/]*)/", path)
+    if match is None:
+        raise ValueError(f"Could not find cache version in {path!r}")
+    return match.group(1)
+
+
+def get_session_index(version: str | None = None, refresh: bool = False) -> pd.DataFrame:
+    """Get a dataframe with one row per session in the `session` cache:
+    session_id, is_ephys, is_templeton, is_training, is_dynamic_routing, is_opto.
+
+    Saved in `LOCAL_CACHE_DIR` the first time it's requested for a cache
+    version, then read from local disk on subsequent calls, without accessing
+    the cache (unless `refresh` is True).
+
+    For a new cache version, it's made from the `session_index` derived table:
+    only sessions that are new or have changed since a previous version are
+    read, in one dataset scan (all sessions are read if `refresh` is True).
+    See `derived.get_derived_table`.
+    """
+    import dynamicrouting_summary.derived as derived  # derived depends on utils
+
+    version = get_cache_version(version)
+    path = LOCAL_CACHE_DIR / SESSION_INDEX_DIRNAME / f'{version}.parquet'
+    if path.exists() and not refresh:
+        return pd.read_parquet(path)
+    session_index = derived.get_derived_table('session_index', version=version, refresh=refresh)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # unique to each process and thread: prefetch threads can all make the index for a new version
+    tmp_path = path.with_name(f'.{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+    session_index.to_parquet(tmp_path)
+    os.replace(tmp_path, path)
+    return session_index
+
+
+def make_session_index(session_df: pd.DataFrame) -> pd.DataFrame:
+    """Make session index from a `session` table with subject_id, date, session_idx
+    and keywords columns.
+
+    >>> session_df = pd.DataFrame({'subject_id': ['660023'], 'date': ['2023-08-09'], 'session_idx': [0], 'keywords': [['ephys', 'opto']]})
+    >>> make_session_index(session_df).iloc[0]
+    session_id            660023_2023-08-09_0
+    is_ephys                             True
+    is_templeton                        False
+    is_training                         False
+    is_dynamic_routing                   True
+    is_opto                              True
+    Name: 0, dtype: object
+    """
+    keywords = session_df['keywords'].map(lambda k: set(k) if k is not None else set())
+    return pd.DataFrame(
+        dict(
+            session_id = add_session_id_column(session_df)['session_id'].array,
+            is_ephys = keywords.map({'ephys'}.issubset).array,
+            is_templeton = (is_templeton := keywords.map({'Templeton'}.issubset).array),
+            is_training = keywords.map({'training'}.issubset).array,
+            is_dynamic_routing = ~is_templeton,
+            is_opto = keywords.map({'opto'}.issubset).array,
+        )
+    )
 
-@functools.cache
-def get_session_bools_df(version: str | None = None, session_ids:list[str] | None=None) -> pd.DataFrame:
+
+def get_session_bools_df(version: str | None = None, session_ids: Iterable[str] | None = None) -> pd.DataFrame:
     """Get a dataframe with session_id, is_ephys, is_templeton, is_training, is_dynamic_routing columns.
+
+    - see `get_session_index`
     
     >>> get_session_bools_df().columns
     Index(['session_id', 'is_ephys', 'is_templeton', 'is_training',
            'is_dynamic_routing', 'is_opto'],
           dtype='object')
     """
-    session_df = pd.concat(pd.read_parquet(npc_lims.get_cache_path('session', version=version, session_id=session)) for session in session_ids)
-    session_df = add_session_id_column(session_df)
-    bools_df = pd.DataFrame(
-        dict(
-            is_ephys = session_df.keywords.map({'ephys'}.issubset),
-            is_templeton = (is_templeton := session_df.keywords.map({'Templeton'}.issubset)),
-            is_training = session_df.keywords.map({'training'}.issubset),
-            is_dynamic_routing = ~is_templeton,
-            is_opto = session_df.keywords.map({'opto'}.issubset),
-        )
-    )
-    session_bools_df = pd.concat([session_df['session_id'].reset_index(drop=True), bools_df.reset_index(drop=True)], axis=1)
-    return session_bools_df
+    session_index = get_session_index(version=version)
+    if session_ids is not None:
+        session_index = session_index[session_index['session_id'].isin(list(session_ids))]
+    return session_index
+
+
+@overload
+def add_session_id_column(df: 'pl.DataFrame', inplace: bool = False) -> 'pl.DataFrame': ...
 
-def add_session_id_column(df: pd.DataFrame) -> pd.DataFrame:
+
+@overload
+def add_session_id_column(df: 'pl.LazyFrame', inplace: bool = False) -> 'pl.LazyFrame': ...
+
+
+@overload
+def add_session_id_column(df: pd.DataFrame, inplace: bool = False) -> pd.DataFrame: ...
+
+
+def add_session_id_column(
+    df: 'pd.DataFrame | pl.DataFrame | pl.LazyFrame', inplace: bool = False
+) -> 'pd.DataFrame | pl.DataFrame | pl.LazyFrame':
     """
     >>> df = pd.DataFrame({'subject_id': ['660023'], 'date': ['2023-08-09'], 'session_idx': [0]})
     >>> df
@@ -80,10 +244,42 @@ def add_session_id_column(df: pd.DataFrame) -> pd.DataFrame:
     >>> add_session_id_column(df)
         subject_id        date  session_idx           session_id
     0       660023  2023-08-09            0  660023_2023-08-09_0
+
+    - `session_id` is categorical (stored as a dictionary column in Arrow), so
+      ids are only formatted once per session
+    - with `inplace=True` the column is added to `df` without copying it
+    - polars DataFrames and LazyFrames are also accepted (never in place)
     """
-    df_copy = df.copy()
-    df_copy['session_id'] = df.apply(lambda row: f"{row['subject_id']}_{row['date']}_{row['session_idx']}", axis=1)   
-    return df_copy
+    if not isinstance(df, pd.DataFrame):
+        import polars as pl
+
+        return df.with_columns(
+            pl.concat_str(
+                [pl.col(c).cast(pl.Utf8) for c in SESSION_ID_COLUMNS], separator='_'
+            ).cast(pl.Categorical).alias('session_id')
+        )
+    # combine per-column codes into one integer key per row, then format each
+    # distinct key once
+    key = np.zeros(len(df), dtype=np.int64)
+    column_values = []
+    for column in SESSION_ID_COLUMNS:
+        codes, values = pd.factorize(df[column], use_na_sentinel=False)
+        key = key * len(values) + codes
+        column_values.append(values)
+    keys, key_codes = np.unique(key, return_inverse=True)
+    parts: list[list[str]] = []
+    for values in reversed(column_values):
+        keys, codes = np.divmod(keys, max(len(values), 1))
+        parts.insert(0, [str(v) for v in values.take(codes)])
+    # distinct keys can format to the same id, eg. session_idx 0 and '0'
+    session_ids, name_codes = np.unique(
+        np.array(['_'.join(p) for p in zip(*parts)], dtype=object), return_inverse=True
+    )
+    session_id = pd.Categorical.from_codes(name_codes[key_codes], categories=session_ids)
+    if not inplace:
+        return df.assign(session_id=session_id)
+    df['session_id'] = session_id
+    return df
 
 def add_bool_columns(df: pd.DataFrame, version: str | None = None, session_ids:list[str] | None = None) -> pd.DataFrame:
     """
@@ -98,13 +294,36 @@ def add_bool_columns(df: pd.DataFrame, version: str | None = None, session_ids:l
         subject_id        date  session_idx           session_id  is_ephys  is_templeton  is_training  is_dynamic_routing  is_opto
     0       660023  2023-08-09            0  660023_2023-08-09_0      True         False        False                True    False
     """
-    session_bools_df = get_session_bools_df(version=version, session_ids=session_ids)
-    return add_session_id_column(df).merge(session_bools_df, on=['session_id'])  
+    with instrument.stage('session_index'):
+        session_bools_df = get_session_bools_df(version=version, session_ids=session_ids)
+    with instrument.stage('bool_join', rows=len(df)):
+        df = add_session_id_column(df)
+        # share categories so the merge joins on integer codes
+        categories = df['session_id'].cat.categories
+        session_bools_df = session_bools_df[session_bools_df['session_id'].isin(categories)]
+        session_bools_df = session_bools_df.assign(
+            session_id=pd.Categorical(session_bools_df['session_id'], categories=categories)
+        )
+        return df.merge(session_bools_df, on=['session_id'])
 
 K = TypeVar("K")
 V = TypeVar("V")
 
 
+def get_nbytes(value: object) -> int:
+    """Approximate size of an object in memory, including the contents of
+    dataframes and arrays.
+
+    >>> get_nbytes(np.zeros(10))
+    80
+    """
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return int(np.sum(value.memory_usage(deep=True)))
+    if hasattr(value, 'nbytes'):
+        return int(value.nbytes)
+    return sys.getsizeof(value)
+
+
 class LazyDict(collections.abc.Mapping[K, V]):
     """Dict for postponed evaluation of functions and caching of results.
 
@@ -123,16 +342,88 @@ class LazyDict(collections.abc.Mapping[K, V]):
     >>> d = LazyDict(b=(min, (1, 2), {}))
     >>> d['b']
     1
+
+    Thread-safe: concurrent accesses to a key share a single evaluation.
+
+    With `max_bytes`, cached results are evicted least-recently-used first
+    when their total size exceeds the budget, and evaluated again on next access:
+    >>> d = LazyDict(a=(np.zeros, (10,), {}), b=(np.ones, (10,), {}), max_bytes=100)
+    >>> _ = d['a'], d['b']
+    >>> d.loaded_keys
+    ('b',)
+
+    Results can be evaluated in background threads ahead of access with
+    `prefetch`, and dropped from the cache with `invalidate`.
     """
 
-    def __init__(self, *args, **kwargs) -> None:
+    def __init__(self, *args, max_bytes: int | None = None, **kwargs) -> None:
         self._raw_dict = dict(*args, **kwargs)
+        self.max_bytes = max_bytes
+        self._cache: collections.OrderedDict[K, tuple[V, int]] = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._key_locks = {key: threading.Lock() for key in self._raw_dict}
+        self._executor: concurrent.futures.ThreadPoolExecutor | None = None
+
+    @staticmethod
+    def _is_lazy(value: object) -> bool:
+        return isinstance(value, tuple) and len(value) == 3 and callable(value[0])
 
     def __getitem__(self, key) -> V:
-        with contextlib.suppress(TypeError):
-            func, args, *kwargs = self._raw_dict.__getitem__(key)
-            self._raw_dict.__setitem__(key, func(*args, **kwargs[0]))
-        return self._raw_dict.__getitem__(key)
+        raw = self._raw_dict.__getitem__(key)
+        if not self._is_lazy(raw):
+            return raw
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key][0]
+        with self._key_locks[key]:
+            with self._lock:
+                # may have been evaluated by another thread while waiting
+                if key in self._cache:
+                    self._cache.move_to_end(key)
+                    return self._cache[key][0]
+            func, args, kwargs = raw
+            value = func(*args, **kwargs)
+            nbytes = get_nbytes(value) if self.max_bytes is not None else 0
+            with self._lock:
+                self._cache[key] = (value, nbytes)
+                self._evict()
+        return value
+
+    def _evict(self) -> None:
+        if self.max_bytes is None:
+            return
+        while (
+            len(self._cache) > 1
+            and sum(nbytes for _, nbytes in self._cache.values()) > self.max_bytes
+        ):
+            self._cache.popitem(last=False)
+
+    @property
+    def loaded_keys(self) -> tuple[K, ...]:
+        """Keys with evaluated results currently cached, least-recently-used first"""
+        with self._lock:
+            return tuple(self._cache)
+
+    def prefetch(self, keys: Iterable[K] | None = None) -> list[concurrent.futures.Future[V]]:
+        """Start evaluating keys (default all) in background threads.
+
+        Accessing a key before it finishes waits for the same evaluation.
+        """
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    thread_name_prefix=self.__class__.__name__
+                )
+        return [
+            self._executor.submit(self.__getitem__, key)
+            for key in (self._raw_dict if keys is None else keys)
+        ]
+
+    def invalidate(self, key: K) -> None:
+        """Drop the cached result for key, so it's evaluated again on next access"""
+        with self._lock:
+            self._cache.pop(key, None)
 
     def __iter__(self) -> Iterator[K]:
         return iter(self._raw_dict)
@@ -0,0 +1,262 @@
+"""Benchmarks of the package's hot paths on synthetic data, with no S3 access.
+
+Each benchmark is run on a `synthetic.SyntheticSession`, or on a synthetic
+cache of `N_SESSIONS` sessions written to a temporary directory, at one or
+more scales: a scale multiplies the number of units, number of trials and
+session duration of `BASE_SIZES`. The wall time (best of `repeat` runs, after
+one untimed warm-up run that compiles numba functions and fills caches) and
+peak memory allocated during a run are recorded for each.
+
+Not part of the installed package: run from the root of the repository, with
+the package installed, saving results to compare with a later run:
+
+    python -m tests.benchmarks --scales 1 4 --output before.csv
+    python -m tests.benchmarks --scales 1 4 --baseline before.csv
+
+`tests/test_benchmarks.py` runs every benchmark once on a small session.
+"""
+
+from __future__ import annotations
+
+import argparse
+import dataclasses
+import gc
+import pathlib
+import statistics
+import tempfile
+import time
+import tracemalloc
+from collections.abc import Callable, Iterable, Sequence
+from typing import Any
+
+import pandas as pd
+
+import dynamicrouting_summary.binned_counts as binned_counts
+import dynamicrouting_summary.opto as opto
+import dynamicrouting_summary.spike_utils as spike_utils
+import dynamicrouting_summary.synthetic as synthetic
+import dynamicrouting_summary.utils as utils
+
+BASE_SIZES = dict(n_units=300, n_trials=500, duration=3600.0)
+BIN_SIZE = 0.025
+PYRAMID_BIN_SIZES = (0.005, 0.01, 0.025, 0.1)
+N_SESSIONS = 4
+
+
+@dataclasses.dataclass
+class BenchmarkData:
+    """Synthetic data shared by benchmarks at one scale"""
+
+    session: synthetic.SyntheticSession
+    cache_root: pathlib.Path
+    session_ids: list[str]
+    version: str = synthetic.SYNTHETIC_VERSION
+
+
+# a setup function takes the data and returns a function to time: setup isn't timed
+SetupFn = Callable[[BenchmarkData], Callable[[], Any]]
+BENCHMARKS: dict[str, SetupFn] = {}
+
+
+def benchmark(name: str) -> Callable[[SetupFn], SetupFn]:
+    """Decorator to register a benchmark setup function"""
+
+    def decorator(setup: SetupFn) -> SetupFn:
+        BENCHMARKS[name] = setup
+        return setup
+
+    return decorator
+
+
+@benchmark("get_spike_counts_in_intervals")
+def _setup_spike_counts(data: BenchmarkData) -> Callable[[], Any]:
+    session = data.session
+    units = session.units[:]
+    intervals = list(zip(session.trials.stim_start_time, session.trials.stim_start_time + 0.5))
+    return lambda: opto.get_spike_counts_in_intervals(session, intervals, unit_selection=units)
+
+
+@benchmark("make_neuron_time_trials_tensor")
+def _setup_trials_tensor(data: BenchmarkData) -> Callable[[], Any]:
+    units, trials = data.session.units[:], data.session.trials
+    return lambda: spike_utils.make_neuron_time_trials_tensor(
+        units, None, trials, 0.5, 1.0, BIN_SIZE
+    )
+
+
+@benchmark("make_timebins_table")
+def _setup_timebins_table(data: BenchmarkData) -> Callable[[], Any]:
+    trials = data.session.trials
+    return lambda: spike_utils.make_timebins_table(trials, BIN_SIZE)
+
+
+@benchmark("make_neuron_timebins_matrix")
+def _setup_timebins_matrix(data: BenchmarkData) -> Callable[[], Any]:
+    units, trials = data.session.units[:], data.session.trials
+    return lambda: spike_utils.make_neuron_timebins_matrix(units, trials, BIN_SIZE)
+
+
+@benchmark("add_bool_columns")
+def _setup_bool_columns(data: BenchmarkData) -> Callable[[], Any]:
+    # all sessions' trials: one row per trial, as in the consolidated table
+    trials = pd.read_parquet(
+        data.cache_root / data.version / "consolidated" / "trials.parquet",
+        columns=list(utils.SESSION_ID_COLUMNS),
+    )
+    return lambda: utils.add_bool_columns(trials, version=data.version)
+
+
+@benchmark("get_population_rate_drift")
+def _setup_rate_drift(data: BenchmarkData) -> Callable[[], Any]:
+    epochs = utils.add_session_id_column(
+        pd.read_parquet(data.cache_root / data.version / "consolidated" / "epochs.parquet")
+    )
+    return lambda: spike_utils.get_population_rate_drift(epochs, version=data.version)
+
+
+@benchmark("write_binned_counts")
+def _setup_write_binned_counts(data: BenchmarkData) -> Callable[[], Any]:
+    units = data.session.units[:]
+    path = data.cache_root / binned_counts.BINNED_COUNTS_DIRNAME
+    return lambda: binned_counts.write_binned_counts(path, units["unit_id"], units["spike_times"])
+
+
+@benchmark("binned_counts_pyramid")
+def _setup_binned_counts_pyramid(data: BenchmarkData) -> Callable[[], Any]:
+    # counts at each bin size from the same cumulative counts, as rows of a
+    # timebins matrix and around each trial's stimulus, as in a trials tensor
+    units, trials = data.session.units[:], data.session.trials
+    counts = binned_counts.write_binned_counts(
+        data.cache_root / binned_counts.BINNED_COUNTS_DIRNAME,
+        units["unit_id"],
+        units["spike_times"],
+    )
+
+    def fn() -> None:
+        for bin_size in PYRAMID_BIN_SIZES:
+            counts.get_counts(bin_size)
+            counts.get_event_aligned_counts(trials.stim_start_time, 0.5, 1.0, bin_size)
+
+    return fn
+
+
+def get_sizes(scale: float) -> dict[str, Any]:
+    """`BASE_SIZES` multiplied by `scale`"""
+    return dict(
+        n_units=max(1, round(BASE_SIZES["n_units"] * scale)),
+        n_trials=max(1, round(BASE_SIZES["n_trials"] * scale)),
+        duration=BASE_SIZES["duration"] * scale,
+    )
+
+
+def measure(fn: Callable[[], Any], repeat: int = 3) -> dict[str, float]:
+    """Time `fn` (after one warm-up call) and trace its peak memory allocation.
+
+    - memory is traced in a separate call, as tracing slows Python code:
+      allocations made through Python and numpy (including arrays allocated in
+      numba functions) are traced, but not pyarrow's memory pool
+    """
+    fn()
+    seconds = []
+    for _ in range(repeat):
+        gc.collect()
+        t0 = time.perf_counter()
+        fn()
+        seconds.append(time.perf_counter() - t0)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return dict(
+        seconds=min(seconds),
+        seconds_median=statistics.median(seconds),
+        peak_mb=peak / 1e6,
+    )
+
+
+def run_benchmarks(
+    names: Iterable[str] | None = None,
+    scales: Iterable[float] = (1,),
+    repeat: int = 3,
+    tmp_dir: str | pathlib.Path | None = None,
+    seed: int = 0,
+) -> pd.DataFrame:
+    """Run benchmarks at each scale and return a table of results, with one row
+    per benchmark per scale.
+
+    - `names`: benchmarks in `BENCHMARKS` to run (default all)
+    - `tmp_dir`: where synthetic caches are written (default: a temporary
+      directory, removed afterwards)
+    """
+    names = list(BENCHMARKS) if names is None else list(names)
+    if unknown := set(names) - set(BENCHMARKS):
+        raise ValueError(f"Unknown benchmarks {unknown}: expected some of {tuple(BENCHMARKS)}")
+    records = []
+    for scale in scales:
+        sizes = get_sizes(scale)
+        with tempfile.TemporaryDirectory(dir=tmp_dir) as root:
+            session_ids = synthetic.write_synthetic_cache(
+                root, n_sessions=N_SESSIONS, **sizes, seed=seed
+            )
+            data = BenchmarkData(
+                session=synthetic.SyntheticSession(**sizes, seed=seed),
+                cache_root=pathlib.Path(root),
+                session_ids=session_ids,
+            )
+            with synthetic.use_synthetic_cache(root):
+                for name in names:
+                    fn = BENCHMARKS[name](data)
+                    records.append(
+                        dict(benchmark=name, scale=scale, **sizes, **measure(fn, repeat))
+                    )
+    return pd.DataFrame.from_records(records)
+
+
+def compare(results: pd.DataFrame, baseline: pd.DataFrame) -> pd.DataFrame:
+    """Results joined with a baseline run on benchmark and scale, with the
+    ratio of time and memory to the baseline (< 1 is an improvement)"""
+    df = results.merge(
+        baseline[["benchmark", "scale", "seconds", "peak_mb"]],
+        on=["benchmark", "scale"],
+        how="left",
+        suffixes=("", "_baseline"),
+    )
+    df["seconds_ratio"] = df["seconds"] / df["seconds_baseline"]
+    df["peak_mb_ratio"] = df["peak_mb"] / df["peak_mb_baseline"]
+    return df
+
+
+def main(argv: Sequence[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Benchmark hot paths on synthetic sessions, without access to the cache."
+    )
+    parser.add_argument(
+        "--benchmarks", nargs="+", choices=tuple(BENCHMARKS), help="default: all"
+    )
+    parser.add_argument(
+        "--scales",
+        nargs="+",
+        type=float,
+        default=[1.0],
+        help=f"multiples of the base number of units, trials and duration {BASE_SIZES}",
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per benchmark")
+    parser.add_argument("--output", type=pathlib.Path, help="save results as csv")
+    parser.add_argument(
+        "--baseline", type=pathlib.Path, help="csv from a previous run to compare results with"
+    )
+    args = parser.parse_args(argv)
+    df = run_benchmarks(args.benchmarks, scales=args.scales, repeat=args.repeat)
+    if args.output:
+        df.to_csv(args.output, index=False)
+    if args.baseline:
+        df = compare(df, pd.read_csv(args.baseline))
+    with pd.option_context("display.width", 200, "display.max_columns", None):
+        print(df.round(4).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+from __future__ import annotations
+
+import functools
+import pathlib
+import shutil
+from collections.abc import Callable, Iterator
+
+import pytest
+
+import dynamicrouting_summary.synthetic as synthetic
+
+N_SESSIONS = 3
+SIZES = dict(n_units=20, n_trials=60, duration=600.0)
+
+
+@pytest.fixture(scope="session")
+def synthetic_root(tmp_path_factory: pytest.TempPathFactory) -> pathlib.Path:
+    """Synthetic cache shared by all tests: read-only"""
+    root = tmp_path_factory.mktemp("synthetic")
+    synthetic.write_synthetic_cache(root, n_sessions=N_SESSIONS, **SIZES)
+    return root
+
+
+@pytest.fixture
+def synthetic_cache(synthetic_root: pathlib.Path, tmp_path: pathlib.Path) -> Iterator[list[str]]:
+    """Read the synthetic cache within a test, with a fresh local cache
+    directory, and return its session IDs"""
+    with synthetic.use_synthetic_cache(synthetic_root, local_cache_dir=tmp_path / "local"):
+        yield synthetic.get_session_ids(N_SESSIONS)
+
+
+@pytest.fixture
+def writable_synthetic_cache(
+    synthetic_root: pathlib.Path, tmp_path: pathlib.Path
+) -> Iterator[pathlib.Path]:
+    """Read a copy of the synthetic cache within a test, for tests that change
+    files in it, and return its root"""
+    root = tmp_path / "synthetic"
+    shutil.copytree(synthetic_root, root)
+    with synthetic.use_synthetic_cache(root, local_cache_dir=tmp_path / "local"):
+        yield root
+
+
+@pytest.fixture(scope="session")
+def session() -> synthetic.SyntheticSession:
+    return synthetic.SyntheticSession(**SIZES)
+
+
+@pytest.fixture
+def make_session() -> Callable[[], synthetic.SyntheticSession]:
+    """Make a new synthetic session, for tests that add columns to units"""
+    return lambda: synthetic.SyntheticSession(**SIZES)
+
+
+@pytest.fixture(scope="session")
+def session_factory() -> Callable[[str], synthetic.SyntheticSession]:
+    """Make a synthetic session from a session ID: can be sent to worker
+    processes"""
+    return functools.partial(synthetic.SyntheticSession, **SIZES)
@@ -0,0 +1,65 @@
+from __future__ import annotations
+
+import functools
+import json
+
+import pandas as pd
+
+import dynamicrouting_summary.batch as batch
+import dynamicrouting_summary.synthetic as synthetic
+
+
+def _read_manifest_lines(output_dir) -> list[dict]:
+    with open(output_dir / batch.MANIFEST_FILENAME) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_run_batch_resumes_and_recomputes_changed_sessions(tmp_path, session_factory) -> None:
+    session_ids = synthetic.get_session_ids(2)
+
+    def run(fingerprints):
+        return batch.run_batch(
+            tmp_path,
+            session_ids=session_ids,
+            metrics=["opto"],
+            max_workers=1,
+            session_factory=session_factory,
+            fingerprints=fingerprints,
+            progress=False,
+        )
+
+    df = run({session_id: "a" for session_id in session_ids})
+    assert [r["status"] for r in _read_manifest_lines(tmp_path)] == ["done", "done"]
+    assert sorted(df["session_id"].unique()) == session_ids
+    assert {"unit_id", "opto_response", "opto_latency", "opto_latency_jitter"} <= set(df.columns)
+    expected = session_factory(session_ids[0]).units[:]["unit_id"].tolist()
+    assert df.query("session_id == @session_ids[0]")["unit_id"].tolist() == expected
+
+    # unchanged: both shards are reused
+    shard = tmp_path / batch.SHARDS_DIRNAME / f"{session_ids[0]}.parquet"
+    mtime = shard.stat().st_mtime_ns
+    pd.testing.assert_frame_equal(run({session_id: "a" for session_id in session_ids}), df)
+    assert len(_read_manifest_lines(tmp_path)) == 2
+    assert shard.stat().st_mtime_ns == mtime
+
+    # source of one session changed: only that session is recomputed
+    rerun = run({session_ids[0]: "a", session_ids[1]: "b"})
+    records = _read_manifest_lines(tmp_path)
+    assert [(r["session_id"], r["fingerprint"]) for r in records[2:]] == [(session_ids[1], "b")]
+    assert shard.stat().st_mtime_ns == mtime
+    pd.testing.assert_frame_equal(rerun, df)
+
+
+def test_run_batch_records_failures_and_retries(tmp_path, session_factory) -> None:
+    session_id = synthetic.get_session_ids(1)[0]
+    kwargs = dict(session_ids=[session_id], metrics=["opto"], max_workers=1, progress=False)
+    # fails in the worker, without stopping the batch
+    failing_factory = functools.partial(synthetic.SyntheticSession, n_units=-1)
+    df = batch.run_batch(tmp_path, session_factory=failing_factory, **kwargs)
+    assert df.empty
+    assert batch.read_manifest(tmp_path)[session_id]["status"] == "error"
+    assert batch.get_completed_session_ids(tmp_path) == set()
+
+    df = batch.run_batch(tmp_path, session_factory=session_factory, **kwargs)
+    assert batch.read_manifest(tmp_path)[session_id]["status"] == "done"
+    assert len(df) == len(session_factory(session_id).units)
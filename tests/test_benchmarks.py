@@ -0,0 +1,42 @@
+from __future__ import annotations
+
+import pathlib
+
+import pytest
+
+import dynamicrouting_summary.synthetic as synthetic
+import tests.benchmarks as benchmarks
+
+
+@pytest.fixture
+def data(
+    session: synthetic.SyntheticSession, writable_synthetic_cache: pathlib.Path
+) -> benchmarks.BenchmarkData:
+    session_dir = writable_synthetic_cache / synthetic.SYNTHETIC_VERSION / "session"
+    return benchmarks.BenchmarkData(
+        session=session,
+        cache_root=writable_synthetic_cache,
+        session_ids=sorted(path.stem for path in session_dir.glob("*.parquet")),
+    )
+
+
+@pytest.mark.parametrize("name", list(benchmarks.BENCHMARKS))
+def test_benchmark_runs(data: benchmarks.BenchmarkData, name: str) -> None:
+    fn = benchmarks.BENCHMARKS[name](data)
+    fn()
+
+
+def test_run_benchmarks(tmp_path: pathlib.Path) -> None:
+    names = ["make_timebins_table", "write_binned_counts"]
+    df = benchmarks.run_benchmarks(names, scales=[0.05], repeat=1, tmp_dir=tmp_path)
+    assert df["benchmark"].tolist() == names
+    assert (df[["seconds", "peak_mb"]] > 0).all(axis=None)
+    assert df.iloc[0][["n_units", "n_trials", "duration"]].tolist() == [15, 25, 180.0]
+
+    compared = benchmarks.compare(df, df)
+    assert (compared[["seconds_ratio", "peak_mb_ratio"]] == 1).all(axis=None)
+
+
+def test_run_benchmarks_unknown_name() -> None:
+    with pytest.raises(ValueError, match="Unknown benchmarks"):
+        benchmarks.run_benchmarks(["not_a_benchmark"])
@@ -0,0 +1,97 @@
+from __future__ import annotations
+
+import pathlib
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import dynamicrouting_summary.binned_counts as binned_counts
+import dynamicrouting_summary.spike_utils as spike_utils
+import dynamicrouting_summary.synthetic as synthetic
+import dynamicrouting_summary.utils as utils
+
+BIN_SIZE = 0.025
+# fraction of bins allowed to differ (by one spike) from the tensor for event
+# times off the 1 ms grid: a spike moves to a neighbouring bin if it's within
+# 0.5 ms of an edge of a 25 ms bin
+OFF_GRID_TOLERANCE = 0.01
+
+
+@pytest.fixture
+def counts(
+    session: synthetic.SyntheticSession, tmp_path: pathlib.Path
+) -> binned_counts.BinnedCounts:
+    units = session.units[:]
+    return binned_counts.write_binned_counts(
+        tmp_path / "binned_counts", units["unit_id"], units["spike_times"]
+    )
+
+
+@pytest.mark.parametrize("on_grid", [True, False])
+def test_event_aligned_counts_match_tensor(
+    session: synthetic.SyntheticSession, counts: binned_counts.BinnedCounts, on_grid: bool
+) -> None:
+    trials = session.trials.copy()
+    if on_grid:
+        trials["stim_start_time"] = trials["stim_start_time"].round(3)
+    # windows extending past the start and end of the recording
+    trials.loc[trials.index[0], "stim_start_time"] = 0.2
+    trials.loc[trials.index[-1], "stim_start_time"] = counts.stop_time - 0.3
+    tensor = spike_utils.make_neuron_time_trials_tensor(
+        session.units[:], None, trials, 0.5, 1.0, BIN_SIZE
+    )
+    expected = np.round(tensor.to_numpy() * BIN_SIZE).astype(np.int64)
+
+    result, bin_centers = counts.get_event_aligned_counts(
+        trials["stim_start_time"], 0.5, 1.0, BIN_SIZE
+    )
+    np.testing.assert_allclose(bin_centers, tensor["time"].to_numpy())
+    assert result.shape == expected.shape
+    diff = result.astype(np.int64) - expected
+    if on_grid:
+        np.testing.assert_array_equal(diff, 0)
+    else:
+        assert np.abs(diff).max() <= 1
+        assert np.mean(diff != 0) < OFF_GRID_TOLERANCE
+    # events at the edges of the recording are on the grid either way
+    np.testing.assert_array_equal(diff[..., [0, -1]], 0)
+
+
+def test_window_counts(
+    session: synthetic.SyntheticSession, counts: binned_counts.BinnedCounts
+) -> None:
+    units = session.units[:]
+    starts, stops = np.array([0.0, 10.0, 599.5]), np.array([5.0, 10.0, 700.0])
+    expected = [
+        [np.count_nonzero((times >= start) & (times < stop)) for start, stop in zip(starts, stops)]
+        for times in units["spike_times"]
+    ]
+    np.testing.assert_array_equal(counts.get_window_counts(starts, stops), expected)
+
+
+def test_window_counts_stop_before_start(counts: binned_counts.BinnedCounts) -> None:
+    with pytest.raises(ValueError, match="stop before they start"):
+        counts.get_window_counts([10.0, 20.0], [15.0, 19.0])
+
+
+def test_get_binned_counts_resolves_version_once(
+    synthetic_cache, synthetic_root, monkeypatch
+) -> None:
+    calls = []
+    get_cache_version = utils.get_cache_version
+
+    def latest_version(version=None):
+        calls.append(version)
+        return get_cache_version(synthetic.SYNTHETIC_VERSION if version is None else version)
+
+    monkeypatch.setattr(utils, "get_cache_version", latest_version)
+    counts = binned_counts.get_binned_counts(synthetic_cache[0])
+    assert calls.count(None) == 1
+    assert counts.path == binned_counts.get_binned_counts_path(
+        synthetic_cache[0], synthetic.SYNTHETIC_VERSION
+    )
+    units = pd.read_parquet(
+        synthetic_root / synthetic.SYNTHETIC_VERSION / "units" / f"{synthetic_cache[0]}.parquet"
+    )
+    assert counts.unit_ids.tolist() == units["unit_id"].tolist()
@@ -0,0 +1,106 @@
+from __future__ import annotations
+
+import threading
+import time
+
+import pandas as pd
+import pyarrow.dataset as ds
+import pytest
+
+import dynamicrouting_summary.dataframes as dataframes
+import dynamicrouting_summary.synthetic as synthetic
+import dynamicrouting_summary.utils as utils
+
+VERSION = synthetic.SYNTHETIC_VERSION
+
+
+@pytest.fixture
+def consolidated(synthetic_cache, synthetic_root) -> dict[str, pd.DataFrame]:
+    """Tables in the synthetic cache, read directly"""
+    root = synthetic_root / VERSION / "consolidated"
+    return {
+        component: pd.read_parquet(root / f"{component}.parquet")
+        for component in ("trials", "epochs")
+    }
+
+
+def test_get_dfs_without_bool_columns(consolidated) -> None:
+    dfs = dataframes.get_dfs(VERSION, with_bool_columns=False, components=["trials", "epochs"])
+    assert list(dfs) == ["trials", "epochs"]
+    for component, expected in consolidated.items():
+        pd.testing.assert_frame_equal(dfs[component], expected)
+
+
+def test_get_dfs_columns(consolidated) -> None:
+    dfs = dataframes.get_dfs(
+        VERSION,
+        with_bool_columns=False,
+        components=["trials", "epochs"],
+        columns={"trials": ["start_time", "is_vis_stim"]},
+    )
+    pd.testing.assert_frame_equal(
+        dfs["trials"], consolidated["trials"][["start_time", "is_vis_stim"]]
+    )
+    pd.testing.assert_frame_equal(dfs["epochs"], consolidated["epochs"])
+
+    # session ID columns are read to add bool columns
+    trials = dataframes.get_dfs(VERSION, components=["trials"], columns=["start_time"])["trials"]
+    assert list(trials.columns) == [
+        "start_time",
+        *utils.SESSION_ID_COLUMNS,
+        "session_id",
+        "is_ephys",
+        "is_templeton",
+        "is_training",
+        "is_dynamic_routing",
+        "is_opto",
+    ]
+    assert len(trials) == len(consolidated["trials"])
+
+
+def test_get_dfs_filters(synthetic_cache, consolidated) -> None:
+    subject_id, date = synthetic_cache[1].split("_")
+    dfs = dataframes.get_dfs(
+        VERSION,
+        with_bool_columns=False,
+        components=["trials", "epochs"],
+        filters={"trials": (ds.field("subject_id") == subject_id) & (ds.field("date") == date)},
+    )
+    trials = consolidated["trials"]
+    expected = trials[(trials["subject_id"] == subject_id) & (trials["date"] == date)]
+    assert 0 < len(expected) < len(trials)
+    pd.testing.assert_frame_equal(dfs["trials"], expected.reset_index(drop=True))
+    pd.testing.assert_frame_equal(dfs["epochs"], consolidated["epochs"])
+
+    # the same filter for every component
+    dfs = dataframes.get_dfs(
+        VERSION,
+        with_bool_columns=False,
+        components=["trials", "epochs"],
+        filters=ds.field("subject_id") == subject_id,
+    )
+    assert (dfs["trials"]["subject_id"] == subject_id).all()
+    assert (dfs["epochs"]["subject_id"] == subject_id).all()
+
+
+def test_get_dfs_prefetch(synthetic_cache, monkeypatch) -> None:
+    calls = []
+    lock = threading.Lock()
+    read_component = dataframes._read_component
+
+    def counting_read_component(component, *args, **kwargs):
+        with lock:
+            calls.append(component)
+        return read_component(component, *args, **kwargs)
+
+    monkeypatch.setattr(dataframes, "_read_component", counting_read_component)
+    components = ["trials", "epochs", "performance"]
+    dfs = dataframes.get_dfs(VERSION, components=components, prefetch=True)
+    # read in the background, without accessing the dataframes
+    deadline = time.monotonic() + 30
+    while len(calls) < len(components) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert sorted(calls) == sorted(components)
+    for component in components:
+        assert len(dfs[component])
+    assert sorted(calls) == sorted(components)
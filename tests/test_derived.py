@@ -0,0 +1,139 @@
+from __future__ import annotations
+
+import concurrent.futures
+import time
+
+import pandas as pd
+import pytest
+
+import dynamicrouting_summary.derived as derived
+import dynamicrouting_summary.synthetic as synthetic
+import dynamicrouting_summary.utils as utils
+
+VERSION = synthetic.SYNTHETIC_VERSION
+
+
+@pytest.fixture
+def transform_calls(monkeypatch) -> list[pd.DataFrame]:
+    """Sources passed to the session_index transform"""
+    calls = []
+    table = derived.DERIVED_TABLES["session_index"]
+
+    def transform(df: pd.DataFrame) -> pd.DataFrame:
+        calls.append(df)
+        return table.transform(df)
+
+    monkeypatch.setitem(
+        derived.DERIVED_TABLES,
+        "session_index",
+        derived.DerivedTable(
+            table.name, table.component, transform=transform, columns=table.columns
+        ),
+    )
+    return calls
+
+
+def _get_expected_session_index(root) -> pd.DataFrame:
+    session_df = pd.read_parquet(root / VERSION / "consolidated" / "session.parquet")
+    return utils.make_session_index(session_df).astype({"session_id": str})
+
+
+def test_update_derived_table_skips_unchanged_sessions(synthetic_cache, transform_calls) -> None:
+    assert sorted(derived.update_derived_table("session_index", version=VERSION)) == synthetic_cache
+    assert len(transform_calls) == len(synthetic_cache)
+    assert derived.update_derived_table("session_index", version=VERSION) == []
+    assert len(transform_calls) == len(synthetic_cache)
+    assert set(derived.read_manifest("session_index")) == set(synthetic_cache)
+    assert derived.update_derived_table("session_index", version=VERSION, refresh=True)
+    assert len(transform_calls) == 2 * len(synthetic_cache)
+
+
+def test_update_derived_table_recomputes_changed_source(
+    writable_synthetic_cache, transform_calls
+) -> None:
+    derived.update_derived_table("session_index", version=VERSION)
+    manifest = derived.read_manifest("session_index")
+    session_ids = sorted(manifest)
+
+    time.sleep(0.01)  # fingerprints of local files include mtime
+    changed = session_ids[1]
+    synthetic.make_session(changed, keywords=["training"]).to_parquet(
+        writable_synthetic_cache / VERSION / "session" / f"{changed}.parquet", index=False
+    )
+    assert derived.update_derived_table("session_index", version=VERSION) == [changed]
+    assert derived.read_manifest("session_index")[changed] != manifest[changed]
+
+    df = derived.get_derived_table("session_index", version=VERSION).set_index("session_id")
+    assert df.loc[f"{changed}_0", "is_training"]
+    assert not df.drop(index=f"{changed}_0")["is_training"].any()
+
+
+def test_scanned_table_matches_consolidated(synthetic_cache, synthetic_root) -> None:
+    df = derived.get_derived_table("session_index", version=VERSION)
+    pd.testing.assert_frame_equal(
+        df.astype({"session_id": str}), _get_expected_session_index(synthetic_root)
+    )
+
+
+def test_get_session_index_reads_local_copy_without_cache(
+    synthetic_cache, synthetic_root, monkeypatch
+) -> None:
+    expected = _get_expected_session_index(synthetic_root)
+    df = utils.get_session_index(version=VERSION)
+    pd.testing.assert_frame_equal(df.astype({"session_id": str}), expected)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("cache accessed")
+
+    monkeypatch.setattr(derived, "get_source_fingerprints", fail)
+    monkeypatch.setattr(derived, "_scan_sources", fail)
+    pd.testing.assert_frame_equal(utils.get_session_index(version=VERSION), df)
+    bools = utils.add_bool_columns(
+        pd.DataFrame({"subject_id": ["900000"], "date": ["2024-01-01"], "session_idx": [0]}),
+        version=VERSION,
+    )
+    assert bools["is_ephys"].tolist() == [True]
+
+
+def test_combined_tables_for_session_subsets(synthetic_cache, synthetic_root) -> None:
+    expected = _get_expected_session_index(synthetic_root)
+    subsets = [synthetic_cache[:1], synthetic_cache[1:], synthetic_cache]
+    for session_ids in subsets:
+        derived.get_derived_table("session_index", version=VERSION, session_ids=session_ids)
+    table = derived.DERIVED_TABLES["session_index"]
+    assert len(list(table.path.glob("session_index_*.parquet"))) == len(subsets)
+
+    for session_ids in subsets:
+        df = derived.get_derived_table("session_index", version=VERSION, session_ids=session_ids)
+        pd.testing.assert_frame_equal(
+            df.astype({"session_id": str}),
+            expected[expected["session_id"].str.rsplit("_", n=1).str[0].isin(session_ids)]
+            .reset_index(drop=True),
+        )
+
+
+def test_concurrent_get_derived_table(synthetic_cache, synthetic_root) -> None:
+    expected = _get_expected_session_index(synthetic_root)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        futures = [
+            executor.submit(
+                derived.get_derived_table, "session_index", version=VERSION, refresh=True
+            )
+            for _ in range(16)
+        ]
+        for future in futures:
+            pd.testing.assert_frame_equal(future.result().astype({"session_id": str}), expected)
+    table = derived.DERIVED_TABLES["session_index"]
+    assert not list(table.path.rglob("*.tmp"))
+
+
+def test_concurrent_get_session_index(synthetic_cache, synthetic_root) -> None:
+    expected = _get_expected_session_index(synthetic_root)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        futures = [
+            executor.submit(utils.get_session_index, version=VERSION, refresh=True)
+            for _ in range(16)
+        ]
+        for future in futures:
+            pd.testing.assert_frame_equal(future.result().astype({"session_id": str}), expected)
+    assert not list((utils.LOCAL_CACHE_DIR / utils.SESSION_INDEX_DIRNAME).glob("*.tmp"))
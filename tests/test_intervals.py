@@ -0,0 +1,95 @@
+from __future__ import annotations
+
+import numpy as np
+import pytest
+
+from dynamicrouting_summary.intervals import IntervalArray
+
+# integer times, so that intervals often touch or share edges: coverage is
+# checked at midpoints between integers
+MAX_TIME = 30
+MIDPOINTS = np.arange(-1, MAX_TIME + 1) + 0.5
+
+
+def _random_intervals(seed: int, n: int) -> np.ndarray:
+    """Unsorted intervals with integer start and stop times"""
+    rng = np.random.default_rng(seed)
+    starts = rng.integers(0, MAX_TIME - 1, n)
+    return np.column_stack([starts, starts + rng.integers(1, 6, n)]).astype(float)
+
+
+def _is_covered(intervals: np.ndarray, times: np.ndarray) -> np.ndarray:
+    return np.array([any(a < t < b for a, b in intervals) for t in times], dtype=bool)
+
+
+def _assert_sorted_disjoint(intervals: IntervalArray) -> None:
+    assert np.all(intervals.starts < intervals.stops)
+    # touching intervals are merged
+    assert np.all(intervals.starts[1:] > intervals.stops[:-1])
+
+
+@pytest.fixture(params=range(5))
+def seed(request: pytest.FixtureRequest) -> int:
+    return request.param
+
+
+def test_overlaps(seed: int) -> None:
+    a, b = _random_intervals(seed, 20), _random_intervals(seed + 100, 8)
+    expected = [any(a0 < b1 and b0 < a1 for b0, b1 in b) for a0, a1 in a]
+    np.testing.assert_array_equal(IntervalArray(a).overlaps(b), expected)
+
+
+def test_is_within(seed: int) -> None:
+    a, b = _random_intervals(seed, 20), _random_intervals(seed + 100, 8)
+    expected = [any(b0 <= a0 and a1 <= b1 for b0, b1 in b) for a0, a1 in a]
+    np.testing.assert_array_equal(IntervalArray(a).is_within(b), expected)
+
+
+def test_union(seed: int) -> None:
+    a, b = _random_intervals(seed, 10), _random_intervals(seed + 100, 10)
+    result = IntervalArray(a).union(b)
+    _assert_sorted_disjoint(result)
+    np.testing.assert_array_equal(
+        _is_covered(result.values, MIDPOINTS), _is_covered(np.concatenate([a, b]), MIDPOINTS)
+    )
+
+
+def test_intersection(seed: int) -> None:
+    a, b = _random_intervals(seed, 10), _random_intervals(seed + 100, 10)
+    result = IntervalArray(a).intersection(b)
+    _assert_sorted_disjoint(result)
+    np.testing.assert_array_equal(
+        _is_covered(result.values, MIDPOINTS),
+        _is_covered(a, MIDPOINTS) & _is_covered(b, MIDPOINTS),
+    )
+
+
+def test_complement(seed: int) -> None:
+    a = _random_intervals(seed, 10)
+    start, stop = 3.0, MAX_TIME - 3.0
+    result = IntervalArray(a).complement(start, stop)
+    _assert_sorted_disjoint(result)
+    assert np.all((result.starts >= start) & (result.stops <= stop))
+    in_range = (MIDPOINTS > start) & (MIDPOINTS < stop)
+    np.testing.assert_array_equal(
+        _is_covered(result.values, MIDPOINTS), in_range & ~_is_covered(a, MIDPOINTS)
+    )
+
+
+def test_touching_intervals() -> None:
+    intervals = IntervalArray([(2, 3), (0, 1), (1, 2)])
+    assert not intervals.has_overlap()
+    np.testing.assert_array_equal(intervals.overlaps([(1, 2)]), [False, False, True])
+    np.testing.assert_array_equal(intervals.is_within([(0, 2)]), [False, True, True])
+    assert intervals.union().values.tolist() == [[0.0, 3.0]]
+    assert len(intervals.intersection([(3, 4)])) == 0
+    assert intervals.complement(-1, 4).values.tolist() == [[-1.0, 0.0], [3.0, 4.0]]
+
+
+def test_array_copy() -> None:
+    intervals = IntervalArray([(0, 1), (2, 3)])
+    assert not np.asarray(intervals).flags.writeable
+    values = np.array(intervals, copy=True)
+    values[0, 0] = -1
+    assert intervals[0] == (0.0, 1.0)
+    assert np.asarray(intervals, dtype=np.float32).dtype == np.float32
@@ -0,0 +1,149 @@
+from __future__ import annotations
+
+import warnings
+
+import numpy as np
+import pandas as pd
+
+import dynamicrouting_summary.opto as opto
+
+METRIC_COLUMNS = ("opto_response", "opto_latency", "opto_latency_jitter")
+
+
+def _add_opto_metrics(session, unit_selection=None) -> None:
+    trials = session.intervals["OptoTagging"].to_dataframe()
+    with warnings.catch_warnings():
+        # all-NaN rows for units with no valid events
+        warnings.simplefilter("ignore", RuntimeWarning)
+        opto.add_response_latency_metrics(
+            session,
+            name="opto",
+            event_times=trials.start_time,
+            baseline_intervals=zip(trials.start_time - opto.OPTO_RESP_WINDOW, trials.start_time),
+            min_latency=opto.OPTO_MIN_RESP_LATENCY,
+            window=opto.OPTO_RESP_WINDOW,
+            description="optotagging laser stimulus",
+            unit_selection=unit_selection,
+        )
+
+
+def test_add_response_latency_metrics_unit_selection(make_session) -> None:
+    full, subset = make_session(), make_session()
+    _add_opto_metrics(full)
+    selected = subset.units[:].iloc[[3, 1, 7]]
+    _add_opto_metrics(subset, unit_selection=selected)
+
+    expected = full.units[:].set_index("unit_id")[list(METRIC_COLUMNS)]
+    result = subset.units[:].set_index("unit_id")[list(METRIC_COLUMNS)]
+    np.testing.assert_array_equal(
+        result.loc[selected.unit_id].to_numpy(), expected.loc[selected.unit_id].to_numpy()
+    )
+    assert result.drop(index=selected.unit_id).isna().all().all()
+    assert expected["opto_response"].notna().any()
+
+
+def test_add_response_latency_metrics_flattens_once(make_session, monkeypatch) -> None:
+    calls = []
+    flatten_spike_times = opto.flatten_spike_times
+
+    def counting_flatten(*args, **kwargs):
+        calls.append(args)
+        return flatten_spike_times(*args, **kwargs)
+
+    monkeypatch.setattr(opto, "flatten_spike_times", counting_flatten)
+    _add_opto_metrics(make_session())
+    assert len(calls) == 1
+
+
+def _get_valid_intervals_mask_reference(units, invalid_times, intervals) -> np.ndarray:
+    """Pairwise checks of every interval against invalid times and each unit's
+    observed intervals"""
+    is_invalid = [
+        any(start < b and a < stop for a, b in invalid_times)
+        for start, stop in intervals
+    ]
+    return np.array([
+        [
+            not invalid
+            and (
+                obs_intervals is None
+                or any(a <= start and stop <= b for a, b in obs_intervals)
+            )
+            for (start, stop), invalid in zip(intervals, is_invalid)
+        ]
+        for obs_intervals in units["obs_intervals"]
+    ])
+
+
+def test_valid_intervals_mask(make_session) -> None:
+    session = make_session()
+    units = session.units.to_dataframe()
+    obs_intervals = list(units["obs_intervals"])
+    obs_intervals[0] = [[100.0, 400.0]]
+    obs_intervals[1] = [[0.0, 200.0], [300.0, 600.0]]
+    obs_intervals[2] = [[100.0, 400.0]]
+    obs_intervals[3] = None
+    units["obs_intervals"] = obs_intervals
+    starts = session.trials.stim_start_time.to_numpy()
+    # the last invalid interval touches a trial's interval without overlapping it
+    session.invalid_times = pd.DataFrame({
+        "start_time": [starts[1] - 1.0, starts[23] + 0.9, starts[40] + 1.0],
+        "stop_time": [starts[1], starts[23] + 2.0, starts[40] + 3.0],
+    })
+    intervals = list(zip(starts - 0.5, starts + 1.0))
+
+    expected = _get_valid_intervals_mask_reference(
+        units, session.invalid_times[["start_time", "stop_time"]].to_numpy(), intervals
+    )
+    # intervals overlapping invalid times, and intervals outside partially observed units
+    assert (~expected).all(axis=0).sum() == 2
+    assert not expected[:3].all(axis=1).any()
+    mask = opto.get_valid_intervals_mask(session, intervals)
+    np.testing.assert_array_equal(mask, expected)
+
+    values = np.arange(mask.size, dtype=float).reshape(mask.shape)
+    result = opto.apply_invalid_intervals(session, intervals, values)
+    np.testing.assert_array_equal(np.isnan(result), ~expected)
+    np.testing.assert_array_equal(result[expected], values[expected])
+
+    selected = units.iloc[[2, 0, 5]]
+    np.testing.assert_array_equal(
+        opto.get_valid_intervals_mask(session, intervals, selected), expected[[0, 2, 5]]
+    )
+
+
+def test_get_response_by_condition_matches_loop(make_session) -> None:
+    session = make_session()
+    trials = session.intervals["VisRFMapping"].to_dataframe().copy()
+    trials.loc[trials.index[:3], "grating_x"] = np.nan
+    # NaN responses for some trials, which are ignored in the mean
+    start = trials.stim_start_time.iloc[5]
+    session.invalid_times = pd.DataFrame({"start_time": [start], "stop_time": [start + 0.1]})
+
+    def get_intervals(t: pd.DataFrame) -> tuple[list, list]:
+        starts = t.stim_start_time + opto.VIS_MIN_RESP_LATENCY
+        return (
+            list(zip(starts, starts + opto.VIS_RESP_WINDOW)),
+            list(zip(t.start_time, t.stim_start_time)),
+        )
+
+    result = opto.get_response_by_condition(
+        session, trials, ["grating_x", "grating_y"], *get_intervals(trials)
+    )
+
+    # the loop over conditions that get_response_by_condition replaced (with query
+    # variables, as a NaN condition in an f-string can't be parsed): NaN matches no trials
+    expected = {}
+    for grating_x in trials.grating_x.unique():
+        for grating_y in trials.grating_y.unique():
+            t = trials.query("grating_x == @grating_x and grating_y == @grating_y")
+            if len(t) == 0:
+                continue
+            expected[(grating_x, grating_y)] = np.nanmean(
+                opto.get_response_in_intervals(session, *get_intervals(t)), axis=1
+            )
+    assert not any(np.isnan(x) for x, _ in expected)
+    assert sorted(result.columns) == sorted(expected)
+    for condition, values in expected.items():
+        np.testing.assert_allclose(result[condition].to_numpy(), values, atol=1e-12)
+    assert result.index.tolist() == session.units[:].unit_id.tolist()
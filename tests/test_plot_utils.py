@@ -0,0 +1,49 @@
+from __future__ import annotations
+
+import os
+
+import pytest
+
+import dynamicrouting_summary.plot_utils as plot_utils
+import dynamicrouting_summary.synthetic as synthetic
+import dynamicrouting_summary.unit_index as unit_index
+
+VERSION = synthetic.SYNTHETIC_VERSION
+
+
+def _render(unit_ids, save_path, **kwargs) -> dict:
+    return plot_utils.render_units_context_modulation(
+        unit_ids, save_path, version=VERSION, max_workers=1, units_per_task=2, dpi=20, **kwargs
+    )
+
+
+def test_render_units_context_modulation(synthetic_cache, tmp_path) -> None:
+    save_path = tmp_path / "figures"
+    index = unit_index.get_unit_index(VERSION)
+    # units from two sessions, with a duplicate
+    unit_ids = [*index.index[:3], index.index[-1], index.index[0]]
+    paths = [plot_utils.get_context_modulation_path(save_path, u) for u in unit_ids]
+
+    result = _render(unit_ids[:2], save_path)
+    assert (result["rendered"], result["skipped"]) == (2, 0)
+    assert all(os.path.exists(p) for p in paths[:2])
+    assert not any(os.path.exists(p) for p in paths[2:4])
+    mtime = os.path.getmtime(paths[0])
+
+    # existing figures are skipped
+    result = _render(unit_ids, save_path)
+    assert (result["rendered"], result["skipped"]) == (2, 2)
+    assert all(os.path.exists(p) for p in paths)
+    assert os.path.getmtime(paths[0]) == mtime
+
+    result = _render(unit_ids, save_path, overwrite=True)
+    assert (result["rendered"], result["skipped"]) == (4, 0)
+    assert sorted(os.listdir(save_path)) == sorted(set(map(os.path.basename, paths)))
+
+
+def test_render_units_context_modulation_unknown_unit(synthetic_cache, tmp_path) -> None:
+    save_path = tmp_path / "figures"
+    unit_ids = [unit_index.get_unit_index(VERSION).index[0], "not_a_unit"]
+    with pytest.raises(KeyError, match="Units not found.*not_a_unit"):
+        _render(unit_ids, save_path)
+    assert not os.listdir(save_path)
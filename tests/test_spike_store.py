@@ -0,0 +1,19 @@
+from __future__ import annotations
+
+import numpy as np
+import pandas as pd
+
+import dynamicrouting_summary.storage as storage
+import dynamicrouting_summary.synthetic as synthetic
+from dynamicrouting_summary.spike_store import SpikeStore, write_spike_store
+
+
+def test_write_spike_store_default_source(synthetic_cache, tmp_path) -> None:
+    store = write_spike_store(tmp_path / "store", version=synthetic.SYNTHETIC_VERSION)
+    for session_id in synthetic_cache:
+        units = pd.read_parquet(
+            storage.get_cache_path("units", session_id, version=synthetic.SYNTHETIC_VERSION)
+        )
+        for unit_id, spike_times in zip(units["unit_id"], units["spike_times"]):
+            np.testing.assert_array_equal(store[unit_id], spike_times)
+    assert len(SpikeStore(tmp_path / "store")) == len(synthetic_cache) * 20
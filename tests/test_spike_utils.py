@@ -0,0 +1,170 @@
+from __future__ import annotations
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+import dynamicrouting_summary.spike_utils as spike_utils
+import dynamicrouting_summary.synthetic as synthetic
+import dynamicrouting_summary.utils as utils
+
+
+def _make_timebins_table_reference(trials, bin_size):
+    """make_timebins_table before event marking was vectorized: one boolean
+    mask over all bins per block, reward and trial"""
+    bins = np.arange(trials["start_time"].iloc[0], trials["stop_time"].iloc[-1], bin_size)
+    bin_start = bins[:-1]
+    table = dict(bin_start=bin_start, bin_end=bins[1:], bin_center=(bins[:-1] + bins[1:]) / 2)
+    for name in spike_utils.TIMEBIN_FLAGS:
+        table[name] = np.zeros(len(bin_start), dtype=bool)
+
+    def in_bin(time):
+        return (bin_start >= time) & (bin_start < time + bin_size)
+
+    switch_index = np.hstack(
+        [0, trials.query("is_context_switch")["trial_index"].values, len(trials) - 1]
+    )
+    for ii, switch_trial in enumerate(switch_index[:-1]):
+        block_start = trials.loc[switch_trial]["start_time"]
+        block_end = trials.loc[switch_index[ii + 1]]["stop_time"]
+        in_block = (bin_start >= block_start) & (bin_start < block_end)
+        if trials["is_vis_context"].loc[switch_trial]:
+            table["is_vis_context"][in_block] = True
+            table["is_aud_context"][in_block] = False
+        elif trials["is_aud_context"].loc[switch_trial]:
+            table["is_aud_context"][in_block] = True
+            table["is_vis_context"][in_block] = False
+        if ii > 0:
+            table["is_context_switch"][in_bin(block_start)] = True
+
+    for _, trial in trials.query("is_rewarded").iterrows():
+        table["reward"][in_bin(trial["reward_time"])] = True
+
+    for _, trial in trials.iterrows():
+        is_stim = in_bin(trial["stim_start_time"])
+        if trial["is_vis_stim"]:
+            table["is_vis_stim"][is_stim] = True
+            if trial["is_target"]:
+                table["is_vis_target"][is_stim] = True
+            elif trial["is_nontarget"]:
+                table["is_vis_nontarget"][is_stim] = True
+        elif trial["is_aud_stim"]:
+            table["is_aud_stim"][is_stim] = True
+            if trial["is_target"]:
+                table["is_aud_target"][is_stim] = True
+            elif trial["is_nontarget"]:
+                table["is_aud_nontarget"][is_stim] = True
+        elif trial["is_catch"]:
+            table["is_catch"][is_stim] = True
+        table["stim_start"][is_stim] = True
+        table["stim_stop"][in_bin(trial["stim_stop_time"])] = True
+    return pd.DataFrame.from_dict(table), bins
+
+
+@pytest.mark.parametrize(
+    ("time_before", "time_after", "bin_size"),
+    [(0.5, 1.0, 0.025), (0.5, 1.0, 0.03), (0.5, 1.0, 0.01), (0.23, 0.41, 0.03)],
+)
+def test_make_neuron_time_trials_tensor_matches_psth(
+    session, time_before, time_after, bin_size
+) -> None:
+    units, trials = session.units[:], session.trials
+    tensor = spike_utils.make_neuron_time_trials_tensor(
+        units, None, trials, time_before, time_after, bin_size
+    )
+    for spike_times, unit_tensor in zip(units["spike_times"], tensor.transpose("unit_id", ...)):
+        psth, bin_centers = spike_utils.makePSTH(
+            np.asarray(spike_times), trials["stim_start_time"].to_numpy(), time_before, time_after,
+            bin_size,
+        )
+        np.testing.assert_array_equal(unit_tensor.to_numpy(), psth / bin_size)
+        np.testing.assert_array_equal(unit_tensor["time"].to_numpy(), bin_centers)
+
+
+@pytest.mark.parametrize("bin_size", [0.025, 0.1, 1.0])
+def test_make_timebins_table_matches_reference(session, bin_size) -> None:
+    expected, expected_bins = _make_timebins_table_reference(session.trials, bin_size)
+    table, bins = spike_utils.make_timebins_table(session.trials, bin_size)
+    np.testing.assert_array_equal(bins, expected_bins)
+    pd.testing.assert_frame_equal(table, expected)
+    assert table[list(spike_utils.TIMEBIN_FLAGS)].to_numpy().any(axis=0).all()
+
+    packed, _ = spike_utils.make_timebins_table(session.trials, bin_size, packed_flags=True)
+    assert packed["flags"].dtype == np.uint16
+    pd.testing.assert_frame_equal(
+        spike_utils.unpack_timebin_flags(packed)[expected.columns], expected
+    )
+
+
+@pytest.mark.parametrize("bin_size", [0.025, 0.1])
+def test_make_neuron_timebins_matrix_sparse_matches_dense(session, bin_size) -> None:
+    units = session.units[:]
+    dense, table = spike_utils.make_neuron_timebins_matrix(
+        units, session.trials, bin_size, storage="uint16"
+    )
+    sparse, sparse_table = spike_utils.make_neuron_timebins_matrix(
+        units, session.trials, bin_size, storage="sparse"
+    )
+    pd.testing.assert_frame_equal(sparse_table, table)
+    assert sparse.shape == dense.shape
+    assert len(sparse.bins) == sparse.shape[1] + 1
+    xr.testing.assert_identical(sparse.to_dataarray().astype(dense.dtype), dense)
+
+
+@pytest.mark.parametrize(
+    ("storage", "name"), [("float32", "spikes_per_second"), ("uint8", "spike_counts")]
+)
+def test_make_neuron_timebins_matrix_zarr(session, tmp_path, storage, name) -> None:
+    units = session.units[:]
+    expected, _ = spike_utils.make_neuron_timebins_matrix(
+        units, session.trials, 0.1, storage=storage
+    )
+    da, _ = spike_utils.make_neuron_timebins_matrix(
+        units, session.trials, 0.1, storage=storage, zarr_path=tmp_path / "matrix.zarr",
+        unit_chunk_size=7,
+    )
+    assert da.name == name
+    assert list(xr.open_zarr(tmp_path / "matrix.zarr").data_vars) == [name]
+    xr.testing.assert_equal(da.load(), expected)
+
+
+def test_make_structure_probe_missing_group_name() -> None:
+    units = pd.DataFrame({
+        'unit_id': list('abcdef'),
+        'structure': ['VISp', 'VISp', 'VISp', 'MOs', 'MOs', None],
+        'group_name': ['A', 'B', np.nan, np.nan, np.nan, 'A'],
+    })
+    result = spike_utils.make_structure_probe(units)
+    # as the previous per-structure queries: units with no probe in a structure on several probes
+    # match no probe
+    assert result['structure_probe'].tolist() == ['VISp_A', 'VISp_B', '', 'MOs', 'MOs', '']
+    assert result['unit_id'].tolist() == list('abcdef')
+
+
+@pytest.mark.parametrize("windows_has_probe_column", [False, True])
+def test_get_population_rate_drift_matches_histogram(
+    synthetic_cache, synthetic_root, windows_has_probe_column
+) -> None:
+    consolidated = synthetic_root / synthetic.SYNTHETIC_VERSION / "consolidated"
+    # the cache's epochs table has no session_id column
+    epochs = pd.read_parquet(consolidated / "epochs.parquet")
+    if windows_has_probe_column:
+        epochs = epochs.assign(electrode_group_name="x")
+    n_bins = 7
+    drift_df, counts = spike_utils.get_population_rate_drift(
+        epochs, n_bins=n_bins, version=synthetic.SYNTHETIC_VERSION, batch_size=8
+    )
+
+    units = utils.add_session_id_column(
+        pd.read_parquet(synthetic_root / synthetic.SYNTHETIC_VERSION / "units")
+    )
+    units_by_probe = units.groupby(["session_id", "electrode_group_name"], observed=True)
+    assert len(drift_df) == len(epochs) * units_by_probe.ngroups // len(synthetic_cache)
+    assert (drift_df["electrode_group_name"] != "x").all()
+    for row, row_counts in zip(drift_df.itertuples(), counts):
+        probe_units = units_by_probe.get_group((row.session_id, row.electrode_group_name))
+        edges = np.linspace(row.start_time, row.stop_time, n_bins + 1)
+        expected = sum(np.histogram(t, bins=edges)[0] for t in probe_units["spike_times"])
+        np.testing.assert_array_equal(row_counts, expected)
+        assert row.n_units == len(probe_units)
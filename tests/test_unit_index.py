@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import dynamicrouting_summary.storage as storage
+import dynamicrouting_summary.synthetic as synthetic
+import dynamicrouting_summary.unit_index as unit_index
+
+VERSION = synthetic.SYNTHETIC_VERSION
+
+
+def _read_units(root, session_id: str) -> pd.DataFrame:
+    return pd.read_parquet(root / VERSION / "units" / f"{session_id}.parquet")
+
+
+def test_get_unit_index(synthetic_cache, synthetic_root) -> None:
+    index = unit_index.get_unit_index(VERSION)
+    units = [_read_units(synthetic_root, s) for s in synthetic_cache]
+    assert sorted(index.index) == sorted(pd.concat(units)["unit_id"])
+    # one row group per synthetic units file
+    assert unit_index.get_unit_location(units[-1]["unit_id"].iloc[-1], VERSION) == (
+        f"{synthetic_cache[-1]}.parquet", 0, len(units[-1]) - 1
+    )
+    with pytest.raises(KeyError):
+        unit_index.get_unit_location("not_a_unit", VERSION)
+
+
+def test_get_units_round_trips_rows(synthetic_cache, synthetic_root) -> None:
+    expected = pd.concat(
+        [_read_units(synthetic_root, s).assign(session_id=s) for s in synthetic_cache],
+        ignore_index=True,
+    )
+    # across sessions, out of order
+    rows = expected.iloc[[45, 3, 21, 0, 59]].reset_index(drop=True)
+    df = unit_index.get_units(rows["unit_id"], version=VERSION)
+    assert df["unit_id"].tolist() == rows["unit_id"].tolist()
+    assert df["session_id"].tolist() == rows["session_id"].tolist()
+    for column in ("structure", "default_qc", "firing_rate", "num_spikes"):
+        assert df[column].tolist() == rows[column].tolist()
+    for result, spike_times in zip(df["spike_times"], rows["spike_times"]):
+        np.testing.assert_array_equal(result, spike_times)
+
+    df = unit_index.get_units(rows["unit_id"].iloc[0], columns=["structure"], version=VERSION)
+    assert df.columns.tolist() == ["structure", "unit_id", "session_id"]
+    assert df["structure"].tolist() == [rows["structure"].iloc[0]]
+    with pytest.raises(KeyError):
+        unit_index.get_units(["not_a_unit"], version=VERSION)
+
+
+def test_get_units_reads_row_group_without_mirroring(synthetic_cache, monkeypatch) -> None:
+    mirror = storage.get_mirror()
+    paths = []
+    get_cache_path = storage.get_cache_path
+
+    def spy(*args, **kwargs):
+        paths.append(path := get_cache_path(*args, **kwargs))
+        return path
+
+    monkeypatch.setattr(storage, "get_cache_path", spy)
+    unit_id = unit_index.get_unit_index(VERSION).index[0]
+    expected = unit_index.get_units(unit_id, version=VERSION)
+    assert mirror.get_size() == 0
+    assert not paths[-1].is_relative_to(mirror.root)
+
+    # a copy already in the mirror is read instead
+    session_id = expected["session_id"].iloc[0]
+    local_path = get_cache_path("units", session_id, version=VERSION)
+    assert local_path.is_relative_to(mirror.root)
+    pd.testing.assert_frame_equal(unit_index.get_units(unit_id, version=VERSION), expected)
+    assert paths[-1] == local_path
@@ -0,0 +1,236 @@
+from __future__ import annotations
+
+import collections
+import concurrent.futures
+import threading
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import dynamicrouting_summary.synthetic as synthetic
+import dynamicrouting_summary.utils as utils
+from dynamicrouting_summary.utils import LazyDict
+
+
+def _make_counting_dict(n_keys: int = 3, nbytes: int = 80, delay: float = 0.0, **kwargs):
+    """LazyDict of arrays of `nbytes`, and a counter of evaluations per key"""
+    calls: collections.Counter[str] = collections.Counter()
+    lock = threading.Lock()
+
+    def load(key: str) -> np.ndarray:
+        with lock:
+            calls[key] += 1
+        time.sleep(delay)
+        return np.zeros(nbytes, dtype=np.uint8)
+
+    keys = [chr(ord("a") + idx) for idx in range(n_keys)]
+    return LazyDict({key: (load, (key,), {}) for key in keys}, **kwargs), calls
+
+
+def test_lazy_dict_evicts_least_recently_used() -> None:
+    d, calls = _make_counting_dict(max_bytes=200)
+    d["a"], d["b"]
+    d["a"]  # b is now least recently used
+    d["c"]
+    assert d.loaded_keys == ("a", "c")
+    d["b"]
+    assert d.loaded_keys == ("c", "b")
+    assert calls == {"a": 1, "b": 2, "c": 1}
+
+
+def test_lazy_dict_keeps_one_result_larger_than_budget() -> None:
+    d, calls = _make_counting_dict(nbytes=1000, max_bytes=100)
+    d["a"], d["a"]
+    assert d.loaded_keys == ("a",)
+    assert calls["a"] == 1
+
+
+def test_lazy_dict_without_budget_keeps_all() -> None:
+    d, calls = _make_counting_dict(nbytes=10**6)
+    for key in d:
+        d[key]
+    assert d.loaded_keys == tuple(d)
+
+
+def test_lazy_dict_invalidate() -> None:
+    d, calls = _make_counting_dict()
+    first = d["a"]
+    d.invalidate("a")
+    d.invalidate("b")  # not loaded: no error
+    assert d.loaded_keys == ()
+    assert d["a"] is not first
+    assert calls["a"] == 2
+
+
+def test_lazy_dict_concurrent_access_evaluates_once() -> None:
+    d, calls = _make_counting_dict(delay=0.05)
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(lambda _: d["a"], range(16)))
+    futures = d.prefetch()
+    values = [f.result() for f in futures]
+    assert all(result is results[0] for result in results)
+    assert values[0] is results[0]
+    assert calls == {"a": 1, "b": 1, "c": 1}
+
+
+def test_lazy_dict_prefetch_shared_with_access() -> None:
+    d, calls = _make_counting_dict(delay=0.05)
+    futures = d.prefetch(["a", "b"])
+    assert d["a"] is futures[0].result()
+    assert calls == {"a": 1, "b": 1}
+
+
+def test_lazy_dict_concurrent_prefetch_creates_one_executor(monkeypatch) -> None:
+    created = []
+
+    class SlowExecutor(concurrent.futures.ThreadPoolExecutor):
+        def __init__(self, *args, **kwargs) -> None:
+            created.append(self)
+            time.sleep(0.05)
+            super().__init__(*args, **kwargs)
+
+    monkeypatch.setattr(concurrent.futures, "ThreadPoolExecutor", SlowExecutor)
+    d, calls = _make_counting_dict()
+    threads = [threading.Thread(target=d.prefetch) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(created) == 1
+    for key in d:
+        d[key]
+    assert calls == {"a": 1, "b": 1, "c": 1}
+
+
+def _make_performance_df(seed: int = 0) -> pd.DataFrame:
+    """Block dprimes for sessions of several subjects, including values at the
+    threshold and NaN"""
+    rng = np.random.default_rng(seed)
+    rows = []
+    for subject_idx, n_sessions in enumerate([1, 1, 2, 3, 1, 2]):
+        subject_id = str(660000 + subject_idx)
+        for day in range(n_sessions):
+            for block_index in range(6):
+                rows.append(
+                    dict(
+                        subject_id=subject_id,
+                        session_id=f"{subject_id}_2024-01-0{day + 1}",
+                        block_index=block_index,
+                        **{
+                            column: rng.choice([0.5, 1.0, 1.5, 2.0, 3.0, np.nan])
+                            for column in ("same_modal_dprime", "cross_modal_dprime")
+                        },
+                    )
+                )
+    return pd.DataFrame(rows)
+
+
+def _get_passing_sessions_reference(df: pd.DataFrame, dprimethresh: float) -> dict[str, bool]:
+    """Session passing criterion from `plots.plot_DRephys_behavior`, before
+    `make_behavior_pass_table`"""
+    passed = {}
+    for session in df["session_id"].unique().tolist():
+        sessiondf = df.loc[df["session_id"] == session]
+        dprimeintra = sessiondf["same_modal_dprime"].tolist()
+        dprimeinter = sessiondf["cross_modal_dprime"].tolist()
+        passed[session] = bool(
+            np.sum(np.array(dprimeintra) >= dprimethresh) > 3
+            and np.sum(np.array(dprimeinter) >= dprimethresh) > 3
+        )
+    return passed
+
+
+def _is_subject_passing_reference(subject: str, performance_df: pd.DataFrame) -> bool:
+    """`is_subject_passing_behavior` before `make_behavior_pass_table`: dprimes
+    of blocks with the same index are summed across sessions"""
+    df = performance_df[performance_df["subject_id"] == subject]
+    number_of_blocks_passed = 0
+    for block in df["block_index"].unique():
+        intra_dprime = df[df["block_index"] == block]["same_modal_dprime"].sum()
+        inter_dprime = df[df["block_index"] == block]["cross_modal_dprime"].sum()
+        if (
+            intra_dprime > utils.BEHAVIOR_CRITERIA_THRESHOLD
+            and inter_dprime > utils.BEHAVIOR_CRITERIA_THRESHOLD
+        ):
+            number_of_blocks_passed += 1
+    return number_of_blocks_passed > 3
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_make_behavior_pass_table_matches_plot_criterion(seed) -> None:
+    df = _make_performance_df(seed)
+    table = utils.make_behavior_pass_table(
+        df, by="session_id", threshold=1.5, min_blocks=4, joint=False, inclusive=True
+    )
+    assert dict(zip(table["session_id"], table["is_passing"])) == (
+        _get_passing_sessions_reference(df, 1.5)
+    )
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_is_subject_passing_behavior(seed) -> None:
+    df = _make_performance_df(seed)
+    n_sessions = df.groupby("subject_id")["session_id"].nunique()
+    for subject, count in n_sessions.items():
+        result = utils.is_subject_passing_behavior(subject, df)
+        if count == 1:
+            # unchanged for subjects with one session
+            assert result == _is_subject_passing_reference(subject, df)
+        # blocks passing both criteria are counted across all sessions
+        subject_df = df[df["subject_id"] == subject]
+        dprime = subject_df[["same_modal_dprime", "cross_modal_dprime"]]
+        n_passed = (dprime > utils.BEHAVIOR_CRITERIA_THRESHOLD).all(axis=1).sum()
+        assert result == (n_passed >= utils.BEHAVIOR_CRITERIA_MIN_BLOCKS)
+
+
+def test_is_subject_passing_behavior_counts_blocks_across_sessions() -> None:
+    # two sessions with 2 passing blocks each: passes, as 4 blocks pass in total
+    # (summing dprimes of same-index blocks, blocks 0-3 would pass instead of 0-1)
+    dprimes = [2.0, 2.0, 1.0, 1.0]
+    df = pd.DataFrame(
+        dict(
+            subject_id="660023",
+            session_id=["660023_2024-01-01"] * 4 + ["660023_2024-01-02"] * 4,
+            block_index=[0, 1, 2, 3] * 2,
+            same_modal_dprime=dprimes + dprimes[::-1],
+            cross_modal_dprime=dprimes + dprimes[::-1],
+        )
+    )
+    assert utils.is_subject_passing_behavior("660023", df)
+    assert utils.is_subject_passing_behavior(660023, df.astype({"subject_id": int}))
+    assert not utils.make_behavior_pass_table(df)["is_passing"].any()
+
+
+def test_get_behavior_pass_table(synthetic_cache, synthetic_root) -> None:
+    path = synthetic_root / synthetic.SYNTHETIC_VERSION / "consolidated" / "performance.parquet"
+    performance_df = utils.add_session_id_column(pd.read_parquet(path)).astype({"session_id": str})
+    expected = utils.make_behavior_pass_table(performance_df)
+    table = utils.get_behavior_pass_table(version=synthetic.SYNTHETIC_VERSION)
+    pd.testing.assert_frame_equal(table, expected)
+    assert table["is_passing"].any()
+
+
+def test_add_bool_columns_for_subset_of_sessions(synthetic_cache) -> None:
+    session_ids = [f"{session_id}_0" for session_id in synthetic_cache]
+    df = pd.DataFrame({
+        "subject_id": [s.split("_")[0] for s in synthetic_cache[:2]],
+        "date": [s.split("_")[1] for s in synthetic_cache[:2]],
+        "session_idx": [0, 0],
+    })
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        result = utils.add_bool_columns(df, version=synthetic.SYNTHETIC_VERSION)
+    assert result["session_id"].astype(str).tolist() == session_ids[:2]
+    assert result["is_ephys"].all()
+
+
+def test_add_session_id_column_polars() -> None:
+    pl = pytest.importorskip("polars")
+    df = pl.DataFrame({"subject_id": ["660023"], "date": ["2023-08-09"], "session_idx": [0]})
+    expected = utils.add_session_id_column(df.to_pandas())["session_id"].astype(str).tolist()
+    assert utils.add_session_id_column(df)["session_id"].cast(pl.Utf8).to_list() == expected
+    lazy = utils.add_session_id_column(df.lazy()).collect()
+    assert lazy["session_id"].cast(pl.Utf8).to_list() == expected